@@ -0,0 +1,219 @@
+"""
+REST API client for writing articles
+
+Every write goes over one keep-alive requests Session, so the connection to the API is set up once per run rather
+than once per article, and articles are sent in batches:
+
+* bulk: each batch is a single POST of a JSON array to the bulk endpoint, which answers with a status per article.
+  If the API doesn't have the endpoint (404/405), the client falls back to one by one for the rest of the run
+* one by one (the default): the articles of a batch are POSTed to the create endpoint in order, over the session's
+  kept-alive connection. With `concurrency` above 1 they're pipelined, `concurrency` at a time over pooled
+  connections, which is faster but means they're no longer created in order. The scrapers post oldest first so that
+  a crash can't leave an older article behind a newer one, so only turn it up if that doesn't matter
+
+Either way the caller gets an ApiResult per article, in order, rather than an exception or a raw response to pick
+apart. Articles go through the outbox (see outbox.py) on their way, so one the API couldn't take right now is kept to
+be posted later, and its result is marked `spooled`. The settings come from the 'rest_api' section of the config:
+
+    rest_api:
+        batch_size: 20
+        concurrency: 1
+        bulk: False
+
+    results = get_api().create(articles, PUBLISHER)
+    for result in results:
+        if not result.ok and not result.spooled:
+            get_logger().error(f"{result.error} while creating article {result.item['url']}")
+"""
+import json
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+from dogbeach import retrypolicy
+from dogbeach.outbox import open_outbox
+
+
+class ApiResult:
+    """ What happened to one article """
+
+    def __init__(self, item, status=None, error=None):
+        """
+        :param item: The article that was sent
+        :param status: The HTTP status for the article (None if the request never got an answer)
+        :param error: What went wrong, or None if it was created
+        """
+        self.item = item
+        self.status = status
+        self.error = error
+        self.spooled = False
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return f"ApiResult({self.item.get('url')}, {self.status}, {self.error})"
+
+
+def describe(r):
+    """ :return: the error in a failed response, whether or not its body is JSON """
+    try:
+        body = r.json()
+    except ValueError:
+        body = r.text[:500]
+    return f"{r.status_code} {r.reason}: {body}"
+
+
+def batched(items, size):
+    """ :return: a generator of lists of up to `size` items, from any iterable (a generator of results, say) """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+class ApiClient:
+    """ This class writes articles to the REST API over a pooled session """
+
+    def __init__(self, base_url, user_id, browser_id, batch_size=20, concurrency=1, bulk=False, timeout=60,
+                 outbox=None, logger=None):
+        """
+        :param base_url: The API's url, e.g. http://localhost:8081
+        :param user_id: The system user's id, added to every article
+        :param browser_id: The scraper's browser id, added to every article
+        :param batch_size: How many articles to send per batch
+        :param concurrency: How many POSTs to have in flight at once when not in bulk mode (more than 1 gives up
+            creating the articles in order)
+        :param bulk: Send each batch to the bulk endpoint as one request
+        :param timeout: Seconds to wait for the API to answer a request
+        :param outbox: The Outbox to spool articles in until they're posted (None to not spool them)
+        :param logger: Logger object
+        """
+        self.create_endpoint = f"{base_url}/article"
+        self.bulk_endpoint = f"{base_url}/articles"
+        self.user_id = user_id
+        self.browser_id = browser_id
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.bulk = bulk
+        self.timeout = timeout
+        self.outbox = outbox
+        self.logger = logger
+
+        self.session = requests.Session()
+        self.session.headers.update({"Content-Type": "application/json"})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='api')
+
+    def prepare(self, article, publisher=None):
+        """ Add the fields every article needs """
+        article['userId'] = self.user_id
+        article['browserId'] = self.browser_id
+        if publisher is not None:
+            article['publisher'] = publisher
+        return article
+
+    def post(self, article):
+        """ POST a single article
+
+        :return: an ApiResult
+        """
+        try:
+            r = retrypolicy.post(self.create_endpoint, session=self.session, timeout=self.timeout,
+                                 data=json.dumps(article, default=str))
+        except Exception as ex:
+            return ApiResult(article, error=f"{ex.__class__.__name__}: {ex}")
+        return ApiResult(article, r.status_code, None if r.ok else describe(r))
+
+    def post_bulk(self, articles):
+        """ POST a batch of articles to the bulk endpoint
+
+        :return: a list of ApiResults, or None if the API doesn't have a bulk endpoint
+        """
+        try:
+            r = retrypolicy.post(self.bulk_endpoint, session=self.session, timeout=self.timeout,
+                                 data=json.dumps(articles, default=str))
+        except Exception as ex:
+            return [ApiResult(a, error=f"{ex.__class__.__name__}: {ex}") for a in articles]
+
+        if r.status_code in (404, 405):
+            return None
+        if not r.ok:
+            return [ApiResult(a, r.status_code, describe(r)) for a in articles]
+
+        # The endpoint answers with a status (and an error, when there is one) per article. Anything else means
+        # they all went in
+        try:
+            statuses = r.json()
+        except ValueError:
+            statuses = None
+        if not isinstance(statuses, list) or len(statuses) != len(articles):
+            return [ApiResult(a, r.status_code) for a in articles]
+        return [ApiResult(a, s.get('status', r.status_code), s.get('error')) for a, s in zip(articles, statuses)]
+
+    def create(self, articles, publisher=None):
+        """ Create the articles, in batches, by way of the outbox
+
+        :param articles: A list of article dictionaries
+        :param publisher: Set the articles' publisher (otherwise they keep their own)
+        :return: a list of ApiResults, in the same order as the articles
+        """
+        articles = [self.prepare(a, publisher) for a in articles]
+        if self.outbox is None:
+            return self.send(articles)
+
+        ids = self.outbox.add(articles)
+        results = self.send(articles)
+        self.outbox.settle(ids, results)
+        spooled = sum(1 for r in results if r.spooled)
+        if spooled > 0 and self.logger is not None:
+            self.logger.warning(f"Spooled {spooled} articles in the outbox to post later")
+        return results
+
+    def send(self, articles):
+        """ Post articles that are ready to go, in batches
+
+        :param articles: A list of prepared article dictionaries
+        :return: a list of ApiResults, in the same order as the articles
+        """
+        results = []
+        for batch in batched(articles, self.batch_size):
+            batch_results = self.post_bulk(batch) if self.bulk else None
+            if batch_results is None:
+                if self.bulk and self.logger is not None:
+                    self.logger.warning(f"No bulk endpoint at {self.bulk_endpoint}, POSTing articles one by one")
+                self.bulk = False
+                batch_results = list(self.executor.map(self.post, batch))
+            results += batch_results
+
+        if self.logger is not None:
+            failed = sum(1 for r in results if not r.ok)
+            self.logger.debug(f"Created {len(results) - failed} of {len(results)} articles")
+        return results
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+
+def open_api(config, logger=None, outbox=True):
+    """ Create the API client from the 'rest_api' settings in the 'common' section of the config
+
+    :param config: The loaded config.yml
+    :param logger: Logger object
+    :param outbox: Spool the articles in the outbox until they're posted
+    :return: an ApiClient object
+    """
+    settings = config['common']['rest_api']
+    base_url = f"{settings['protocol']}://{settings['host']}:{settings['port']}"
+    return ApiClient(base_url, config['common']['system_user_id'], config['common']['browser_id'],
+                     batch_size=settings.get('batch_size', 20), concurrency=settings.get('concurrency', 1),
+                     bulk=settings.get('bulk', False), timeout=settings.get('timeout', 60),
+                     outbox=open_outbox(config, logger) if outbox else None, logger=logger)
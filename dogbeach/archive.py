@@ -0,0 +1,154 @@
+"""
+Raw page archive
+
+Every page we fetch is kept, compressed, so that when a selector breaks the parse functions can be re-run over the
+stored pages instead of re-crawling the sites. Pages are stored by the sha256 of their content, so a page that hasn't
+changed between fetches is only stored once, and an append-only index maps each url to its fetches:
+
+    <root>/index.jsonl                  {"url": ..., "fetched_at": ..., "sha256": ..., "codec": ...} per fetch
+    <root>/objects/ab/abcdef....zst     the compressed page source
+
+The index is loaded into a dictionary once, so looking up a url is O(1).
+"""
+import os
+import json
+import gzip
+import hashlib
+import threading
+from pathlib import Path
+from datetime import datetime, timezone
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def _compress(data, codec):
+    if codec == 'zst':
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def _decompress(data, codec):
+    if codec == 'zst':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def content_hash(source):
+    """ :return: the sha256 hex digest of the page source """
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+class PageArchive:
+    """ This class stores and retrieves compressed raw page sources by url """
+
+    def __init__(self, root, compression='zstd'):
+        """
+        :param root: The directory for the archive
+        :param compression: 'zstd' (if the zstandard package is installed, otherwise gzip is used) or 'gzip'
+        """
+        self.root = Path(root)
+        self.codec = 'zst' if compression == 'zstd' and zstandard is not None else 'gz'
+        self.index_file = self.root / 'index.jsonl'
+        self.lock = threading.Lock()
+
+        # url => list of index entries, oldest first
+        self.index = {}
+        os.makedirs(self.root / 'objects', exist_ok=True)
+        if self.index_file.exists():
+            with open(self.index_file, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        self._add_entry(json.loads(line))
+
+    def _add_entry(self, entry):
+        self.index.setdefault(entry['url'], []).append(entry)
+
+    def _object_path(self, digest, codec):
+        return self.root / 'objects' / digest[:2] / f"{digest}.{codec}"
+
+    def put(self, url, source, fetched_at=None):
+        """ Store a fetched page. The content is only written if we don't have it already
+
+        :param url: The url that was requested
+        :param source: The page source
+        :param fetched_at: When it was fetched (defaults to now)
+        :return: the content hash of the page
+        """
+        digest = content_hash(source)
+        fetched_at = datetime.now(timezone.utc) if fetched_at is None else fetched_at
+        entry = {'url': url, 'fetched_at': fetched_at.isoformat(), 'sha256': digest, 'codec': self.codec}
+
+        with self.lock:
+            existing = self.find(digest)
+            if existing is not None:
+                entry['codec'] = existing
+            else:
+                path = self._object_path(digest, self.codec)
+                os.makedirs(path.parent, exist_ok=True)
+                tmp = path.with_suffix('.tmp')
+                with open(tmp, 'wb') as f:
+                    f.write(_compress(source.encode('utf-8'), self.codec))
+                os.replace(tmp, path)
+
+            with open(self.index_file, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            self._add_entry(entry)
+
+        return digest
+
+    def find(self, digest):
+        """ :return: the codec the content is stored with, or None if we don't have it """
+        for codec in ('zst', 'gz'):
+            if self._object_path(digest, codec).exists():
+                return codec
+        return None
+
+    def latest(self, url):
+        """ :return: the index entry for the most recent fetch of the url, or None """
+        entries = self.index.get(url)
+        return entries[-1] if entries else None
+
+    def get(self, url):
+        """ :return: the most recently fetched source of the url, or None if it isn't archived """
+        entry = self.latest(url)
+        return None if entry is None else self.read(entry)
+
+    def read(self, entry):
+        """ :return: the page source for an index entry """
+        with open(self._object_path(entry['sha256'], entry['codec']), 'rb') as f:
+            return _decompress(f.read(), entry['codec']).decode('utf-8')
+
+    def __contains__(self, url):
+        return url in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def urls(self):
+        return list(self.index.keys())
+
+    def pages(self, include=None):
+        """ Iterate over the latest version of every archived page
+
+        :param include: An optional function of the url, returning False for pages to skip
+        :return: a generator of (url, source)
+        """
+        for url in self.urls():
+            if include is None or include(url):
+                yield url, self.get(url)
+
+
+def open_archive(config, publisher):
+    """ Open the publisher's archive, if archiving is turned on in the 'common' section of the config
+
+    :param config: The loaded config.yml
+    :param publisher: The publisher's key, which names its directory in the archive
+    :return: a PageArchive object, or None
+    """
+    settings = config['common'].get('archive', {}) if 'common' in config else {}
+    if not settings.get('enabled', False):
+        return None
+    return PageArchive(Path(settings.get('path', '../data/archive')) / publisher, settings.get('compression', 'zstd'))
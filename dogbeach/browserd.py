@@ -0,0 +1,145 @@
+"""
+Shared browser service
+
+Keeps a single headless Chromium running with its DevTools (CDP) endpoint open on localhost, so that every scraper
+job can attach to it instead of cold starting a browser of its own. DogDriver attaches through chromedriver's
+debuggerAddress and the Playwright scrapers through connect_over_cdp, and each of them works in its own browser
+context so jobs don't share cookies or storage.
+
+Usage: python -m dogbeach.browserd [port]
+
+The host and port come from the 'browser_service' section of config.yml, if there is one (a port on the command line
+wins).
+"""
+import os
+import sys
+import time
+import yaml
+import shutil
+import signal
+import logging
+import tempfile
+import subprocess
+import urllib.request
+from pathlib import Path
+from sys import platform
+
+from dogbeach import doglog
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 9222
+
+# The chromium build installed by playwright, which DogDriver uses as well
+if "linux" in platform:
+    CHROME_BINARY = '/home/ubuntu/.cache/ms-playwright/chromium-1033/chrome-linux/chrome'
+else:
+    CHROME_BINARY = None
+
+
+def settings(config):
+    """ :return: the (enabled, host, port) of the browser service from the 'common' section of the config """
+    service = config['common'].get('browser_service', {}) if 'common' in config else {}
+    return service.get('enabled', False), service.get('host', DEFAULT_HOST), int(service.get('port', DEFAULT_PORT))
+
+
+def is_running(host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """ :return: True if there's a browser answering on the DevTools endpoint """
+    try:
+        with urllib.request.urlopen(f"http://{host}:{port}/json/version", timeout=1) as r:
+            return r.status == 200
+    except OSError:
+        return False
+
+
+def address(config):
+    """ The "host:port" a scraper should attach to, if the service is enabled and actually up. Otherwise None, in
+    which case the scraper just starts its own browser like it always has
+
+    :param config: The loaded config.yml
+    :return: "host:port" or None
+    """
+    enabled, host, port = settings(config)
+    if enabled and is_running(host, port):
+        return f"{host}:{port}"
+    return None
+
+
+def endpoint(addr):
+    """ :return: the http url of the DevTools endpoint, as used by playwright's connect_over_cdp """
+    return f"http://{addr}"
+
+
+def launch(host=DEFAULT_HOST, port=DEFAULT_PORT, binary=CHROME_BINARY, user_data_dir=None):
+    """ Start the browser process
+
+    :param user_data_dir: The browser's profile directory (it's up to the caller to remove it)
+    :return: the Popen object for the browser
+    """
+    if binary is None:
+        raise RuntimeError("No chromium binary configured for this platform")
+    if user_data_dir is None:
+        user_data_dir = tempfile.mkdtemp(prefix='dogbeach-browserd-')
+
+    return subprocess.Popen([
+        binary,
+        '--headless',
+        f'--remote-debugging-address={host}',
+        f'--remote-debugging-port={port}',
+        f'--user-data-dir={user_data_dir}',
+        '--window-size=1920,1080',
+        '--disable-extensions',
+        '--disable-gpu',
+        '--no-sandbox',
+        '--no-proxy-server',
+        'about:blank',
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, logger=None):
+    """ Run the browser, restarting it whenever it dies, until this process is told to stop. Each browser gets a fresh
+    profile directory, which is removed once it's exited """
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    browser, profile = None, None
+    try:
+        while not stopping:
+            if browser is None or browser.poll() is not None:
+                if browser is not None and logger is not None:
+                    logger.error(f"Browser exited with code {browser.returncode}, restarting it")
+                if profile is not None:
+                    shutil.rmtree(profile, ignore_errors=True)
+                profile = tempfile.mkdtemp(prefix='dogbeach-browserd-')
+                browser = launch(host, port, user_data_dir=profile)
+                if logger is not None:
+                    logger.info(f"Browser service started (pid {browser.pid}) on {host}:{port}")
+            time.sleep(1)
+    finally:
+        if browser is not None:
+            browser.terminate()
+            try:
+                browser.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                browser.kill()
+                browser.wait()
+        if profile is not None:
+            shutil.rmtree(profile, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    logfile = Path(os.path.dirname(os.path.realpath(__file__))).parent / "log/browserd.log"
+    _logger = doglog.setup_logger("browserd", logfile, flevel=logging.INFO, clevel=logging.INFO)
+
+    _host, _port = DEFAULT_HOST, DEFAULT_PORT
+    _config_file = Path(os.path.dirname(os.path.realpath(__file__))).parent / "config.yml"
+    if _config_file.exists():
+        with open(_config_file, "r") as ymlfile:
+            _, _host, _port = settings(yaml.load(ymlfile, Loader=yaml.FullLoader))
+
+    serve(_host, int(sys.argv[1]) if len(sys.argv) > 1 else _port, _logger)
@@ -0,0 +1,126 @@
+"""
+Crawl checkpoints
+
+A scraper's progress through a run is kept in a JSON file per publisher (data/checkpoints/<publisher>.json), so a run
+that dies partway through picks up where it stopped rather than walking every listing page again:
+
+* the frontier: the articles found on the listing pages but not posted yet, in the order they were found. Items are
+  dicts with at least a 'url', either the card from the listing page or the fully scraped article
+* the urls posted so far this run
+* whatever else the scraper wants to keep, e.g. how far it got through each category (get/put)
+
+Every change is written straight away, to a temporary file that's then renamed over the checkpoint, so the file is
+always either the old state or the new one, never half written. When the run finishes, `finish` removes it, and the
+next run starts from scratch.
+
+    checkpoint = open_checkpoint(config, PUBLISHER, get_logger())
+    checkpoint.add(cards)
+    for card in checkpoint.pending():
+        ...
+        checkpoint.done(card['url'])
+    checkpoint.finish()
+"""
+import os
+import json
+from pathlib import Path
+from datetime import datetime, timezone
+
+from dogbeach import replay
+
+
+class Checkpoint:
+    """ This class keeps a publisher's crawl frontier and progress on disk """
+
+    def __init__(self, path, logger=None):
+        """
+        :param path: The checkpoint file
+        :param logger: Logger object
+        """
+        self.path = Path(path)
+        self.logger = logger
+        self.resuming = self.path.exists()
+        self.state = {'started': now(), 'frontier': [], 'posted': [], 'progress': {}}
+
+        if self.resuming:
+            with open(self.path, 'r') as f:
+                self.state = json.load(f)
+            if logger is not None:
+                logger.info(f"Resuming the run started {self.state['started']} from {self.path}: "
+                            f"{len(self.state['frontier'])} articles left, {len(self.state['posted'])} posted")
+        self.posted = set(self.state['posted'])
+
+    def save(self):
+        """ Write the checkpoint atomically """
+        self.state['updated'] = now()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def get(self, name, default=None):
+        """ :return: a value the scraper saved with `put` """
+        return self.state['progress'].get(name, default)
+
+    def put(self, name, value):
+        """ Save a value (anything that can go in JSON) """
+        self.state['progress'][name] = value
+        self.save()
+
+    def add(self, items):
+        """ Add items to the end of the frontier, leaving out any already in it or posted. An item already in the
+        frontier is updated in place, e.g. when its card is replaced by the scraped article
+
+        :param items: A list of dicts with a 'url'
+        """
+        position = {item['url']: i for i, item in enumerate(self.state['frontier'])}
+        for item in items:
+            if item['url'] in position:
+                self.state['frontier'][position[item['url']]] = item
+            elif item['url'] not in self.posted:
+                position[item['url']] = len(self.state['frontier'])
+                self.state['frontier'].append(item)
+        self.save()
+
+    def pending(self):
+        """ :return: the items in the frontier, in the order they were added """
+        return list(self.state['frontier'])
+
+    def urls(self):
+        """ :return: the urls in the frontier """
+        return [item['url'] for item in self.state['frontier']]
+
+    def done(self, url):
+        """ Take an item off the frontier once it's been posted (or given up on) """
+        self.state['frontier'] = [item for item in self.state['frontier'] if item['url'] != url]
+        self.state['posted'].append(url)
+        self.posted.add(url)
+        self.save()
+
+    def finish(self):
+        """ The run completed, so the next one starts from scratch """
+        if self.path.exists():
+            self.path.unlink()
+        if self.logger is not None:
+            self.logger.debug(f"Run complete, removed {self.path}")
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def open_checkpoint(config, publisher, logger=None):
+    """ Open (or start) the publisher's checkpoint, from the 'checkpoint' settings in the 'common' section of the config
+    (a scratch one while replaying, which neither resumes nor leaves behind a live run's checkpoint)
+
+    :param config: The loaded config.yml
+    :param publisher: The publisher's key, which names the checkpoint file
+    :param logger: Logger object
+    :return: a Checkpoint object
+    """
+    settings = config['common'].get('checkpoint', {}) if 'common' in config else {}
+    if replay.replaying():
+        return Checkpoint(replay.scratch(f"{publisher}.json"), logger)
+    return Checkpoint(Path(settings.get('path', '../data/checkpoints')) / f"{publisher}.json", logger)
@@ -0,0 +1,127 @@
+"""
+Content hashes
+
+The url index knows which urls we've scraped, but not what was on them, so an article we load again (The Inertia
+moving an article to a new slug, a full re-walk of an archive) gets posted again even when nothing changed. Each
+posted article's content hash is kept next to its url in the url index's database:
+
+* the article hash covers the fields that matter, normalised (title, text_content, thumb, tags), so an article is
+  only posted when one of them is different from what we posted for its url. An article at a url we haven't posted
+  is only taken as one we already have if it's moved (same hash, under another url), and it has both a title and a
+  body, so short pieces that happen to normalise the same aren't mistaken for each other
+* the page hash is of the raw html, so a backfill over archived pages can skip parsing the ones that haven't changed
+  since they were last parsed
+
+    hashes = ContentHashes(already_scraped, get_logger())
+    hashes.check_page(article['url'], source)
+    ...
+    articles = [a for a in articles if not (hashes.unchanged(a) or hashes.moved(a))]
+    ...
+    hashes.remember(posted)
+"""
+import json
+import hashlib
+import threading
+from datetime import datetime, timezone
+
+from dogbeach.text import collapse_whitespace
+
+# The fields that make up an article's hash
+FIELDS = ('title', 'text_content', 'thumb', 'tags')
+
+
+def normalise(field, value):
+    """ :return: the value of one of the FIELDS, without differences that don't matter (whitespace, tag order...) """
+    if value is None:
+        return ''
+    if field == 'tags':
+        tags = value.split(',') if isinstance(value, str) else value
+        return sorted({collapse_whitespace(str(t)).lower() for t in tags} - {''})
+    return collapse_whitespace(str(value))
+
+
+def article_hash(article):
+    """ :return: the hash of the article's normalised FIELDS, as a hex string """
+    fields = {field: normalise(field, article.get(field)) for field in FIELDS}
+    return hashlib.blake2b(json.dumps(fields, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def page_hash(source):
+    """ :return: the hash of the page's html, as a hex string """
+    return hashlib.blake2b(source.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class ContentHashes:
+    """ This class keeps the content hashes of a publisher's articles, in the url index's database """
+
+    def __init__(self, index, logger=None):
+        """
+        :param index: The publisher's UrlIndex
+        :param logger: Logger object
+        """
+        self.index = index
+        self.logger = logger
+        self.pages = {}
+        self.lock = threading.Lock()
+
+        with self.index.lock:
+            self.index.db.execute("CREATE TABLE IF NOT EXISTS hashes (publisher TEXT, key TEXT, content TEXT, "
+                                  "page TEXT, updated_at TEXT, PRIMARY KEY (publisher, key)) WITHOUT ROWID")
+            self.index.db.execute("CREATE INDEX IF NOT EXISTS hashes_content ON hashes (publisher, content)")
+            self.index.db.commit()
+
+    def unchanged(self, article):
+        """ :return: True if the article is the same as what we posted for its url """
+        with self.index.lock:
+            row = self.index.db.execute("SELECT content FROM hashes WHERE publisher = ? AND key = ?",
+                                        (self.index.publisher, self.index.key(article['url']))).fetchone()
+        return row is not None and row[0] == article_hash(article)
+
+    def moved(self, article):
+        """ :return: the url we posted the article under before, if it's the same article (with a title and a body)
+            at a url we haven't posted, otherwise None """
+        if '' in (normalise('title', article.get('title')), normalise('text_content', article.get('text_content'))):
+            return None
+        with self.index.lock:
+            key = self.index.key(article['url'])
+            if self.index.db.execute("SELECT 1 FROM hashes WHERE publisher = ? AND key = ?",
+                                     (self.index.publisher, key)).fetchone() is not None:
+                return None
+            row = self.index.db.execute("SELECT url FROM hashes JOIN urls USING (publisher, key) "
+                                        "WHERE publisher = ? AND content = ?",
+                                        (self.index.publisher, article_hash(article))).fetchone()
+        return None if row is None else row[0]
+
+    def check_page(self, url, source):
+        """ Hash the page the article was parsed from, to be saved along with the article
+
+        :param url: The page's url
+        :param source: The page's html
+        :return: True if it's the same as the page we last saved for the url
+        """
+        key, hashed = self.index.key(url), page_hash(source)
+        with self.lock:
+            self.pages[key] = hashed
+        with self.index.lock:
+            row = self.index.db.execute("SELECT page FROM hashes WHERE publisher = ? AND key = ?",
+                                        (self.index.publisher, key)).fetchone()
+        return row is not None and row[0] == hashed
+
+    def remember(self, articles):
+        """ Save the hashes of articles that were posted (with their page hashes, if `check_page` saw them) """
+        self.save([(self.index.key(a['url']), article_hash(a)) for a in articles])
+
+    def remember_pages(self, urls):
+        """ Save the page hashes of pages that were parsed, leaving the article hashes as they are """
+        self.save([(self.index.key(url), None) for url in urls])
+
+    def save(self, rows):
+        updated = datetime.now(timezone.utc).isoformat()
+        with self.lock:
+            rows = [(self.index.publisher, key, content, self.pages.pop(key, None), updated) for key, content in rows]
+        with self.index.lock:
+            self.index.db.executemany("INSERT INTO hashes VALUES (?, ?, ?, ?, ?) "
+                                      "ON CONFLICT (publisher, key) DO UPDATE "
+                                      "SET content = COALESCE(excluded.content, content), "
+                                      "page = COALESCE(excluded.page, page), updated_at = excluded.updated_at", rows)
+            self.index.db.commit()
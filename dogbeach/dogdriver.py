@@ -1,38 +1,149 @@
 import os
 import time
+import queue
+import lxml.html
+from lxml.cssselect import CSSSelector
 from dogbeach import doglog
+from dogbeach import retrypolicy
+from dogbeach import replay
+from dogbeach.browserd import CHROME_BINARY
+from concurrent.futures import ThreadPoolExecutor
 from sys import platform
 from pathlib import Path
 from selenium import webdriver
+from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.support.ui import WebDriverWait
 from selenium.common.exceptions import TimeoutException
 from selenium.common.exceptions import WebDriverException
+from selenium.common.exceptions import NoSuchElementException
+
+# The url patterns (see the CDP Network.setBlockedURLs command) blocked by each resource blocking profile
+MEDIA_PATTERNS = ['*.png*', '*.jpg*', '*.jpeg*', '*.gif*', '*.webp*', '*.svg*', '*.ico*', '*.woff*', '*.ttf*', '*.otf*',
+                  '*.mp4*', '*.webm*', '*.m3u8*', '*.mp3*']
+AD_PATTERNS = ['*doubleclick.net*', '*googlesyndication.com*', '*googletagservices.com*', '*google-analytics.com*',
+               '*googletagmanager.com*', '*amazon-adsystem.com*', '*facebook.net*', '*taboola.com*', '*outbrain.com*',
+               '*scorecardresearch.com*', '*quantserve.com*', '*chartbeat.*', '*jwplayer.com*', '*jwpcdn.com*',
+               '*brightcove*', '*ooyala.com*', '*connatix.com*']
+BLOCKING_PROFILES = {
+    'none': [],
+    'media': MEDIA_PATTERNS,
+    'ads': AD_PATTERNS,
+    'lite': MEDIA_PATTERNS + AD_PATTERNS,
+}
+
+# The readiness condition that waits for the page's network activity to settle
+NETWORK_IDLE = 'network-idle'
+
+
+def css(selector):
+    """ Readiness condition: the page is loaded once an element matching the CSS selector exists """
+    return lambda driver: len(driver.find_elements(By.CSS_SELECTOR, selector)) > 0
+
+
+def xpath(expression):
+    """ Readiness condition: the page is loaded once an element matching the XPath expression exists """
+    return lambda driver: len(driver.find_elements(By.XPATH, expression)) > 0
+
+
+def js(predicate):
+    """ Readiness condition: the page is loaded once the javascript expression evaluates truthy """
+    return lambda driver: bool(driver.execute_script("return ({});".format(predicate)))
+
+
+def network_idle(quiet=.5):
+    """ Readiness condition: the document has finished loading and no new resources have been requested for `quiet`
+    seconds (based on the browser's resource timing entries)
+    """
+    state = {'count': -1, 'since': time.time()}
+
+    def idle(driver):
+        count = driver.execute_script(
+            "return document.readyState === 'complete' ? performance.getEntriesByType('resource').length : -1;")
+        now = time.time()
+        if count != state['count']:
+            state['count'], state['since'] = count, now
+            return False
+        return count >= 0 and now - state['since'] >= quiet
+
+    return idle
+
+
+def readiness(ready):
+    """ Convert a readiness declaration into a condition function
+
+    :param ready: None, a condition function taking the webdriver, NETWORK_IDLE, an XPath expression (starting with
+        '/' or '(') or otherwise a CSS selector
+    :return: a function taking the webdriver and returning True when the page is ready, or None
+    """
+    if ready is None or callable(ready):
+        return ready
+    if ready == NETWORK_IDLE:
+        return network_idle()
+    if ready.startswith('/') or ready.startswith('('):
+        return xpath(ready)
+    return css(ready)
 
 
 class DogDriver:
     """ This class will support scraping activities through ChromeDriver """
 
-    def __init__(self, logger=None, sleep=5, tries=10, backoff=.4, pageload_timeout=15):
-        self.driver = self.init_driver()
+    # So scrapers can clean up the page source with the driver they loaded it with
+    clean_unicode = staticmethod(doglog.clean_unicode)
+
+    def __init__(self, logger=None, sleep=5, tries=10, backoff=.4, pageload_timeout=15, ready=None, block=None,
+                 page_load_strategy=None, debugger_address=None, policy=None, archive=None):
+        self.context_id = None
+        if debugger_address is None:
+            self.driver = self.init_driver(block, page_load_strategy)
+        else:
+            self.driver = self.attach_driver(debugger_address, page_load_strategy)
+            self.context_id = self.open_context(self.driver)
+            self.block_urls(self.driver, block)
         self.pageload_timeout = pageload_timeout
         self.set_pageload_timeout(pageload_timeout)
         self.sleep = sleep
         self.tries = tries
         self.backoff = 1 + backoff
+        self.ready = ready
+        self.policy = retrypolicy.get_policy() if policy is None else policy
+        self.archive = archive
         self.logger = logger
+        self.loaded, self.steps = None, 0
 
         if self.logger is not None:
             self.logger.info("Initialized DogDriver with: sleep={}, tries={}, backoff={} and {} logger"
                              .format(sleep, tries, backoff, "no" if logger is None else "a"))
+            if debugger_address is not None:
+                self.logger.info("Attached to the shared browser at {}".format(debugger_address))
     
     def set_pageload_timeout(self, pageload_timeout):
         self.pageload_timeout = pageload_timeout
         self.driver.set_page_load_timeout(pageload_timeout)
     
     @staticmethod
-    def init_driver():
+    def blocked_urls(block):
+        """ :return: the list of url patterns for a blocking profile name, or the list itself if given one """
+        if block is None:
+            return []
+        if isinstance(block, str):
+            return BLOCKING_PROFILES[block]
+        return list(block)
+
+    @staticmethod
+    def block_urls(driver, block):
+        """ Block the heavy requests (images, fonts, ads, autoplay video) at the network level for the current tab """
+        blocked = DogDriver.blocked_urls(block)
+        if len(blocked) > 0:
+            driver.execute_cdp_cmd('Network.enable', {})
+            driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': blocked})
+
+    @staticmethod
+    def init_driver(block=None, page_load_strategy=None):
         """ Create a driver object based on default settings and set for this instance
 
+        :param block: A key of BLOCKING_PROFILES (or a list of url patterns) for requests the browser shouldn't make
+        :param page_load_strategy: 'normal' (wait for everything), 'eager' (return once the DOM is ready) or 'none'
         :return:
         """
         # instantiate a chrome options object so you can set the size and headless preference
@@ -45,48 +156,386 @@ class DogDriver:
         options.add_argument('--no-sandbox')
         options.add_argument('--no-proxy-server')
 
+        # Return from get() before every last resource has loaded
+        if page_load_strategy is not None:
+            options.set_capability('pageLoadStrategy', page_load_strategy)
+
+        # Don't even decode images for the profiles that block media
+        if block in ('media', 'lite'):
+            options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+
         # download the chrome driver from https://sites.google.com/a/chromium.org/chromedriver/downloads and put it in
         # the current directory
         currdir = os.path.dirname(os.path.realpath(__file__)) + "/{}"
         if "linux" in platform:
-            options.binary_location = '/home/ubuntu/.cache/ms-playwright/chromium-1033/chrome-linux/chrome'
-            return webdriver.Chrome(chrome_options=options, executable_path=currdir.format("chromedriver_linux"))
+            options.binary_location = CHROME_BINARY
+            driver = webdriver.Chrome(chrome_options=options, executable_path=currdir.format("chromedriver_linux"))
         else:
-            return webdriver.Chrome(chrome_options=options, executable_path=currdir.format("chromedriver"))
+            driver = webdriver.Chrome(chrome_options=options, executable_path=currdir.format("chromedriver"))
 
-    def get_url(self, url, sleep=None, tries=None):
-        """ Recursive method to retrieve the
+        DogDriver.block_urls(driver, block)
+
+        return driver
+
+    @staticmethod
+    def attach_driver(debugger_address, page_load_strategy=None):
+        """ Create a driver object connected to the already running browser service (see dogbeach.browserd)
+        instead of starting a new browser. Chromedriver won't accept most launch options here, the browser already
+        has them
+
+        :param debugger_address: The "host:port" of the browser's DevTools endpoint
+        :param page_load_strategy: 'normal', 'eager' or 'none'
+        :return:
+        """
+        options = Options()
+        options.add_experimental_option("debuggerAddress", debugger_address)
+        if page_load_strategy is not None:
+            options.set_capability('pageLoadStrategy', page_load_strategy)
+
+        currdir = os.path.dirname(os.path.realpath(__file__)) + "/{}"
+        chromedriver = "chromedriver_linux" if "linux" in platform else "chromedriver"
+        return webdriver.Chrome(chrome_options=options, executable_path=currdir.format(chromedriver))
+
+    @staticmethod
+    def open_context(driver):
+        """ Open a tab in a new, isolated browser context (its own cookies and storage, like an incognito window) and
+        switch the driver to it, so that jobs sharing the browser don't see each other's state
+
+        :return: the id of the browser context, to be disposed of on quit
+        """
+        context = driver.execute_cdp_cmd('Target.createBrowserContext', {'disposeOnDetach': True})
+        target = driver.execute_cdp_cmd('Target.createTarget', {
+            'url': 'about:blank',
+            'browserContextId': context['browserContextId']
+        })
+        driver.switch_to.window(target['targetId'])
+        return context['browserContextId']
+
+    def changed(self):
+        """ Call this after the page changes in place (a "load more" click, the next page loaded by ajax). When
+        recording, the page as it is now is saved as the next step of the url last loaded, for a replay to step
+        through (see replay.py)
+
+        :return: True (the replay driver returns False when there are no more recorded steps)
+        """
+        self.steps += 1
+        if self.loaded is not None:
+            replay.record(replay.step_url(self.loaded, self.steps), self.driver.page_source)
+        return True
+
+    def quit(self):
+        """ Close this driver. When attached to the shared browser, only our own browser context goes away """
+        if self.context_id is not None:
+            try:
+                self.driver.execute_cdp_cmd('Target.disposeBrowserContext', {'browserContextId': self.context_id})
+            except WebDriverException:
+                pass
+        self.driver.quit()
+
+    def wait_until_ready(self, url, condition, timeout):
+        """ Poll the readiness condition for at most `timeout` seconds. A page that never becomes "ready" (a 404, a
+        layout we don't know) is still returned to the caller to deal with, so this never fails the load
+
+        :return: True if the condition was met, False if we gave up waiting
+        """
+        try:
+            WebDriverWait(self.driver, timeout, poll_frequency=.1).until(condition)
+            return True
+        except TimeoutException:
+            if self.logger is not None:
+                self.logger.debug("Page wasn't ready after waiting {} seconds: {}".format(timeout, url))
+            return False
+        except WebDriverException:
+            if self.logger is not None:
+                self.logger.warn("Error checking whether the page was ready: {}".format(url), exc_info=True)
+            return False
+
+    def load(self, url, s, condition):
+        """ Make a single attempt at loading the page, raising the WebDriverException if it fails
 
         :param url: The URL to load
-        :param sleep: The number of seconds (int) to wait after request
+        :param s: The number of seconds to wait after the request, or the most to wait for the condition
+        :param condition: The readiness condition function, or None
+        """
+        self.driver.get(url)
+        if condition is None:
+            time.sleep(s)
+        else:
+            self.wait_until_ready(url, condition, s)
+
+    def get_url(self, url, sleep=None, tries=None, ready=None):
+        """ Load the url, retrying failed loads according to the retry policy (jittered backoff between attempts,
+        the run's retry budget and the site's circuit breaker)
+
+        :param url: The URL to load
+        :param sleep: The number of seconds (int) to wait after request. When there is a readiness condition this is
+            only the upper bound on how long to wait for it. Each retry allows a little longer (see backoff)
         :param tries: The number of times to retry before giving up
-        :return: True if successful, False otherwise
+        :param ready: What "loaded" means for this page (see `readiness`), defaults to the driver's own condition. With
+            no condition at all we just sleep for the full duration
+        :return: True if successful, False otherwise. Successfully loaded pages are saved to the archive, if we have one
         """
         s = self.sleep if sleep is None else sleep
         t = self.tries if tries is None else tries
+        condition = readiness(self.ready if ready is None else ready)
+
+        # Give the page a bit more time to settle on each attempt, backoff AT LEAST 1 second
+        attempt = [0]
+
+        def attempt_load():
+            wait = s
+            for _ in range(attempt[0]):
+                wait += max(int((self.backoff - 1) * wait), 1)
+            attempt[0] += 1
+            self.load(url, wait, condition)
 
         # Attempt to load the page, catch and log any exceptions
         try:
-            self.driver.get(url)
-            time.sleep(s)
+            self.policy.call(url, attempt_load, retry_on=(WebDriverException,), tries=t)
+            if self.archive is not None:
+                self.archive.put(url, self.driver.page_source)
+            replay.record(url, self.driver.page_source)
+            self.loaded, self.steps = url, 0
             return True
         except TimeoutException:
             if self.logger is not None:
                 self.logger.error("TimeoutException on: {}".format(url), exc_info=True)
         except WebDriverException:
             if self.logger is not None:
-                self.logger.warn('Error retrieving page after waiting {} seconds: {}'.format(s, url), exc_info=True)
-        
-        # If this is the last attempt, log an error and return False
-        if t == 1:
+                self.logger.warn('Error retrieving page: {}'.format(url), exc_info=True)
+        except (retrypolicy.CircuitOpenError, retrypolicy.RetryBudgetExhausted) as ex:
             if self.logger is not None:
-                self.logger.error("Failed to retrieve the page before running out of retries")
+                self.logger.error("Not loading {}: {}".format(url, ex))
+
+        if self.logger is not None:
+            self.logger.error("Failed to retrieve the page before running out of retries")
+        return False
+
+
+def find_in(root, by, value):
+    """ Find elements in an lxml tree the way selenium's find_elements would
+
+    :param root: The lxml element to search under
+    :param by: A selenium By strategy
+    :param value: The id, class name, selector or expression
+    :return: a list of lxml elements
+    """
+    if root is None:
+        return []
+    if by == By.ID:
+        return root.xpath('.//*[@id=$value]', value=value)
+    if by == By.NAME:
+        return root.xpath('.//*[@name=$value]', value=value)
+    if by == By.CLASS_NAME:
+        return CSSSelector('.' + value)(root)
+    if by == By.CSS_SELECTOR:
+        return CSSSelector(value)(root)
+    if by == By.TAG_NAME:
+        return root.xpath('.//' + value)
+    if by == By.LINK_TEXT:
+        return root.xpath('.//a[normalize-space(.)=$value]', value=value)
+    if by == By.PARTIAL_LINK_TEXT:
+        return root.xpath('.//a[contains(., $value)]', value=value)
+    return root.xpath(value)
+
+
+class Finder:
+    """ The find_element(s) methods, and their find_element(s)_by_* shortcuts, over an lxml tree """
+
+    def root(self):
+        return None
+
+    def find_elements(self, by=By.ID, value=None):
+        return [ReplayElement(e) for e in find_in(self.root(), by, value)]
+
+    def find_element(self, by=By.ID, value=None):
+        found = self.find_elements(by, value)
+        if len(found) == 0:
+            raise NoSuchElementException("Not in the recorded page: {} {}".format(by, value))
+        return found[0]
+
+    def __getattr__(self, name):
+        for prefix, find in (('find_elements_by_', self.find_elements), ('find_element_by_', self.find_element)):
+            if name.startswith(prefix):
+                by = name[len(prefix):].replace('_', ' ')
+                return lambda value: find(by, value)
+        raise AttributeError(name)
+
+
+class ReplayElement(Finder):
+    """ Stands in for a selenium WebElement while replaying, an element of the recorded page source. Clicking it
+    does nothing, the scraper's `changed()` call moves on to the next recorded step """
+
+    def __init__(self, element):
+        self.element = element
+
+    def root(self):
+        return self.element
+
+    @property
+    def text(self):
+        return " ".join(self.element.text_content().split())
+
+    def get_attribute(self, name):
+        if name == 'innerHTML':
+            return (self.element.text or '') + ''.join(lxml.html.tostring(child, encoding='unicode')
+                                                       for child in self.element)
+        if name == 'outerHTML':
+            return lxml.html.tostring(self.element, encoding='unicode', with_tail=False)
+        if name in ('textContent', 'innerText'):
+            return self.element.text_content()
+        return self.element.get(name)
+
+    def click(self):
+        pass
+
+
+class ReplayWebDriver(Finder):
+    """ Stands in for the selenium webdriver while replaying: elements are found in the page source of the recorded
+    page, and clicks and scripts do nothing """
+
+    def __init__(self):
+        self.current_url = 'about:blank'
+        self.page_source = ''
+        self.parsed = (None, None)
+
+    def root(self):
+        # Parsed once per page source
+        if self.parsed[0] is not self.page_source:
+            tree = lxml.html.fromstring(self.page_source) if self.page_source.strip() else None
+            self.parsed = (self.page_source, tree)
+        return self.parsed[1]
+
+    def execute_script(self, script, *args):
+        return None
+
+    def get_screenshot_as_file(self, filename):
+        return False
+
+    def set_page_load_timeout(self, timeout):
+        pass
+
+    def quit(self):
+        pass
+
+
+class ReplayDriver:
+    """ This class has the same interface as DogDriver, but serves the pages recorded for each url (see replay.py)
+    instead of loading them, without any sleeps """
+
+    clean_unicode = staticmethod(doglog.clean_unicode)
+
+    def __init__(self, logger=None, sleep=0, tries=1, **kwargs):
+        self.driver = ReplayWebDriver()
+        self.sleep = sleep
+        self.tries = tries
+        self.logger = logger
+        self.loaded, self.steps = None, 0
+
+    def get_url(self, url, sleep=None, tries=None, ready=None):
+        """ :return: True if there's a recording for the url, which then becomes the current page """
+        source = replay.fixture(url)
+        if source is None:
+            return False
+        self.driver.current_url = url
+        self.driver.page_source = source
+        self.loaded, self.steps = url, 0
+        return True
+
+    def changed(self):
+        """ :return: True if there's a recording of the next step of the page, which then becomes the current page """
+        if self.loaded is None:
+            return False
+        source = replay.fixture(replay.step_url(self.loaded, self.steps + 1))
+        if source is None:
             return False
+        self.steps += 1
+        self.driver.page_source = source
+        return True
+
+    def set_pageload_timeout(self, pageload_timeout):
+        pass
+
+    def quit(self):
+        pass
+
+
+def open_driver(logger=None, **driver_kwargs):
+    """ :return: a DogDriver, or a ReplayDriver when we're replaying recorded pages """
+    if replay.replaying():
+        return ReplayDriver(logger, **driver_kwargs)
+    return DogDriver(logger, **driver_kwargs)
+
+
+class DogDriverPool:
+    """ A fixed set of warm DogDriver instances that share a work queue, so that several articles can be loaded and
+    parsed at the same time instead of one after another """
 
-        # Calculate the new duration to sleep, backoff AT LEAST 1 second
-        newsleep = s + max(int(self.backoff * s), 1)
+    def __init__(self, size=2, logger=None, bucket=None, **driver_kwargs):
+        """ Start `size` drivers (in parallel, since each Chrome takes a few seconds to come up)
+
+        :param size: The number of drivers, which is also the number of pages in flight at once
+        :param logger: The logger handed to each driver
+        :param bucket: An optional engine.TokenBucket that every task waits on, to stay within the site's rate limit
+        :param driver_kwargs: Any other DogDriver keyword arguments (sleep, tries, backoff, pageload_timeout)
+        """
+        self.size = max(int(size), 1)
+        self.logger = logger
+        self.bucket = bucket
+        self.executor = ThreadPoolExecutor(max_workers=self.size)
+
+        # Each worker checks a driver out of the idle queue for the duration of one task
+        self.idle = queue.Queue()
+        starting = [self.executor.submit(open_driver, logger, **driver_kwargs) for _ in range(self.size)]
+        self.drivers = [f.result() for f in starting]
+        for driver in self.drivers:
+            self.idle.put(driver)
+
+        if self.logger is not None:
+            self.logger.info("Initialized DogDriverPool with {} drivers".format(self.size))
+
+    def _run(self, fn, item):
+        """ Check out an idle driver, run the task with it and always return the driver to the pool """
+        driver = self.idle.get()
+        try:
+            if self.bucket is not None:
+                self.bucket.take()
+            return fn(driver, item)
+        except Exception:
+            if self.logger is not None:
+                self.logger.error("Unhandled error in pooled task for: {}".format(item), exc_info=True)
+            return None
+        finally:
+            self.idle.put(driver)
+
+    def submit(self, fn, item):
+        """ Queue a single task
+
+        :param fn: A function taking (driver, item) and returning the parsed result
+        :param item: The url (or article dict) to process
+        :return: a Future for the result
+        """
+        return self.executor.submit(self._run, fn, item)
+
+    def map(self, fn, items):
+        """ Process every item on the pool
+
+        :param fn: A function taking (driver, item) and returning the parsed result
+        :param items: The urls (or article dicts) to process
+        :return: a generator of results in the same order as `items`, yielded as soon as each one is ready
+        """
+        futures = [self.submit(fn, item) for item in items]
+        for future in futures:
+            yield future.result()
 
-        return self.get_url(url, newsleep, t - 1)
+    def quit(self):
+        """ Shut down the workers and every browser in the pool """
+        self.executor.shutdown(wait=True)
+        for driver in self.drivers:
+            try:
+                driver.quit()
+            except WebDriverException:
+                pass
 
 
 if __name__ == "__main__":
@@ -0,0 +1,144 @@
+import time
+import asyncio
+import threading
+from urllib.parse import urlparse
+from dogbeach import replay
+
+
+def host_of(url):
+    """ :return: the host name of the url, which is what rate limits are keyed on """
+    return urlparse(url).netloc.lower()
+
+
+def rate_limits(config):
+    """ Collect the per-publisher rate limits out of the scraper config
+
+    Any publisher section with a 'host' can set 'rate' (requests per second, on average) and 'burst' (how many
+    requests can go out back to back before the rate applies)
+
+    :param config: The loaded config.yml
+    :return: a dictionary of host => (rate, burst)
+    """
+    limits = {}
+    for section in config.values():
+        if isinstance(section, dict) and 'host' in section and 'rate' in section:
+            limits[section['host'].lower()] = (float(section['rate']), int(section.get('burst', 1)))
+    return limits
+
+
+class TokenBucket:
+    """ A token bucket that can be waited on from threads (take) or from coroutines (acquire) """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.capacity = max(int(burst), 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """ Take a token, going into debt if there isn't one available
+
+        :return: how many seconds the caller has to wait before using the token (never any while replaying)
+        """
+        if replay.replaying():
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def take(self):
+        """ Block the current thread until a token is available """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire(self):
+        """ Suspend the current coroutine until a token is available """
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class CrawlEngine:
+    """ This class runs many fetches at once across hosts, while each host is held to its own token bucket
+
+    The fetch work itself (requests, selenium) is blocking, so it runs on the event loop's thread pool. The event loop
+    only does the waiting, which means being polite to one host never holds up the others.
+    """
+
+    def __init__(self, limits=None, default_rate=1, default_burst=1, concurrency=16, host_concurrency=None,
+                 fetcher=None, logger=None):
+        """
+        :param limits: A dictionary of host => (rate, burst), see `rate_limits`
+        :param default_rate: The requests per second for hosts without a configured limit
+        :param default_burst: The burst for hosts without a configured limit
+        :param concurrency: The total number of requests in flight at once
+        :param host_concurrency: A dictionary of host => requests in flight at once, for hosts that can't take more
+            than a few (e.g. when they're loaded through a single browser)
+        :param fetcher: The Fetcher (or HttpFetcher) used by `fetch` and `fetch_json`
+        :param logger: Logger object
+        """
+        self.limits = {} if limits is None else limits
+        self.default_rate = default_rate
+        self.default_burst = default_burst
+        self.concurrency = concurrency
+        self.host_concurrency = {} if host_concurrency is None else host_concurrency
+        self.fetcher = fetcher
+        self.logger = logger
+        self.buckets = {}
+        self.semaphores = {}
+
+    def bucket(self, host):
+        """ :return: the token bucket for this host, creating it on first use """
+        host = host.lower()
+        if host not in self.buckets:
+            rate, burst = self.limits.get(host, (self.default_rate, self.default_burst))
+            self.buckets[host] = TokenBucket(rate, burst)
+        return self.buckets[host]
+
+    def _semaphore(self, key, size):
+        # Semaphores are bound to the running loop, so they're created lazily inside it
+        if key not in self.semaphores:
+            self.semaphores[key] = asyncio.Semaphore(size)
+        return self.semaphores[key]
+
+    async def call(self, url, fn, *args):
+        """ Wait for the url's host to allow another request, then run the blocking function on the thread pool
+
+        :param url: The url being requested, used to pick the rate limit
+        :param fn: The blocking function doing the work
+        :return: whatever the function returns
+        """
+        host = host_of(url)
+        async with self._semaphore(None, self.concurrency):
+            async with self._semaphore(host, self.host_concurrency.get(host, self.concurrency)):
+                await self.bucket(host).acquire()
+                if self.logger is not None:
+                    self.logger.debug("Engine fetching: {}".format(url))
+                return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    async def fetch(self, url):
+        """ :return: the page body as text, or None """
+        return await self.call(url, self.fetcher.fetch, url)
+
+    async def fetch_json(self, url):
+        """ :return: the decoded json body, or None """
+        return await self.call(url, self.fetcher.fetch_json, url)
+
+    def run(self, coroutines):
+        """ Run the coroutines to completion concurrently
+
+        :param coroutines: A list of coroutines, typically one per category or listing
+        :return: the list of their results, in the same order
+        """
+        async def gather():
+            try:
+                return await asyncio.gather(*coroutines)
+            finally:
+                self.semaphores = {}
+
+        return asyncio.run(gather())
@@ -0,0 +1,139 @@
+"""
+Declarative field extraction
+
+A publisher's extraction rules are declared once, as a Spec of named Fields. Each field lists its selectors in the
+order to try them (so a layout fallback is just another selector), what to take from what they match, and an optional
+post-processing function. The selectors are compiled into lxml XPath/CSSSelector objects when the spec is created, and
+a page is parsed once into an lxml tree that every field is evaluated against in C:
+
+    CARD_SPEC = extract.Spec(
+        url=extract.Field("a", attr="href"),
+        title=extract.Field("h2.article__title a", "h2.title a", text=True, default=""),
+        tags=extract.Field(".//a[@rel='tag']/text()", many=True, default=[]),
+    )
+    article = CARD_SPEC.extract(source)
+    cards = CARD_SPEC.extract_all(source, "article")
+
+Like readiness conditions in dogdriver.py, a selector starting with '/', '(' or '.' is XPath and anything else is CSS.
+
+More selectors can be added to a spec's fields from config.yml without touching the code (see Spec.extend):
+
+    surfd.com:
+        extract:
+            article:
+                title: ["//header//h1/text()"]
+"""
+import lxml.html
+from lxml import etree
+from lxml.cssselect import CSSSelector
+
+
+def is_xpath(selector):
+    return selector.startswith('/') or selector.startswith('(') or selector.startswith('.')
+
+
+def compile_selector(selector):
+    """ :return: the compiled lxml XPath or CSSSelector object for the selector """
+    return etree.XPath(selector) if is_xpath(selector) else CSSSelector(selector)
+
+
+def tree(source):
+    """ :return: the lxml tree for a page (already parsed trees are passed through) """
+    if isinstance(source, str):
+        return lxml.html.document_fromstring(source)
+    return source
+
+
+class Field:
+    """ One value to extract from a page """
+
+    def __init__(self, *selectors, attr=None, text=False, many=False, default=None, post=None):
+        """
+        :param selectors: The XPath or CSS selectors to try, in order. The first one that finds anything wins
+        :param attr: Take this attribute of the matched elements
+        :param text: Take the text content of the matched elements
+        :param many: Return every match as a list, rather than just the first
+        :param default: The value when no selector finds anything (post isn't applied to it)
+        :param post: A function applied to the value (or the list of values when many=True)
+        """
+        self.selectors = list(selectors)
+        self.compiled = [compile_selector(s) for s in selectors]
+        self.attr = attr
+        self.text = text
+        self.many = many
+        self.default = default
+        self.post = post
+
+    def add(self, *selectors):
+        """ Add fallback selectors, tried after the existing ones """
+        self.selectors += selectors
+        self.compiled += [compile_selector(s) for s in selectors]
+
+    def value(self, match):
+        """ :return: what to take from a single match (XPath string results are taken as they are) """
+        if isinstance(match, str):
+            return str(match)
+        if self.attr is not None:
+            return match.get(self.attr)
+        if self.text:
+            return match.text_content()
+        return match
+
+    def extract(self, element):
+        """ :return: the field's value for the element (the whole page, or one item of it) """
+        for selector in self.compiled:
+            values = [v for v in (self.value(m) for m in selector(element)) if v is not None and v != '']
+            if len(values) > 0:
+                value = values if self.many else values[0]
+                return value if self.post is None else self.post(value)
+        return self.default
+
+
+class Spec:
+    """ A named set of fields to extract from a page """
+
+    def __init__(self, **fields):
+        self.fields = fields
+
+    def extend(self, selectors):
+        """ Add fallback selectors to the fields, e.g. from the config
+
+        :param selectors: A dictionary of field name => list of selectors
+        :return: the spec itself
+        """
+        for name, extra in (selectors or {}).items():
+            self.fields[name].add(*extra)
+        return self
+
+    def extract(self, source):
+        """ Extract every field from a page
+
+        :param source: The html, or an lxml tree/element
+        :return: a dictionary of field name => value
+        """
+        element = tree(source)
+        return {name: field.extract(element) for name, field in self.fields.items()}
+
+    def extract_all(self, source, item):
+        """ Extract every field from each item on a page (the cards of a listing page, for instance)
+
+        :param source: The html, or an lxml tree/element
+        :param item: The selector for the items. Field selectors are evaluated relative to each item, so XPath ones
+            should start with './/'
+        :return: a list of dictionaries, one per item in document order
+        """
+        items = compile_selector(item)(tree(source))
+        return [{name: field.extract(element) for name, field in self.fields.items()} for element in items]
+
+
+def from_config(config, publisher, name, spec):
+    """ Extend a spec with the fallback selectors from the 'extract' settings of the publisher's config section
+
+    :param config: The loaded config.yml
+    :param publisher: The publisher's key in the config
+    :param name: The name of the spec in the publisher's 'extract' settings
+    :param spec: The Spec
+    :return: the spec
+    """
+    settings = config.get(publisher, {}).get('extract', {}) or {}
+    return spec.extend(settings.get(name, {}))
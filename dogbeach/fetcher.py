@@ -0,0 +1,144 @@
+import re
+import json
+import html
+import requests
+import threading
+from requests.adapters import HTTPAdapter
+from dogbeach import retrypolicy
+from dogbeach import replay
+
+
+# Chrome wraps a non-html response in a <pre> element when it renders it
+PRE_REGEX = re.compile(r'<pre[^>]*>(.*)</pre>', re.S | re.I)
+
+
+class HttpFetcher:
+    """ This class retrieves pages over plain HTTP, through a single keep-alive session with a connection pool """
+
+    def __init__(self, logger=None, agent=None, timeout=15, pool_size=10, policy=None, archive=None):
+        self.logger = logger
+        self.archive = archive
+        self.timeout = timeout
+        self.policy = retrypolicy.get_policy() if policy is None else policy
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+        if agent is not None:
+            self.session.headers.update({'User-Agent': agent})
+
+    def get(self, url):
+        """ Request the url
+
+        :param url: The URL to load
+        :return: the response if it was successful, None otherwise. Successful responses are saved to the archive, if
+            we have one
+        """
+        try:
+            if replay.replaying():
+                r = replay.response(url)
+            else:
+                r = self.policy.call(url, self.session.get, url, timeout=self.timeout,
+                                     retry_on=retrypolicy.NETWORK_ERRORS, retry_if=retrypolicy.server_error)
+            r.raise_for_status()
+            if self.archive is not None:
+                self.archive.put(url, r.text)
+            replay.record(url, r.text)
+            return r
+        except requests.RequestException:
+            if self.logger is not None:
+                self.logger.warn("HTTP request failed for: {}".format(url), exc_info=True)
+            return None
+        except (retrypolicy.CircuitOpenError, retrypolicy.RetryBudgetExhausted) as ex:
+            if self.logger is not None:
+                self.logger.error("Not requesting {}: {}".format(url, ex))
+            return None
+
+    def fetch(self, url):
+        """ :return: the body of the response as text, or None if the request failed """
+        r = self.get(url)
+        return None if r is None else r.text
+
+    def fetch_json(self, url):
+        """ :return: the decoded json body of the response, or None if the request failed or isn't json """
+        r = self.get(url)
+        if r is None:
+            return None
+        try:
+            return r.json()
+        except ValueError:
+            if self.logger is not None:
+                self.logger.warn("Response wasn't valid json: {}".format(url))
+            return None
+
+    def close(self):
+        self.session.close()
+
+
+class BrowserFetcher:
+    """ This class retrieves pages by loading them in a DogDriver, for pages that need javascript to render. There's
+    only the one browser, so pages are loaded one at a time, whichever threads ask for them """
+
+    def __init__(self, get_driver, ready=None):
+        """
+        :param get_driver: A function returning the DogDriver to use, so that no browser is started until it's needed
+        :param ready: The readiness condition to pass on to DogDriver.get_url
+        """
+        self.get_driver = get_driver
+        self.ready = ready
+        self.lock = threading.Lock()
+
+    def fetch(self, url):
+        """ :return: the page source once loaded, or None if the page couldn't be loaded """
+        with self.lock:
+            driver = self.get_driver()
+            if not driver.get_url(url, ready=self.ready):
+                return None
+            return driver.driver.page_source
+
+    def fetch_json(self, url):
+        """ :return: the decoded json the browser rendered inside its <pre> element, or None """
+        source = self.fetch(url)
+        if source is None:
+            return None
+        match = PRE_REGEX.search(source)
+        try:
+            return json.loads(html.unescape(match.group(1) if match else source))
+        except ValueError:
+            return None
+
+
+class Fetcher:
+    """ Retrieve listing pages over HTTP first, and only fall back to the browser when that fails or when the site
+    actually needs javascript to produce the content """
+
+    def __init__(self, http, browser=None, needs_js=False, logger=None):
+        """
+        :param http: An HttpFetcher
+        :param browser: A BrowserFetcher to fall back on (or None to never use a browser)
+        :param needs_js: Skip straight to the browser
+        :param logger: Logger for reporting the fallbacks
+        """
+        self.http = http
+        self.browser = browser
+        self.needs_js = needs_js and browser is not None
+        self.logger = logger
+
+    def _fetch(self, method, url):
+        if not self.needs_js:
+            result = getattr(self.http, method)(url)
+            if result is not None or self.browser is None:
+                return result
+            if self.logger is not None:
+                self.logger.info("Falling back to the browser for: {}".format(url))
+        return getattr(self.browser, method)(url)
+
+    def fetch(self, url):
+        """ :return: the page body as text, or None """
+        return self._fetch('fetch', url)
+
+    def fetch_json(self, url):
+        """ :return: the decoded json body, or None """
+        return self._fetch('fetch_json', url)
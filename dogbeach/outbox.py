@@ -0,0 +1,216 @@
+"""
+Article outbox
+
+Every article the API client is asked to create is written to an SQLite spool (data/outbox.sqlite) before it's
+posted, and taken out again once the API has it. If the post fails in a way that might go away (the API is down or
+slow, a 5xx, a 429), the article stays in the outbox with a time to try again, and the scraper records the url as
+scraped anyway, so the next run doesn't load the page again. The replayer posts the spooled articles in batches,
+backing off between attempts:
+
+    python -m dogbeach.outbox            # post whatever is due, then exit (e.g. from cron)
+    python -m dogbeach.outbox 300        # keep going, every 5 minutes
+
+Each row is owned by whoever is posting it (the scraper that spooled it, or the replayer that claimed it), for
+LEASE. The replayer only claims rows that are due and aren't leased, so it can't post an article a scraper is still
+waiting on, and only the owner settles a row. If a scraper dies mid-post, its rows are up for grabs once the lease
+runs out.
+
+Articles are spooled when they're handed to the API client. The ones still waiting in a scraper's write-behind queue
+(see writebehind.py) are only in memory, so if the process dies they're not spooled. They aren't lost, as their urls
+were never recorded as scraped (and The Inertia's checkpoint still has them), but they're scraped again next run.
+
+An article the API turns down (any other 4xx) won't go in on a retry either, so it's dropped from the outbox, and
+the scraper gets to it again on a later run like before. The settings are in the 'outbox' section of the config:
+
+    outbox:
+        path: "../data/outbox.sqlite"
+
+The ApiClient does the spooling (see api.py), so a scraper only needs to treat a spooled result like a posted one:
+
+    for result in get_api().create(articles, PUBLISHER):
+        if result.ok or result.spooled:
+            already_scraped.record(result.item['url'])
+"""
+import os
+import sys
+import json
+import time
+import yaml
+import sqlite3
+import logging
+import threading
+from uuid import uuid4
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+
+from dogbeach import doglog
+from dogbeach import replay
+
+# The wait before the first retry, doubling on each failure up to MAX_WAIT
+RETRY_AFTER = timedelta(minutes=1)
+MAX_WAIT = timedelta(hours=6)
+
+# How long a row is held by whoever is posting it, well past the longest a post can take with its retries
+LEASE = timedelta(hours=1)
+
+
+class Outbox:
+    """ This class keeps the articles that haven't made it to the API yet """
+
+    def __init__(self, path, logger=None):
+        """
+        :param path: The SQLite file
+        :param logger: Logger object
+        """
+        self.path = Path(path)
+        self.logger = logger
+        self.owner = uuid4().hex
+        self.lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, publisher TEXT, "
+                        "url TEXT, article TEXT, attempts INTEGER, error TEXT, queued_at TEXT, retry_at TEXT, "
+                        "owner TEXT)")
+        self.db.commit()
+
+    def add(self, articles):
+        """ Spool articles, before they're posted. They're leased to us while we post them
+
+        :param articles: A list of article dictionaries (ready to post)
+        :return: the ids of the spooled articles, in order
+        """
+        queued = now()
+        with self.lock:
+            ids = [self.db.execute("INSERT INTO outbox (publisher, url, article, attempts, queued_at, retry_at, owner) "
+                                   "VALUES (?, ?, ?, 0, ?, ?, ?)",
+                                   (a.get('publisher'), a.get('url'), json.dumps(a, default=str), queued.isoformat(),
+                                    (queued + LEASE).isoformat(), self.owner)).lastrowid
+                   for a in articles]
+            self.db.commit()
+        return ids
+
+    def claim(self, limit):
+        """ Lease up to `limit` of the articles that are due to be posted (and aren't leased to anyone else)
+
+        :return: the (id, article) pairs, oldest first
+        """
+        claimed = now()
+        with self.lock:
+            # Take the write lock up front, so two replayers can't claim the same rows
+            self.db.execute("BEGIN IMMEDIATE")
+            rows = self.db.execute("SELECT id, article FROM outbox WHERE retry_at <= ? ORDER BY id LIMIT ?",
+                                   (claimed.isoformat(), limit)).fetchall()
+            self.db.executemany("UPDATE outbox SET owner = ?, retry_at = ? WHERE id = ?",
+                                [(self.owner, (claimed + LEASE).isoformat(), id) for id, _ in rows])
+            self.db.commit()
+        return [(id, json.loads(article)) for id, article in rows]
+
+    def settle(self, ids, results):
+        """ Take the posted (and the rejected) articles out of the outbox, and set when to try the others again
+        (letting go of them). Marks the results of the articles that are still spooled. Rows someone else has
+        taken over, after our lease ran out, are left to them
+
+        :param ids: The articles' ids
+        :param results: Their ApiResults, in the same order
+        """
+        seen = now()
+        with self.lock:
+            for id, result in zip(ids, results):
+                row = self.db.execute("SELECT attempts FROM outbox WHERE id = ? AND owner = ?",
+                                      (id, self.owner)).fetchone()
+                if row is None:
+                    result.spooled = not result.ok
+                    continue
+                if result.ok or not retryable(result):
+                    self.db.execute("DELETE FROM outbox WHERE id = ?", (id,))
+                    continue
+                result.spooled = True
+                self.db.execute("UPDATE outbox SET attempts = ?, error = ?, retry_at = ?, owner = NULL WHERE id = ?",
+                                (row[0] + 1, result.error, retry_at(row[0] + 1, seen), id))
+            self.db.commit()
+
+    def drain(self, api):
+        """ Post the articles that are due, a batch at a time. Stops early if nothing in a batch gets an answer
+        from the API, as it's probably still down
+
+        :param api: An ApiClient (without an outbox of its own)
+        :return: the number of articles posted
+        """
+        posted = 0
+        while True:
+            rows = self.claim(api.batch_size)
+            if len(rows) == 0:
+                break
+            ids = [id for id, _ in rows]
+            results = api.send([article for _, article in rows])
+            self.settle(ids, results)
+            posted += sum(1 for r in results if r.ok)
+            for r in results:
+                if not r.ok and not r.spooled and self.logger is not None:
+                    self.logger.error(f"The API turned down article {r.item.get('url')}: {r.error}")
+            if all(r.spooled for r in results):
+                break
+
+        if self.logger is not None:
+            self.logger.info(f"Posted {posted} articles from the outbox, {len(self)} still waiting")
+        return posted
+
+    def __len__(self):
+        """ :return: the number of articles waiting to be posted """
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def now():
+    return datetime.now(timezone.utc)
+
+
+def retryable(result):
+    """ :return: True if a failed post might go through later """
+    return result.status is None or result.status >= 500 or result.status in (408, 429)
+
+
+def retry_at(attempts, seen):
+    """ :return: when to post an article again, as an ISO timestamp """
+    return (seen + min(RETRY_AFTER * 2 ** (attempts - 1), MAX_WAIT)).isoformat()
+
+
+def open_outbox(config, logger=None):
+    """ Open the outbox, from the 'outbox' settings in the 'common' section of the config (or a scratch one while
+    replaying, so the articles a replay "posts" are never posted for real)
+
+    :param config: The loaded config.yml
+    :param logger: Logger object
+    :return: an Outbox object
+    """
+    settings = config['common'].get('outbox', {}) if 'common' in config else {}
+    path = replay.scratch('outbox.sqlite') if replay.replaying() else settings.get('path', '../data/outbox.sqlite')
+    return Outbox(path, logger)
+
+
+if __name__ == "__main__":
+    from dogbeach.api import open_api
+
+    root = Path(os.path.dirname(os.path.realpath(__file__))).parent
+    # The paths in the config are relative to the scrapers
+    os.chdir(root / "scrapers")
+    with open("../config.yml", "r") as ymlfile:
+        _config = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    _logger = doglog.setup_logger("outbox", root / "log/outbox.log", flevel=logging.INFO, clevel=logging.INFO)
+
+    _outbox = open_outbox(_config, _logger)
+    _api = open_api(_config, _logger, outbox=False)
+    every = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    while True:
+        _outbox.drain(_api)
+        if every is None:
+            break
+        time.sleep(every)
+    _api.close()
+    _outbox.close()
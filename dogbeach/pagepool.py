@@ -0,0 +1,79 @@
+"""
+A pool of playwright pages (async API) in one browser context
+
+This is the playwright counterpart of DogDriverPool: pages in one context are cheap, so rather than loading articles
+one after another in a single page, a fixed set of pages takes work off a shared queue, and the site's token bucket
+(rather than a sleep between articles) keeps the whole pool within its rate limit.
+
+    pool = PagePool(context, size=4, setup=setup_page, bucket=bucket, logger=logger)
+    await pool.start()
+    articles = await pool.map(extract_article, posts)
+    await pool.close()
+"""
+import asyncio
+
+
+class PagePool:
+    """ A fixed set of pages in a browser context that share a work queue """
+
+    def __init__(self, context, size=2, setup=None, bucket=None, logger=None):
+        """
+        :param context: The playwright (async) browser context to open the pages in
+        :param size: The number of pages, which is also the number of loads in flight at once
+        :param setup: An optional coroutine function taking a new page, to set up its routes and listeners
+        :param bucket: An optional engine.TokenBucket that every task waits on, to stay within the site's rate limit
+        :param logger: Logger object
+        """
+        self.context = context
+        self.size = max(int(size), 1)
+        self.setup = setup
+        self.bucket = bucket
+        self.logger = logger
+        self.pages = []
+        self.idle = None
+
+    async def start(self):
+        """ Open the pages """
+        self.idle = asyncio.Queue()
+        for _ in range(self.size):
+            page = await self.context.new_page()
+            if self.setup is not None:
+                await self.setup(page)
+            self.pages.append(page)
+            self.idle.put_nowait(page)
+
+        if self.logger is not None:
+            self.logger.info("Initialized PagePool with {} pages".format(self.size))
+
+    async def run(self, fn, item):
+        """ Check out an idle page, run the task with it and always return the page to the pool
+
+        :param fn: A coroutine function taking (page, item) and returning the result
+        :param item: The url (or post dict) to process
+        :return: the result, or None if the task raised
+        """
+        page = await self.idle.get()
+        try:
+            if self.bucket is not None:
+                await self.bucket.acquire()
+            return await fn(page, item)
+        except Exception:
+            if self.logger is not None:
+                self.logger.error("Unhandled error in pooled task for: {}".format(item), exc_info=True)
+            return None
+        finally:
+            self.idle.put_nowait(page)
+
+    async def map(self, fn, items):
+        """ Process every item on the pool
+
+        :param fn: A coroutine function taking (page, item) and returning the result
+        :param items: The urls (or post dicts) to process
+        :return: the list of results, in the same order as `items`
+        """
+        return await asyncio.gather(*[self.run(fn, item) for item in items])
+
+    async def close(self):
+        for page in self.pages:
+            await page.close()
+        self.pages = []
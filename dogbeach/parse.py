@@ -0,0 +1,142 @@
+"""
+HTML parsing
+
+Every scraper parses its pages through here, so that the parser is picked in one place, with the 'parser' setting in
+the 'common' section of the config:
+
+* lxml (the default): libxml2's C parser behind BeautifulSoup, several times faster than html.parser
+* html.parser: python's own parser, much slower on big article pages but with no extra dependencies
+* html5lib: the slowest, but parses exactly like a browser does
+
+All of them produce the same BeautifulSoup API, so the scrapers' find/select calls don't change. XPath queries go
+through `selector`, which is the lxml based Scrapy selector.
+
+When a scraper only needs the article, `only` compiles CSS selectors for its container element(s). The page is then
+parsed by lxml alone (which is fast, it's all C) just to find those elements, and only they become BeautifulSoup
+trees, so the nav, footer, widgets and scripts around the article cost next to nothing:
+
+    ARTICLE_ROOT = htmlparse.only("div.inertia-article", "main.inertia-article")
+    soup = htmlparse.soup(source, only=ARTICLE_ROOT)
+
+To compare the parsers on real pages: python -m dogbeach.parse <archive dir> [max pages]
+"""
+import sys
+import time
+from bs4 import BeautifulSoup, FeatureNotFound
+
+try:
+    import lxml
+    import lxml.html
+    from lxml import etree
+    from lxml.cssselect import CSSSelector
+except ImportError:
+    lxml = None
+
+BACKENDS = ('lxml', 'html.parser', 'html5lib')
+DEFAULT_BACKEND = 'lxml' if lxml is not None else 'html.parser'
+
+_backend = DEFAULT_BACKEND
+
+
+def configure(config):
+    """ Set the parser backend from the 'parser' setting in the 'common' section of the config
+
+    :param config: The loaded config.yml
+    :return: the backend in use
+    """
+    global _backend
+    name = config['common'].get('parser', DEFAULT_BACKEND) if 'common' in config else DEFAULT_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown parser backend: {name} (expected one of {', '.join(BACKENDS)})")
+    _backend = DEFAULT_BACKEND if name == 'lxml' else name
+    return _backend
+
+
+def backend():
+    return _backend
+
+
+def only(*selectors):
+    """ Compile the CSS selectors for the elements `soup` should keep (along with everything inside them)
+
+    :return: a function taking an lxml tree and returning the matching elements
+    """
+    return CSSSelector(", ".join(selectors))
+
+
+def roots(source, only):
+    """ Find the elements matching the selectors with lxml, leaving out any that are inside another match
+
+    :param source: The html
+    :param only: The compiled selectors from `only`
+    :return: a list of lxml elements, in document order
+    """
+    try:
+        matches = only(lxml.html.fromstring(source))
+    except (ValueError, etree.ParserError):
+        return []
+    kept = set()
+    for element in matches:
+        if not any(ancestor in kept for ancestor in element.iterancestors()):
+            kept.add(element)
+    return [element for element in matches if element in kept]
+
+
+def soup(source, backend=None, only=None):
+    """ Parse a page
+
+    :param source: The html
+    :param backend: Override the configured backend
+    :param only: Compiled selectors from `only`, to turn nothing but the matching elements into the soup. If nothing
+        on the page matches, the whole page is parsed instead
+    :return: a BeautifulSoup object
+    """
+    backend = _backend if backend is None else backend
+    if only is not None and lxml is not None:
+        elements = roots(source, only)
+        if len(elements) > 0:
+            source = "".join(etree.tostring(e, encoding='unicode', method='html', with_tail=False) for e in elements)
+    return BeautifulSoup(source, backend)
+
+
+def selector(source):
+    """ :return: a Scrapy Selector for the html, for XPath queries """
+    from scrapy.selector import Selector
+    return Selector(text=source)
+
+
+def benchmark(sources, backends=BACKENDS, only=None):
+    """ Time each backend parsing the pages
+
+    :param sources: A list of page sources
+    :param backends: The backends to compare
+    :param only: An optional filter from `only`, to time partial parses
+    :return: a dictionary of backend => average milliseconds per page (backends that aren't installed are left out)
+    """
+    results = {}
+    for name in backends:
+        try:
+            start = time.perf_counter()
+            for source in sources:
+                soup(source, name, only)
+            results[name] = (time.perf_counter() - start) * 1000 / max(len(sources), 1)
+        except FeatureNotFound:
+            continue
+    return results
+
+
+if __name__ == "__main__":
+    from dogbeach.archive import PageArchive
+
+    if len(sys.argv) < 2:
+        print("Usage: python -m dogbeach.parse <archive dir> [max pages]")
+        sys.exit(1)
+
+    archive = PageArchive(sys.argv[1])
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    pages = [source for _, source in archive.pages()][:limit]
+    size = sum(len(p) for p in pages) / max(len(pages), 1) / 1024
+    print(f"{len(pages)} pages from {sys.argv[1]}, {size:.0f}KB on average")
+
+    for name, ms in sorted(benchmark(pages).items(), key=lambda x: x[1]):
+        print(f"{name:12} {ms:8.1f} ms/page")
@@ -0,0 +1,253 @@
+"""
+Record and replay the responses a scraper sees
+
+* record: every page, listing and API response that's fetched is also saved as a fixture in
+  data/fixtures/<publisher> (a PageArchive, see archive.py)
+* replay: nothing goes out over the network. Pages and GETs are served from the fixtures, POSTs to the API are
+  answered locally, and every sleep and rate limit is skipped, so a whole scrape() runs offline at CPU speed
+
+The mode comes from the 'replay' settings in the 'common' section of the config, and the DOGBEACH_REPLAY environment
+variable overrides it:
+
+    DOGBEACH_REPLAY=record python scrape_surfline.py
+    DOGBEACH_REPLAY=replay python scrape_surfline.py
+
+Everything that fetches (DogDriver, HttpFetcher, the retrypolicy request helpers and playwright pages through
+`attach`) checks this module, so the scrapers themselves mostly only have to call `configure`. Two things need a
+hand from the scraper:
+
+* pages that change in place (a "load more" click, the next page of a listing loaded by ajax): the scraper calls
+  the driver's `changed()` each time, which records the page as the next step of the url it loaded, under
+  `step_url(url, n)`. While replaying, `changed()` moves on to the next recorded step, and the replay driver finds
+  (and "clicks") elements in the recorded source
+* calls through other clients, like the google api client the YouTube scraper uses: wrap them in `call`, which
+  records the JSON they return and hands it back while replaying
+
+A replay mustn't touch what the live runs keep, or the next live run would think the replayed articles were posted.
+While replaying, the url index (and so the skips, hashes and watermarks kept in its database), the outbox and the
+checkpoint are opened in a scratch directory that's removed when the process exits (see `scratch`). The url index
+isn't synced with the API, it starts from the snapshot of the publisher's rows the record run saved with its
+fixtures after syncing (see `snapshot` and `restore`), so the replay skips the same articles the record run did.
+"""
+import os
+import json
+import time
+import atexit
+import shutil
+import sqlite3
+import tempfile
+import requests
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from dogbeach.archive import PageArchive
+
+LIVE = 'live'
+RECORD = 'record'
+REPLAY = 'replay'
+MODES = (LIVE, RECORD, REPLAY)
+
+_mode = LIVE
+_fixtures = None
+_logger = None
+_scratch = None
+
+# The API calls answered locally while replaying, as (method, url, body), so a run can be checked afterwards
+posted = []
+
+
+def configure(config, publisher, logger=None):
+    """ Set the mode for this process and open the publisher's fixtures
+
+    :param config: The loaded config.yml
+    :param publisher: The publisher's key, which names its directory under the fixtures path
+    :param logger: Logger object
+    :return: the mode
+    """
+    global _mode, _fixtures, _logger
+    settings = config['common'].get('replay', {}) if 'common' in config else {}
+    mode = os.environ.get('DOGBEACH_REPLAY', settings.get('mode', LIVE))
+    if mode not in MODES:
+        raise ValueError(f"Unknown replay mode: {mode} (expected one of {', '.join(MODES)})")
+
+    _mode = mode
+    _logger = logger
+    _fixtures = None
+    if mode != LIVE:
+        _fixtures = PageArchive(Path(settings.get('path', '../data/fixtures')) / publisher,
+                                settings.get('compression', 'zstd'))
+        if logger is not None:
+            logger.info(f"{mode.capitalize()}ing fixtures in {_fixtures.root} ({len(_fixtures)} recorded urls)")
+    return mode
+
+
+def mode():
+    return _mode
+
+
+def recording():
+    return _mode == RECORD
+
+
+def replaying():
+    return _mode == REPLAY
+
+
+def pause(seconds):
+    """ time.sleep, except while replaying, when there's no site to be polite to and nothing to wait for """
+    if not replaying():
+        time.sleep(seconds)
+
+
+def record(url, source):
+    """ Save the response for the url, if we're recording """
+    if recording() and source is not None:
+        _fixtures.put(url, source)
+
+
+def fixture(url):
+    """ :return: the recorded response for the url, or None """
+    source = _fixtures.get(url) if _fixtures is not None else None
+    if source is None and _logger is not None:
+        _logger.warn(f"No recording for: {url}")
+    return source
+
+
+def step_url(url, step):
+    """ :return: the url a page is recorded under after `step` changes in place """
+    return f"{url}#dogbeach-step-{step}"
+
+
+def scrub(url, params=('key',)):
+    """ :return: the url without the query parameters that shouldn't end up in a fixture's name (api keys) """
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in params]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def call(url, fn):
+    """ Make a call that returns JSON through the current mode: live it's just made, recording the result is saved
+    under the url as well, and replaying the recorded result comes back without making the call
+
+    :param url: What the call fetches, to name the recording by (see `scrub`)
+    :param fn: The function making the call
+    :return: the result, or None if we're replaying and there's no recording
+    """
+    if replaying():
+        source = fixture(url)
+        return None if source is None else json.loads(source)
+    result = fn()
+    record(url, json.dumps(result))
+    return result
+
+
+def scratch(name):
+    """ :return: the path for a file in this process's scratch directory, which is removed when the process exits """
+    global _scratch
+    if _scratch is None:
+        _scratch = Path(tempfile.mkdtemp(prefix='dogbeach-replay-'))
+        atexit.register(shutil.rmtree, _scratch, True)
+    return _scratch / name
+
+
+def snapshot(db, name, publisher):
+    """ Save a copy of an SQLite database with the fixtures, with only the publisher's rows, if we're recording
+
+    :param db: The sqlite3 connection
+    :param name: The file name to save it under
+    :param publisher: The publisher whose rows to keep (from the tables with a publisher column)
+    """
+    if not recording():
+        return
+    copy = sqlite3.connect(str(_fixtures.root / name))
+    try:
+        db.backup(copy)
+        tables = [row[0] for row in copy.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()]
+        for table in tables:
+            if 'publisher' in [column[1] for column in copy.execute(f"PRAGMA table_info({table})")]:
+                copy.execute(f"DELETE FROM {table} WHERE publisher != ?", (publisher,))
+        copy.commit()
+        copy.execute("VACUUM")
+    finally:
+        copy.close()
+
+
+def restore(name):
+    """ :return: the path of a scratch copy of the database saved with `snapshot` (a path for a new one, if the
+        recording doesn't have it). It's only copied once per process """
+    path = scratch(name)
+    saved = _fixtures.root / name
+    if not path.exists() and saved.exists():
+        shutil.copyfile(saved, path)
+    elif not path.exists() and _logger is not None:
+        _logger.warn(f"No recording of {name}, starting from an empty one")
+    return path
+
+
+def response(url, status=None, body=None):
+    """ Build a requests Response from the recording of the url
+
+    :param url: The url requested
+    :param status: Override the status code (by default 200, or 404 when there's no recording)
+    :param body: Override the body
+    :return: a requests.Response object
+    """
+    body = fixture(url) if body is None else body
+    r = requests.Response()
+    r.url = url
+    r.status_code = (200 if body is not None else 404) if status is None else status
+    r.encoding = 'utf-8'
+    r._content = (body or '').encode('utf-8')
+    r.headers['Content-Type'] = 'application/json' if body and body.lstrip()[:1] in '[{' else 'text/html'
+    return r
+
+
+def respond(method, url, **kwargs):
+    """ Answer a request from the recordings: GETs get the recorded response, anything else (the API POSTs) is
+    accepted and remembered in `posted`. A POST of a list of articles (to the bulk endpoint) is answered like the API
+    does, with a status per article
+
+    :return: a requests.Response object
+    """
+    if method.upper() == 'GET':
+        return response(url)
+
+    body = kwargs.get('data', kwargs.get('json'))
+    posted.append((method.upper(), url, body))
+    try:
+        items = json.loads(body) if isinstance(body, (str, bytes)) else body
+    except ValueError:
+        items = None
+    if isinstance(items, list):
+        return response(url, status=200, body=json.dumps([{'status': 201} for _ in items]))
+    return response(url, status=200, body=json.dumps({}))
+
+
+async def _fulfill(route, request):
+    """ Playwright route handler that serves documents from the recordings and drops everything else """
+    if request.resource_type != 'document':
+        await route.abort()
+        return
+    source = fixture(request.url)
+    if source is None:
+        await route.fulfill(status=404, body='')
+    else:
+        await route.fulfill(status=200, body=source, content_type='text/html; charset=utf-8')
+
+
+async def _record_response(response):
+    """ Playwright response listener that records the documents loaded """
+    if response.request.resource_type == 'document' and response.status == 200:
+        record(response.url, await response.text())
+
+
+async def attach(page):
+    """ Hook a playwright page (async API) up to the current mode. Call it after the scraper has set up its own
+    routes, since the last route registered takes precedence
+
+    :param page: The playwright page object
+    """
+    if replaying():
+        await page.route('**/*', _fulfill)
+    elif recording():
+        page.on('response', _record_response)
@@ -0,0 +1,278 @@
+"""
+One retry policy for every fetch and API call
+
+* jittered exponential backoff between attempts
+* a retry budget for the whole run, so a bad night can't turn into hours of retrying
+* a circuit breaker per host, so once a site is clearly down every call to it fails fast instead of waiting out its
+  own retries
+
+Policies are shared per process (like loggers), so that the budget and the breakers see every call:
+
+    policy = retrypolicy.get_policy()
+    r = policy.call(url, requests.get, url, retry_on=NETWORK_ERRORS, retry_if=server_error)
+
+or for plain requests calls, just:
+
+    r = retrypolicy.post(url, headers=header, data=json_data)
+"""
+import time
+import random
+import asyncio
+import requests
+import threading
+from urllib.parse import urlparse
+from dogbeach import replay
+
+
+# The requests exceptions that are worth retrying - anything else (bad urls, invalid responses) won't go away
+NETWORK_ERRORS = (requests.ConnectionError, requests.Timeout)
+
+
+class CircuitOpenError(Exception):
+    """ Raised instead of making a call to a host whose circuit breaker is open """
+
+
+class RetryBudgetExhausted(Exception):
+    """ Raised when a call fails and the run has no retries left to spend """
+
+
+class RetryBudget:
+    """ A number of retries shared by every call in the run """
+
+    def __init__(self, retries=None):
+        """ :param retries: How many retries the run may spend in total, None for no limit """
+        self.remaining = retries
+        self.lock = threading.Lock()
+
+    def spend(self):
+        """ :return: True if there was a retry left to spend """
+        with self.lock:
+            if self.remaining is None:
+                return True
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+class CircuitBreaker:
+    """ Opens after `threshold` consecutive failures, then lets a single trial call through every `cooldown` seconds
+    until one succeeds """
+
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """ :return: True if a call may go ahead """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                # Half open - restart the clock so only this one trial gets through
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        """ :return: True if this failure tripped the breaker """
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold and self.opened_at is None:
+                self.opened_at = time.monotonic()
+                return True
+            if self.opened_at is not None:
+                # A failed trial keeps it open for another cooldown
+                self.opened_at = time.monotonic()
+            return False
+
+
+class RetryPolicy:
+    """ This class makes calls with retries, sharing a retry budget and per-host circuit breakers """
+
+    def __init__(self, tries=5, delay=1, backoff=2, max_delay=30, budget=None, breaker_threshold=5,
+                 breaker_cooldown=60, logger=None):
+        """
+        :param tries: The number of attempts for each call
+        :param delay: The base delay (seconds) before the first retry
+        :param backoff: The multiplier for the delay after each attempt
+        :param max_delay: The cap on the delay between attempts
+        :param budget: The total number of retries for the run (None for no limit)
+        :param breaker_threshold: Consecutive failures before a host's circuit opens
+        :param breaker_cooldown: Seconds before an open circuit lets a trial call through
+        :param logger: Logger object
+        """
+        self.tries = tries
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.budget = RetryBudget(budget)
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.logger = logger
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def breaker(self, url):
+        """ :return: the circuit breaker for the host of this url """
+        host = urlparse(url).netloc.lower()
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(self.breaker_threshold, self.breaker_cooldown)
+            return self.breakers[host]
+
+    def wait_time(self, attempt):
+        """ :return: the (full jitter) delay before the retry that follows this attempt number (0 based) """
+        return random.uniform(0, min(self.max_delay, self.delay * self.backoff ** attempt))
+
+    def _before(self, url, breaker):
+        if not breaker.allow():
+            raise CircuitOpenError("Circuit is open for {}".format(urlparse(url).netloc))
+
+    def _after_failure(self, url, breaker, attempt, tries, error):
+        """ Record a failed attempt
+
+        :return: the number of seconds to wait before the next attempt, or None if we should give up
+        """
+        if breaker.failure() and self.logger is not None:
+            self.logger.error("Circuit opened for {} after {} failures in a row".format(
+                urlparse(url).netloc, breaker.failures))
+        if attempt == tries - 1 or breaker.is_open:
+            return None
+        if not self.budget.spend():
+            if self.logger is not None:
+                self.logger.error("Retry budget exhausted, not retrying: {}".format(url))
+            raise RetryBudgetExhausted(str(error))
+
+        wait = self.wait_time(attempt)
+        if self.logger is not None:
+            self.logger.warn("Attempt {} of {} failed for {} ({}), retrying in {:.1f} seconds".format(
+                attempt + 1, tries, url, error, wait))
+        return wait
+
+    def call(self, url, fn, *args, retry_on=(Exception,), retry_if=None, tries=None, **kwargs):
+        """ Call the function, retrying when it raises one of `retry_on` or its result satisfies `retry_if`
+
+        :param url: The url being requested, which picks the circuit breaker
+        :param fn: The function to call with *args and **kwargs
+        :param retry_on: The exception types that are worth retrying
+        :param retry_if: An optional function of the result that returns True if the result is a failure
+        :param tries: Override the number of attempts for this call
+        :return: the function's result. If every attempt failed on `retry_if`, the last result
+        """
+        tries = self.tries if tries is None else tries
+        breaker = self.breaker(url)
+        for attempt in range(tries):
+            self._before(url, breaker)
+            try:
+                result = fn(*args, **kwargs)
+            except retry_on as ex:
+                wait = self._after_failure(url, breaker, attempt, tries, ex)
+                if wait is None:
+                    raise
+            else:
+                if retry_if is None or not retry_if(result):
+                    breaker.success()
+                    return result
+                wait = self._after_failure(url, breaker, attempt, tries, "unsuccessful result")
+                if wait is None:
+                    return result
+            time.sleep(wait)
+
+    async def acall(self, url, fn, *args, retry_on=(Exception,), retry_if=None, tries=None, **kwargs):
+        """ The same as `call`, for a coroutine function, without blocking the event loop between attempts """
+        tries = self.tries if tries is None else tries
+        breaker = self.breaker(url)
+        for attempt in range(tries):
+            self._before(url, breaker)
+            try:
+                result = await fn(*args, **kwargs)
+            except retry_on as ex:
+                wait = self._after_failure(url, breaker, attempt, tries, ex)
+                if wait is None:
+                    raise
+            else:
+                if retry_if is None or not retry_if(result):
+                    breaker.success()
+                    return result
+                wait = self._after_failure(url, breaker, attempt, tries, "unsuccessful result")
+                if wait is None:
+                    return result
+            await asyncio.sleep(wait)
+
+
+_policies = {}
+
+
+def get_policy(name='default', **settings):
+    """ Return the shared policy with this name, creating it with the settings on first use
+
+    :param name: The name of the policy
+    :param settings: RetryPolicy keyword arguments, only used when the policy is first created
+    :return: a RetryPolicy object
+    """
+    if name not in _policies:
+        _policies[name] = RetryPolicy(**settings)
+    return _policies[name]
+
+
+def configure(config, logger=None, name='default'):
+    """ Create the shared policy from the 'retry' settings in the 'common' section of the config
+
+    :param config: The loaded config.yml
+    :param logger: Logger object for the policy
+    :return: the RetryPolicy object
+    """
+    settings = dict(config['common'].get('retry', {})) if 'common' in config else {}
+    if name in _policies:
+        # Reset in place, anything already holding on to the policy picks up the new settings
+        _policies[name].__init__(logger=logger, **settings)
+    else:
+        _policies[name] = RetryPolicy(logger=logger, **settings)
+    return _policies[name]
+
+
+def server_error(response):
+    """ A `retry_if` for requests responses: retry on 5xx errors, but not on client errors that won't go away """
+    return response.status_code >= 500
+
+
+def request(method, url, policy=None, session=None, **kwargs):
+    """ Make a requests call under the retry policy, retrying network errors and 5xx responses
+
+    :param method: The HTTP method
+    :param url: The url to request
+    :param policy: The RetryPolicy to use (the shared default policy if None)
+    :param session: A requests Session to make the call on, to reuse its connections
+    :param kwargs: Any other requests arguments
+    :return: the last response (or the recorded one, when replaying)
+    """
+    if replay.replaying():
+        return replay.respond(method, url, **kwargs)
+
+    policy = get_policy() if policy is None else policy
+    fn = requests.request if session is None else session.request
+    r = policy.call(url, fn, method, url, retry_on=NETWORK_ERRORS, retry_if=server_error, **kwargs)
+    if method.upper() == 'GET' and r.ok:
+        replay.record(url, r.text)
+    return r
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
@@ -0,0 +1,166 @@
+"""
+Urls not to scrape
+
+The skip list lives in the url index's SQLite database (see urlindex.py), with a reason code and timestamps for each
+url. It's loaded once per run, straight into the index's run-local keys, so skipped urls are filtered by the same
+`key in already_scraped` check as the ones already scraped. New skips are buffered and written in batches.
+
+A skip is either permanent (a dead page, a redirect away from the article, content we never want) or temporary (an
+error that might go away). Temporary skips are left out of the load once their retry time comes, so the url gets
+another go, with the wait doubling on each failure. After MAX_ATTEMPTS the skip becomes permanent.
+
+The old skips.txt files (one url per line) are still read: their urls are imported as permanent LEGACY skips whenever
+the file has changed since the last import.
+
+    skips = SkipStore(already_scraped, legacy=f'../data/{PUBLISHER}/skips.txt', logger=get_logger())
+    skips.load()
+    ...
+    skips.add(url, REDIRECTED)
+"""
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+# Permanent reasons
+LEGACY = 'legacy'
+BROKEN = 'broken'
+REDIRECTED = 'redirected'
+EXCLUDED = 'excluded'
+PERMANENT = (LEGACY, BROKEN, REDIRECTED, EXCLUDED)
+
+# Temporary reasons
+ERROR = 'error'
+MISSING = 'missing'
+
+# The wait before the first retry of a temporary skip, doubling on each failure after that
+RETRY_AFTER = timedelta(days=1)
+MAX_ATTEMPTS = 5
+
+# How many skips to buffer before writing them
+BUFFER_SIZE = 50
+
+
+class SkipStore:
+    """ This class keeps the urls to skip, with why, in the url index's database """
+
+    def __init__(self, index, legacy=None, logger=None):
+        """
+        :param index: The publisher's UrlIndex
+        :param legacy: The path of an old skips.txt file to import
+        :param logger: Logger object
+        """
+        self.index = index
+        self.legacy = legacy
+        self.logger = logger
+        self.buffer = []
+        # The pool's workers add skips too
+        self.lock = threading.Lock()
+
+        with self.index.lock:
+            self.index.db.execute("CREATE TABLE IF NOT EXISTS skips (publisher TEXT, key TEXT, url TEXT, reason TEXT, "
+                                  "attempts INTEGER, first_seen TEXT, last_seen TEXT, retry_at TEXT, "
+                                  "PRIMARY KEY (publisher, key)) WITHOUT ROWID")
+            self.index.db.commit()
+
+    def import_legacy(self):
+        """ Import the urls of the skips.txt file, if it's changed since the last import
+
+        :return: the number of urls imported
+        """
+        if self.legacy is None or not os.path.exists(self.legacy):
+            return 0
+        mtime = str(os.path.getmtime(self.legacy))
+        if self.index.cursor(self.legacy) == mtime:
+            return 0
+
+        with open(self.legacy, 'r') as skips_file:
+            urls = [line.strip() for line in skips_file if line.strip()]
+        seen = now()
+        self.write([(self.index.key(url), url, LEGACY, seen) for url in urls], replace=False)
+
+        with self.index.lock:
+            self.index.db.execute("INSERT OR REPLACE INTO cursors VALUES (?, ?, ?, ?)",
+                                  (self.index.publisher, self.legacy, mtime, now().isoformat()))
+            self.index.db.commit()
+        return len(urls)
+
+    def load(self):
+        """ Add the urls to skip to the index's keys for this run (skipping temporary ones that are due a retry)
+
+        :return: the number of urls to skip
+        """
+        imported = self.import_legacy()
+        with self.index.lock:
+            keys = [row[0] for row in self.index.db.execute(
+                "SELECT key FROM skips WHERE publisher = ? AND (retry_at IS NULL OR retry_at > ?)",
+                (self.index.publisher, now().isoformat()))]
+        self.index.update(keys)
+
+        if self.logger is not None:
+            self.logger.debug(f"Skipping {len(keys)} urls ({imported} imported from {self.legacy})")
+        return len(keys)
+
+    def add(self, url, reason):
+        """ Skip the url from now on (temporary reasons only until their retry time)
+
+        :param url: The url
+        :param reason: One of the reason codes
+        """
+        key = self.index.key(url)
+        self.index.add(key)
+        with self.lock:
+            self.buffer.append((key, url, reason, now()))
+            full = len(self.buffer) >= BUFFER_SIZE
+        if full:
+            self.flush()
+
+    def flush(self):
+        """ Write the buffered skips """
+        with self.lock:
+            buffer, self.buffer = self.buffer, []
+        self.write(buffer)
+
+    def write(self, buffer, replace=True):
+        """ Write skips to the store
+
+        :param buffer: A list of (key, url, reason, seen) tuples
+        :param replace: Update the skips already in the store (their reason, attempts and retry time). Otherwise
+            they're left as they are
+        """
+        if len(buffer) == 0:
+            return
+
+        with self.index.lock:
+            for key, url, reason, seen in buffer:
+                row = self.index.db.execute("SELECT attempts, first_seen FROM skips WHERE publisher = ? AND key = ?",
+                                            (self.index.publisher, key)).fetchone()
+                if row is not None and not replace:
+                    continue
+                attempts, first_seen = (row[0] + 1, row[1]) if row is not None else (1, seen.isoformat())
+                self.index.db.execute("INSERT OR REPLACE INTO skips VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                      (self.index.publisher, key, url, reason, attempts, first_seen, seen.isoformat(),
+                                       retry_at(reason, attempts, seen)))
+            self.index.db.commit()
+
+    def reason(self, url):
+        """ :return: the reason the url is skipped, or None """
+        with self.index.lock:
+            row = self.index.db.execute("SELECT reason FROM skips WHERE publisher = ? AND key = ?",
+                                        (self.index.publisher, self.index.key(url))).fetchone()
+        return None if row is None else row[0]
+
+    def __len__(self):
+        with self.index.lock:
+            return self.index.db.execute("SELECT COUNT(*) FROM skips WHERE publisher = ?",
+                                         (self.index.publisher,)).fetchone()[0]
+
+
+def now():
+    return datetime.now(timezone.utc)
+
+
+def retry_at(reason, attempts, seen):
+    """ :return: when a skip should be retried, as an ISO timestamp, or None if it shouldn't be """
+    if reason in PERMANENT or attempts >= MAX_ATTEMPTS:
+        return None
+    return (seen + RETRY_AFTER * 2 ** (attempts - 1)).isoformat()
@@ -0,0 +1,176 @@
+"""
+Local index of the urls already scraped
+
+Rather than downloading every url a publisher has ever had from the REST API at the start of each run, the urls are
+kept in a local SQLite database, and each run only asks the API for the rows added since the last sync:
+
+    GET {REST_API_URL}/articleUrlsByPublisher?publisher=...&since=<cursor>
+
+The cursor is the newest createdAt (or updatedAt) in the rows we got back, or if the rows don't carry a timestamp, the
+time the sync started, less a day of overlap. Rows we already have are ignored, so an API that doesn't support
+`since` yet (and sends everything) still works, it's just not any cheaper.
+
+Lookups are answered from a FingerprintSet of the keys (see dedup.py, 8 bytes a url), and only a hit is confirmed
+against the database, so a fingerprint collision can't make us skip an article. The index behaves like the
+`already_scraped` set the scrapers used to build:
+
+* `key in index` checks both the database and this run's additions
+* `add`/`update` only remember keys for the rest of this run (e.g. duplicates within a page, or skipped urls)
+* `record` saves a url we've just posted, so it's known even before the next sync
+
+While replaying (see replay.py) the index is a scratch copy of the one the record run had after syncing, and `sync`
+doesn't ask the API for anything.
+"""
+import sqlite3
+import threading
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+
+from dogbeach import replay
+from dogbeach import retrypolicy
+from dogbeach.dedup import FingerprintSet
+from dogbeach.urls import dedup_key
+
+# The timestamp fields of an API row that the sync cursor can come from, in order of preference
+CURSOR_FIELDS = ('createdAt', 'created_at', 'updatedAt', 'updated_at')
+
+# How far back the cursor goes when it has to come from our own clock rather than the rows
+CLOCK_OVERLAP = timedelta(days=1)
+
+# The name of the index's snapshot in the recorded fixtures
+SNAPSHOT = 'url_index.sqlite'
+
+
+class UrlIndex:
+    """ This class keeps the dedup keys of a publisher's scraped urls in SQLite """
+
+    def __init__(self, path, publisher, key=None, logger=None):
+        """
+        :param path: The SQLite database file (shared by every publisher)
+        :param publisher: The namespace for this publisher's urls
+        :param key: A function turning a url into its dedup key (the url itself by default)
+        :param logger: Logger object
+        """
+        self.path = Path(path)
+        self.publisher = publisher
+        self.key = (lambda url: url) if key is None else key
+        self.logger = logger
+        self.local = set()
+        self.fingerprints = None
+        self.lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS urls (publisher TEXT, key TEXT, url TEXT, "
+                        "PRIMARY KEY (publisher, key)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS cursors (publisher TEXT, endpoint TEXT, cursor TEXT, "
+                        "synced_at TEXT, PRIMARY KEY (publisher, endpoint))")
+        self.db.commit()
+
+    def cursor(self, endpoint):
+        """ :return: the cursor from the last sync of the endpoint, or None if it's never been synced """
+        with self.lock:
+            row = self.db.execute("SELECT cursor FROM cursors WHERE publisher = ? AND endpoint = ?",
+                                  (self.publisher, endpoint)).fetchone()
+        return None if row is None else row[0]
+
+    def sync(self, endpoint):
+        """ Fetch the urls added since the last sync of the endpoint
+
+        :param endpoint: The articleUrlsByPublisher url for the publisher (or one of its channels)
+        :return: the number of new urls
+        """
+        if replay.replaying():
+            # The index was restored from the recording, as it was after this sync (see open_url_index)
+            return 0
+
+        cursor = self.cursor(endpoint)
+        started = datetime.now(timezone.utc)
+        url = endpoint if cursor is None else endpoint + ('&' if '?' in endpoint else '?') + urlencode({'since': cursor})
+
+        r = retrypolicy.get(url)
+        r.raise_for_status()
+        rows = r.json()
+
+        before = len(self)
+        self.insert([row['url'] for row in rows])
+        added = len(self) - before
+
+        stamps = [str(stamp) for stamp in (next((row[f] for f in CURSOR_FIELDS if row.get(f)), None) for row in rows)
+                  if stamp is not None]
+        cursor = max(stamps) if stamps else (started - CLOCK_OVERLAP).isoformat()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO cursors VALUES (?, ?, ?, ?)",
+                            (self.publisher, endpoint, cursor, started.isoformat()))
+            self.db.commit()
+            replay.snapshot(self.db, SNAPSHOT, self.publisher)
+
+        if self.logger is not None:
+            self.logger.debug("Synced {}: {} rows, {} new, {} urls in the index".format(url, len(rows), added, len(self)))
+        return added
+
+    def insert(self, urls):
+        """ Save urls to the index """
+        rows = [(self.publisher, self.key(url), url) for url in urls]
+        with self.lock:
+            self.db.executemany("INSERT OR IGNORE INTO urls VALUES (?, ?, ?)", rows)
+            self.db.commit()
+            if self.fingerprints is not None:
+                self.fingerprints.update(key for _, key, _ in rows)
+
+    def record(self, url):
+        """ Save a url we've just scraped and posted, so it's in the index before the next sync """
+        self.insert([url])
+
+    def add(self, key):
+        """ Remember a key for the rest of this run only """
+        self.local.add(key)
+
+    def update(self, keys):
+        """ Remember keys for the rest of this run only """
+        self.local.update(keys)
+
+    def __contains__(self, key):
+        if key in self.local:
+            return True
+        # The pool's workers and the write-behind thread look keys up while others are inserted, so the fingerprints
+        # are built and read under the lock
+        with self.lock:
+            if self.fingerprints is None:
+                self.fingerprints = FingerprintSet(row[0] for row in self.db.execute(
+                    "SELECT key FROM urls WHERE publisher = ?", (self.publisher,)))
+            if key not in self.fingerprints:
+                return False
+            return self.db.execute("SELECT 1 FROM urls WHERE publisher = ? AND key = ?",
+                                   (self.publisher, key)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM urls WHERE publisher = ?", (self.publisher,)).fetchone()[0]
+
+    def keys(self):
+        """ :return: a generator of every key in the database for the publisher """
+        with self.lock:
+            rows = self.db.execute("SELECT key FROM urls WHERE publisher = ?", (self.publisher,)).fetchall()
+        return (row[0] for row in rows)
+
+    def close(self):
+        self.db.close()
+
+
+def open_url_index(config, publisher, key=None, logger=None):
+    """ Open the url index, from the 'url_index' settings in the 'common' section of the config (or a scratch copy of
+    the recorded one, while replaying)
+
+    :param config: The loaded config.yml
+    :param publisher: The publisher's namespace in the index
+    :param key: A function turning a url into its dedup key (by default dedup_key with the publisher's rules)
+    :param logger: Logger object
+    :return: a UrlIndex object
+    """
+    settings = config['common'].get('url_index', {}) if 'common' in config else {}
+    key = (lambda url: dedup_key(url, publisher)) if key is None else key
+    path = replay.restore(SNAPSHOT) if replay.replaying() else settings.get('path', '../data/url_index.sqlite')
+    return UrlIndex(path, publisher, key, logger)
@@ -0,0 +1,106 @@
+"""
+Url canonicalisation
+
+The same article turns up under several urls: http or https, with or without 'www.', with or without a trailing
+slash, with utm_* and other tracking parameters tacked on, and with WordPress' html-escaped '&#038;' left in. Every
+dedup check and every url written to the API goes through here, so they all agree on one form:
+
+    canonicalize(url, PUBLISHER)    # the url to store
+    dedup_key(url, PUBLISHER)       # what to look up in the url index
+
+Each publisher's rules are compiled once, in RULES:
+
+* host: the site's canonical host. The bare domain and the 'www.' one are both mapped to it, and relative urls get it
+* trailing_slash: True to add one, False to remove it, None to leave the url the way the site links it
+* slug: dedup on the last segment of the path rather than the whole url (The Inertia and Stab move articles between
+  sections, but keep the slug)
+
+Anything not in RULES gets the defaults: https, a lowercase host, no fragment and no tracking parameters.
+"""
+import re
+from functools import lru_cache
+from urllib.parse import urlsplit, urlunsplit
+
+# Query parameters that only track where a click came from
+TRACKING_PARAMS = re.compile(r'^(?:utm_\w*|fbclid|gclid|dclid|msclkid|mc_cid|mc_eid|_ga|_gl|igshid|ref_src)$', re.I)
+
+
+class Rules:
+    """ How to canonicalize one publisher's urls """
+
+    def __init__(self, host=None, trailing_slash=None, slug=False, tracking=TRACKING_PARAMS):
+        """
+        :param host: The canonical host
+        :param trailing_slash: True to add a trailing slash, False to remove it, None to leave it
+        :param slug: Dedup on the last segment of the path
+        :param tracking: A compiled regex matching the names of the query parameters to drop
+        """
+        self.host = host
+        self.aliases = set() if host is None else {host, host[4:] if host.startswith('www.') else 'www.' + host}
+        self.trailing_slash = trailing_slash
+        self.slug = slug
+        self.tracking = tracking
+
+    def canonicalize(self, url):
+        """ :return: the canonical form of the url """
+        scheme, host, path, query, _ = urlsplit(url.strip().replace('#038;', ''))
+
+        scheme = 'https' if scheme in ('', 'http', 'https') else scheme.lower()
+        host = host.lower()
+        if host.endswith(':80') or host.endswith(':443'):
+            host = host.rsplit(':', 1)[0]
+        if host == '' or host in self.aliases:
+            host = self.host or host
+
+        if self.trailing_slash is False and path != '/':
+            path = path.rstrip('/')
+        elif self.trailing_slash and not path.endswith('/') and '.' not in path.rsplit('/', 1)[-1]:
+            path += '/'
+
+        if query:
+            query = '&'.join(p for p in query.split('&') if p and not self.tracking.match(p.split('=', 1)[0]))
+
+        return urlunsplit((scheme, host, path, query, ''))
+
+    def dedup_key(self, url):
+        """ :return: the key to dedup the url on """
+        scheme, host, path, query, _ = urlsplit(self.canonicalize(url))
+        path = path.rstrip('/')
+        if self.slug:
+            return path.rsplit('/', 1)[-1]
+        return urlunsplit((scheme, host, path, query, ''))
+
+
+DEFAULT_RULES = Rules()
+
+RULES = {
+    'theinertia': Rules(host='www.theinertia.com', trailing_slash=False, slug=True),
+    'stabmag': Rules(host='stabmag.com', trailing_slash=False, slug=True),
+    'surfer.com': Rules(host='www.surfer.com', trailing_slash=False),
+    'surfd.com': Rules(host='surfd.com'),
+    'surfline.com': Rules(host='www.surfline.com'),
+    'magicseaweed.com': Rules(host='magicseaweed.com'),
+    'youtube': Rules(host='www.youtube.com'),
+}
+
+
+def rules(publisher=None):
+    """ :return: the publisher's Rules (or the defaults) """
+    return RULES.get(publisher, DEFAULT_RULES)
+
+
+@lru_cache(maxsize=65536)
+def canonicalize(url, publisher=None):
+    """ Put a url in its canonical form
+
+    :param url: The url, as found on the page or in a feed
+    :param publisher: The publisher's key, to use its rules
+    :return: the canonical url
+    """
+    return rules(publisher).canonicalize(url)
+
+
+@lru_cache(maxsize=65536)
+def dedup_key(url, publisher=None):
+    """ :return: the key to look the url up by in the url index """
+    return rules(publisher).dedup_key(url)
@@ -0,0 +1,168 @@
+"""
+Listing watermarks
+
+Listings are newest first, so once a page reaches the articles that were at the top of the listing last time, there's
+nothing new further down. Each of a publisher's listings (a category, a channel's playlist...) gets a high-water mark:
+the keys of the newest articles we'd scraped last run and the newest publish date, kept in the url index's database
+next to the urls themselves.
+
+A page crosses the watermark when it has one of the marked articles, or anything published on or before the marked
+date, and discovery stops after that page (or after `overlap` more pages, if the config asks for some slack). A
+listing without a watermark yet, or one whose marked articles have all vanished, falls back to the scraper's own
+empty page count.
+
+    watermarks = open_watermarks(config, already_scraped, get_logger())
+    while ...:
+        ...
+        if watermarks.stop(category, [card['url'] for card in cards]):
+            break
+    watermarks.save()
+
+The new marks are only saved at the end of the run, and only with articles that were posted (that are in the url
+index's urls table, not just remembered for the run). A listing's mark doesn't move at all if anything found above the
+old mark this run is neither posted nor permanently skipped: the old mark stays, so the next run walks down to the
+article that failed again.
+"""
+import json
+from datetime import datetime, timezone
+
+# How many of the newest articles make up a mark, in case the newest one is taken down
+KEEP = 5
+
+# How many keys to look up in the database at once
+CHUNK = 500
+
+
+class Watermarks:
+    """ This class keeps the high-water mark of each of a publisher's listings """
+
+    def __init__(self, index, overlap=0, logger=None):
+        """
+        :param index: The publisher's UrlIndex
+        :param overlap: How many pages past the watermark to keep going
+        :param logger: Logger object
+        """
+        self.index = index
+        self.overlap = overlap
+        self.logger = logger
+        self.marks = {}
+        self.newest = {}
+        self.past = {}
+        self.fresh = {}
+
+        with self.index.lock:
+            self.index.db.execute("CREATE TABLE IF NOT EXISTS watermarks (publisher TEXT, listing TEXT, keys TEXT, "
+                                  "newest TEXT, updated_at TEXT, PRIMARY KEY (publisher, listing))")
+            self.index.db.commit()
+            rows = self.index.db.execute("SELECT listing, keys, newest FROM watermarks WHERE publisher = ?",
+                                         (self.index.publisher,)).fetchall()
+        self.marks = {listing: (set(json.loads(keys)), newest) for listing, keys, newest in rows}
+
+    def observe(self, listing, keys, dates):
+        """ Keep the first KEEP keys and the newest date seen in the listing this run, for the next mark """
+        candidates, newest = self.newest.get(listing, ([], None))
+        candidates += [k for k in keys if k not in candidates][:KEEP - len(candidates)]
+        dates = [str(d) for d in dates if d]
+        if len(dates) > 0:
+            newest = max(dates + ([newest] if newest else []))
+        self.newest[listing] = (candidates, newest)
+
+    def crossed(self, listing, keys, dates=()):
+        """ :return: True if the page reaches what was at the top of the listing last run """
+        if listing not in self.marks:
+            return False
+        marked, newest = self.marks[listing]
+        if any(k in marked for k in keys):
+            return True
+        dates = [str(d) for d in dates if d]
+        return newest is not None and len(dates) > 0 and min(dates) <= newest
+
+    def above(self, listing, keys, dates):
+        """ :return: the keys on a page that are above the listing's mark (all of them, if it hasn't got one) """
+        if listing in self.past:
+            return []
+        if listing not in self.marks:
+            return list(keys)
+        marked, newest = self.marks[listing]
+        dates = [str(d) if d else None for d in dates] if len(dates) == len(keys) else [None] * len(keys)
+        above = []
+        for key, date in zip(keys, dates):
+            if key in marked or (newest is not None and date is not None and date <= newest):
+                break
+            above.append(key)
+        return above
+
+    def stop(self, listing, urls, dates=()):
+        """ Check a listing page against the watermark
+
+        :param listing: The name of the listing (the category, the channel...)
+        :param urls: The urls of every article on the page, scraped or not, in listing order
+        :param dates: Their publish dates, if the listing has them (ISO strings or datetimes)
+        :return: True if discovery should stop after this page
+        """
+        keys = [self.index.key(url) for url in urls]
+        posted = self.posted(keys)
+        self.fresh.setdefault(listing, []).extend(k for k in self.above(listing, keys, dates) if k not in posted)
+        self.observe(listing, keys, dates)
+        if listing in self.past or self.crossed(listing, keys, dates):
+            self.past[listing] = self.past.get(listing, -1) + 1
+            if self.past[listing] >= self.overlap:
+                if self.logger is not None:
+                    self.logger.info(f"Reached the watermark for {listing}")
+                return True
+        return False
+
+    def select(self, query, keys):
+        """ :return: the set of keys the query (which ends with "key IN") finds, looking them up in chunks """
+        keys, found = list(keys), set()
+        with self.index.lock:
+            for i in range(0, len(keys), CHUNK):
+                chunk = keys[i:i + CHUNK]
+                found.update(row[0] for row in self.index.db.execute(
+                    f"{query} ({','.join('?' * len(chunk))})", [self.index.publisher] + chunk))
+        return found
+
+    def posted(self, keys):
+        """ :return: the keys that are in the url index's urls table """
+        return self.select("SELECT key FROM urls WHERE publisher = ? AND key IN", keys)
+
+    def skipped(self, keys):
+        """ :return: the keys that are skipped for good (see skips.py) """
+        with self.index.lock:
+            if self.index.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'skips'").fetchone() is None:
+                return set()
+        return self.select("SELECT key FROM skips WHERE publisher = ? AND retry_at IS NULL AND key IN", keys)
+
+    def save(self):
+        """ Save the newest articles seen in each listing as its new mark, leaving out any that weren't posted. A
+        listing keeps its old mark if an article found above it didn't make it """
+        updated = datetime.now(timezone.utc).isoformat()
+        rows = []
+        for listing, (candidates, newest) in self.newest.items():
+            fresh = self.fresh.get(listing, [])
+            failed = set(fresh) - self.posted(fresh) - self.skipped(fresh)
+            if len(failed) > 0:
+                if self.logger is not None:
+                    self.logger.info(f"Keeping the old watermark for {listing}, {len(failed)} articles above it "
+                                     f"weren't posted")
+                continue
+            posted = self.posted(candidates)
+            keys = [k for k in candidates if k in posted]
+            if len(keys) > 0:
+                rows.append((self.index.publisher, listing, json.dumps(keys), newest, updated))
+
+        with self.index.lock:
+            self.index.db.executemany("INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?, ?)", rows)
+            self.index.db.commit()
+
+
+def open_watermarks(config, index, logger=None):
+    """ Open the publisher's watermarks, with the 'watermark' settings in the 'common' section of the config
+
+    :param config: The loaded config.yml
+    :param index: The publisher's UrlIndex
+    :param logger: Logger object
+    :return: a Watermarks object
+    """
+    settings = config['common'].get('watermark', {}) if 'common' in config else {}
+    return Watermarks(index, settings.get('overlap_pages', 0), logger)
@@ -0,0 +1,103 @@
+"""
+Write-behind queue
+
+Scraped articles are put on a bounded queue, and a sender thread posts them to the API in batches while the scraper
+gets on with loading the next pages, so the browser time overlaps the API's latency instead of adding to it. The
+queue being bounded means a slow API holds the scraper back rather than letting articles pile up in memory.
+
+There's one sender thread, so the articles are posted in the order they were put on the queue (the scrapers rely on
+this to post oldest first). Call `flush` to wait for everything queued to be posted, and `close` from the scraper's
+atexit hook, so whatever is left in the queue still goes out when the scraper stops. The queue is only in memory,
+and articles reach the outbox (see outbox.py) when they're sent, so the ones still queued when the process dies are
+scraped again next run. The batch and queue sizes come from the 'rest_api' section of the config:
+
+    rest_api:
+        batch_size: 20
+        queue_size: 100
+
+    writer = open_writer(config, create_articles, get_logger())
+    for article in articles:
+        writer.put(article)
+    writer.flush()
+"""
+import queue
+import threading
+
+# Put on the queue to stop the sender thread
+_STOP = object()
+
+
+class WriteBehind:
+    """ This class posts items on a background thread """
+
+    def __init__(self, send, batch_size=20, maxsize=100, logger=None):
+        """
+        :param send: The function that posts a list of items (called on the sender thread)
+        :param batch_size: The most items to hand to `send` at once
+        :param maxsize: How many items can wait in the queue before `put` blocks
+        :param logger: Logger object
+        """
+        self.send = send
+        self.batch_size = batch_size
+        self.logger = logger
+        self.queue = queue.Queue(maxsize)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='writebehind', daemon=True)
+                self.thread.start()
+
+    def put(self, item):
+        """ Queue an item to be posted, waiting for room if the queue is full """
+        self.start()
+        self.queue.put(item)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            items = [item for item in batch if item is not _STOP]
+            try:
+                if len(items) > 0:
+                    self.send(items)
+            except Exception:
+                if self.logger is not None:
+                    self.logger.error(f"Failed to send {len(items)} items", exc_info=True)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+            if batch[-1] is _STOP:
+                return
+
+    def flush(self):
+        """ Wait until everything queued so far has been posted """
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self):
+        """ Post whatever is left and stop the sender thread """
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+
+
+def open_writer(config, send, logger=None):
+    """ Create a write-behind queue with the 'rest_api' settings in the 'common' section of the config
+
+    :param config: The loaded config.yml
+    :param send: The function that posts a list of items
+    :param logger: Logger object
+    :return: a WriteBehind object
+    """
+    settings = config['common']['rest_api']
+    return WriteBehind(send, batch_size=settings.get('batch_size', 20), maxsize=settings.get('queue_size', 100),
+                       logger=logger)
@@ -0,0 +1,73 @@
+"""
+Run every publisher scraper at once
+
+Each scraper only waits on its own site's rate limit, so there's no reason to run them one after another - running
+them side by side means a full pass takes about as long as the slowest site rather than the sum of all of them.
+
+Usage: python scrape_all.py [publisher ...]
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+from pathlib import Path
+
+# Import Doglog
+os.chdir(os.path.dirname(os.path.realpath(sys.argv[0])))
+sys.path.append('..')
+from dogbeach import doglog
+
+# The scraper script for each publisher
+SCRAPERS = {
+    'magicseaweed': 'scrape_magicseaweed.py',
+    'surfer.com': 'scrape_surfer.com.py',
+    'surfd.com': 'scrape_surfd.com.py',
+    'theinertia': 'scrape_theinertia.py',
+    'surfline': 'scrape_surfline.py',
+    'youtube': 'scrape_youtube.py',
+    'stabmag': 'scrape_stabmag.py',
+}
+
+_logger = None
+
+
+def get_logger():
+    """ Initialize and/or return existing logger object
+
+    :return: a DogLog logger object
+    """
+    global _logger
+    if _logger is None:
+        logfile = Path(os.path.dirname(os.path.realpath(__file__))) / "../log/scrape_all.log"
+        _logger = doglog.setup_logger('scrape_all', logfile, clevel=logging.INFO, flevel=logging.INFO)
+    return _logger
+
+
+async def run_scraper(name, script):
+    """ Run a single scraper as its own process, with its output appended to the same log file cron would use
+
+    :return: the exit code of the scraper
+    """
+    scrapers_dir = Path(os.path.dirname(os.path.realpath(__file__)))
+    started = time.time()
+    with open(scrapers_dir / f"../log/{name}.cron.log", "a") as output:
+        proc = await asyncio.create_subprocess_exec(sys.executable, str(scrapers_dir / script),
+                                                    stdout=output, stderr=output)
+        code = await proc.wait()
+
+    get_logger().info(f"{name} finished with exit code {code} after {time.time() - started:.0f} seconds")
+    return code
+
+
+async def run_all(names):
+    return await asyncio.gather(*[run_scraper(name, SCRAPERS[name]) for name in names])
+
+
+if __name__ == "__main__":
+    publishers = sys.argv[1:] if len(sys.argv) > 1 else list(SCRAPERS.keys())
+    get_logger().info(f"Running scrapers: {', '.join(publishers)}")
+
+    codes = asyncio.run(run_all(publishers))
+
+    sys.exit(max(codes))
@@ -3,15 +3,13 @@ import sys
 import json
 import yaml
 import pprint
+import asyncio
 import logging
-import requests
 
-from retry import retry
 from pathlib import Path
-from bs4 import BeautifulSoup
-from time import sleep, strftime
+from time import strftime
 from dateutil.parser import parse
-from playwright.sync_api import sync_playwright, Error, TimeoutError
+from playwright.async_api import async_playwright, Error
 
 # Config
 os.chdir(os.path.dirname(sys.argv[0]))
@@ -21,9 +19,21 @@ with open("../config.yml", "r") as ymlfile:
 # Import Doglog
 sys.path.append('..')
 from dogbeach import doglog
-from dogbeach.dogdriver import DogDriver
+from dogbeach import replay
+from dogbeach import retrypolicy
+from dogbeach import browserd
+from dogbeach.archive import open_archive
+from dogbeach.urlindex import open_url_index
+from dogbeach.urls import canonicalize, dedup_key
+from dogbeach.api import open_api
+from dogbeach.watermark import open_watermarks
+from dogbeach import parse as htmlparse
+from dogbeach.engine import TokenBucket, rate_limits
+from dogbeach.pagepool import PagePool
 
 _logger = None
+_api = None
+_bucket = None
 
 PUBLISHER = 'magicseaweed.com'
 BASE_URL = config[PUBLISHER]['base_url']
@@ -48,6 +58,21 @@ NEW_ONLY = config[PUBLISHER]['new_only']
 # Maximum number of empty pages to load before quitting
 MAX_EMPTY_PAGES = config[PUBLISHER]['max_empty_pages']
 
+# Attach to the shared browser service when it's running, rather than starting our own browser
+BROWSER_SERVICE = browserd.address(config)
+
+# How many article pages should we load at once?
+CONCURRENCY = config[PUBLISHER]['concurrency'] if 'concurrency' in config[PUBLISHER] else 1
+
+# The host we're scraping, which is what the rate limit applies to
+HOST = config[PUBLISHER]['host'] if 'host' in config[PUBLISHER] else 'magicseaweed.com'
+
+# Keep the raw pages, so they can be re-parsed without re-crawling (None when archiving is turned off)
+ARCHIVE = open_archive(config, PUBLISHER)
+
+# Parse pages with the parser backend set in config.yml (see dogbeach/parse.py)
+htmlparse.configure(config)
+
 # User Agent to use for the requests
 AGENT = config['common']['agent']
 
@@ -56,6 +81,9 @@ AGENT = config['common']['agent']
 # A list of all the articles that have been scraped already, so we don't duplicate our efforts
 already_scraped = set()
 
+# The newest articles in each listing last run, to stop paging once we reach them
+watermarks = None
+
 ##################################### Logging
 def get_logger():
     """ Initialize and/or return existing logger object
@@ -68,6 +96,16 @@ def get_logger():
         _logger = doglog.setup_logger(f'{PUBLISHER}_site', logfile, clevel=logging.DEBUG)
     return _logger
 
+def get_bucket():
+    """ Initialize and/or return existing token bucket that keeps page loads within the site's rate limit
+
+    :return: a TokenBucket object
+    """
+    global _bucket
+    if _bucket is None:
+        _bucket = TokenBucket(*rate_limits(config).get(HOST, (1, 1)))
+    return _bucket
+
 ##################################### Helper Functions
 
 def str_list(L: list) -> str:
@@ -77,171 +115,259 @@ def str_list(L: list) -> str:
         l = []
     return l
 
-def abort_or_continue(route, request):
+async def launch_browser(p):
+    """ Attach to the shared browser service when it's running (see dogbeach/browserd.py), otherwise start our own
+
+    :param p: the playwright object
+    :return: a playwright browser
+    """
+    if BROWSER_SERVICE:
+        get_logger().info(f"Attaching to the shared browser at {BROWSER_SERVICE}")
+        return await p.chromium.connect_over_cdp(browserd.endpoint(BROWSER_SERVICE))
+    return await p.chromium.launch(headless=True)
+
+async def abort_or_continue(route, request):
     if request.resource_type in ['document']:
-        route.continue_()
+        await route.continue_()
     else:
-        route.abort()
+        await route.abort()
 
-def load_already_scraped_articles():
-    """ Query the database for all articles that have already been scraped
+async def setup_page(page):
+    """ Only let the documents through on each of the pool's pages """
+    await page.route('**/*', abort_or_continue)
+    await replay.attach(page)
+
+def get_api():
+    """ Initialize and/or return the REST API client, which keeps its connections open for the whole run
 
-    :return: a list of urls of articles that have already been scraped
+    :return: an ApiClient object
     """
-    global already_scraped
+    global _api
+    if _api is None:
+        _api = open_api(config, get_logger())
+    return _api
 
-    r = requests.get(PUBLISHER_ARTICLES_ENDPOINT)
-    urls_json = r.json()
 
-    already_scraped = set([x['url'] for x in urls_json])
+def load_already_scraped_articles():
+    """ Bring the local index of the articles that have already been scraped up to date with the database
+    """
+    global already_scraped, watermarks
+
+    already_scraped = open_url_index(config, PUBLISHER, logger=get_logger())
+    already_scraped.sync(PUBLISHER_ARTICLES_ENDPOINT)
+    watermarks = open_watermarks(config, already_scraped, get_logger())
 
     get_logger().debug("Found {} articles already scraped".format(len(already_scraped)))
 
 
 ################################################################################ Scraping
 
-def create_article(article):
-    """
-    Push this article to the database through the REST API
+def create_articles(articles):
+    """ Push the articles to the database through the REST API, in batches
 
-    :param articles:
-    :return:
+    :param articles: A list of article dictionaries
+    :return: the ApiResult for each article, in order
     """
-    # Add some common fields
-    article['userId'] = SYSTEM_USER_ID
-    article['browserId'] = SCRAPER_BROWSER_ID
-    article['publisher'] = PUBLISHER
-    get_logger().debug("Writing article to RDS...\n{}".format(article))
-
-    header = { "Content-Type": "application/json" }
-    json_data = json.dumps(article, default=str)
-    r = requests.post(CREATE_ENDPOINT, headers=header, data=json_data)
-    get_logger().debug("\n\n=================================================================================\n\n")
-    
-    try:
-      r.raise_for_status()
-    except Exception as ex:
-      get_logger().error(f"There was a {type(ex)} error while creating article {article['url']}:...\n{r.json()}")
-
+    for article in articles:
+        article['url'] = canonicalize(article['url'], PUBLISHER)
+        get_logger().debug("Writing article to RDS...\n{}".format(article))
+
+    results = get_api().create(articles, PUBLISHER)
+    for result in results:
+        # Posted, or spooled in the outbox to be posted later, either way the page doesn't need loading again
+        if result.ok or result.spooled:
+            already_scraped.record(result.item['url'])
+        else:
+            get_logger().error(f"There was a {result.error} error while creating article {result.item['url']}")
+    return results
 
-@retry(Error, tries=6, delay=3, backoff=1.4, max_delay=30)
-def extract_article(page, url):
+async def extract_article(page, url):
     get_logger().info(url)
-    
-    global status
-    def set_status(status_code):
-        global status
-        status = status_code
-
-    page.on("response", lambda response: set_status(response.status))
-    page.goto(url)
-    if status == 200:
-        publish_date = page.text_content("time")  # Ex: 10th February 2021
-        publish_date = parse(publish_date).strftime('%Y-%m-%d')
-        
-        author_name = page.text_content(".media-body a")
-        author_url = f'{BASE_URL}{page.query_selector(".media-body a").get_attribute("href")}'
 
-        thumbnail = page.query_selector('meta[name="thumbnail"]').get_attribute("content")
-        if "_SQUARE" in thumbnail[-7:]:
-            thumbnail = thumbnail[:-7]
-        
-        if len(url.split("/"))>3:
-            post_category = url.split("/")[3]
-        else:
-            post_category = ""
-
-        title = page.title().replace(' - Magicseaweed', '')
-
-        html = page.query_selector(".editorial-content").inner_html()
-        soup = BeautifulSoup(html, "lxml")
-        [s.extract() for s in soup('small')]
-        content = ". ".join([p.get_text(strip=True) for p in soup.select("p") if len(p.get_text(strip=True)) > 0]).replace('..', '.') # or "\n".join(...)
-        # get_logger().info(content)
-
-        article_video = [v.find("iframe")["src"] for v in soup.select(".video") if v.find("iframe") is not None] # ["//www.youtube.com/embed/yCICYEGXdVg"]
-        article_video = [v if "/" not in v[0] else f"https:{v}" for v in article_video] # ["https://www.youtube.com/embed/yCICYEGXdVg"]
-        article_video = article_video
-
-        article_insta = [a["href"] for a in soup.select("a[href]") if "https://www.instagram.com/" in a["href"]] # ["https://www.instagram.com/......."]
-        article_insta = str_list(article_insta)
-
-        article_json = {
-            'url': url, 
-            'publishedAt': publish_date, 
-            'category': post_category,
-            'title': title, 
-            'thumb': thumbnail,
-            'article_insta': article_insta, 
-            'article_video': article_video, 
-            'author_name': author_name, 
-            'author_url': author_url,
-            'text_content': content,
-        }
-        get_logger().debug(pprint.pformat(article_json, sort_dicts=False, width=200))
-        return article_json
+    r = await page.goto(url)
+    if r is not None and r.status == 200:
+        raw_source = await page.content()
+        if ARCHIVE is not None:
+            ARCHIVE.put(url, raw_source)
+        return parse_article(url, raw_source)
     else:
-        get_logger().error(f"Error: {status} status retrieving page")
+        get_logger().error(f"Error: {None if r is None else r.status} status retrieving page")
         return None
 
 
-def scrape():
-    """ Main function driving the scraping process
+async def extract_url(page, url):
+    """ Extract the article at the url, retrying according to the retry policy
+
+    :return: the article dict, or None if it couldn't be extracted
     """
-    with sync_playwright() as p:
+    try:
+        return await retrypolicy.get_policy().acall(url, extract_article, page, url, retry_on=(Error,))
+    except (Error, retrypolicy.CircuitOpenError, retrypolicy.RetryBudgetExhausted):
+        get_logger().error(f"Failed to extract: {url}", exc_info=True)
+        return None
+
+
+async def get_last_page_num(page, page_url):
+    """ :return: the number of the last listing page, from the "Last" link on the first one """
+    await page.goto(page_url)
+    last_link = await page.query_selector("text=/.*Last.*/")
+    return int((await last_link.get_attribute("href")).split("/")[-2])
+
+
+async def get_listing(page, page_url):
+    """ :return: the urls of the articles on a listing page """
+    await page.goto(page_url)
+
+    loadmore_group = await page.query_selector(".msw-js-loadmore-group")
+    loadmore_links = await loadmore_group.query_selector_all("a.editorial-item, a.msw-js-live-content")
+    hrefs = [await a.get_attribute("href") for a in loadmore_links]
+    return [f'{BASE_URL}{href}' for href in hrefs if "http://" not in href and "www." not in href]
+
+
+def parse_article(url, raw_source):
+    """ Extract the article's data from its page source. This doesn't need the browser, so it can be run over
+    archived pages as well
+
+    :param url: the url of the article
+    :param raw_source: the page source
+    :return: a dict containing all the data extracted from the page
+    """
+    page_soup = htmlparse.soup(doglog.clean_unicode(raw_source))
+
+    publish_date = page_soup.select_one("time").get_text()  # Ex: 10th February 2021
+    publish_date = parse(publish_date).strftime('%Y-%m-%d')
+    
+    author_name = page_soup.select_one(".media-body a").get_text()
+    author_url = f'{BASE_URL}{page_soup.select_one(".media-body a").get("href")}'
+
+    thumbnail = page_soup.select_one('meta[name="thumbnail"]').get("content")
+    if "_SQUARE" in thumbnail[-7:]:
+        thumbnail = thumbnail[:-7]
+    
+    if len(url.split("/"))>3:
+        post_category = url.split("/")[3]
+    else:
+        post_category = ""
+
+    title = page_soup.title.get_text().replace(' - Magicseaweed', '')
+
+    soup = page_soup.select_one(".editorial-content")
+    [s.extract() for s in soup('small')]
+    content = ". ".join([p.get_text(strip=True) for p in soup.select("p") if len(p.get_text(strip=True)) > 0]).replace('..', '.') # or "\n".join(...)
+    # get_logger().info(content)
+
+    article_video = [v.find("iframe")["src"] for v in soup.select(".video") if v.find("iframe") is not None] # ["//www.youtube.com/embed/yCICYEGXdVg"]
+    article_video = [v if "/" not in v[0] else f"https:{v}" for v in article_video] # ["https://www.youtube.com/embed/yCICYEGXdVg"]
+    article_video = article_video
+
+    article_insta = [a["href"] for a in soup.select("a[href]") if "https://www.instagram.com/" in a["href"]] # ["https://www.instagram.com/......."]
+    article_insta = str_list(article_insta)
+
+    article_json = {
+        'url': url, 
+        'publishedAt': publish_date, 
+        'category': post_category,
+        'title': title, 
+        'thumb': thumbnail,
+        'article_insta': article_insta, 
+        'article_video': article_video, 
+        'author_name': author_name, 
+        'author_url': author_url,
+        'text_content': content,
+    }
+    get_logger().debug(pprint.pformat(article_json, sort_dicts=False, width=200))
+    return article_json
+
+async def scrape():
+    """ Main function driving the scraping process. The articles from each listing page are extracted on a pool of
+    pages at once
+    """
+    async with async_playwright() as p:
         get_logger().info(f"Start time: {strftime('%H:%M:%S')}\n")
         
-        browser = p.chromium.launch(headless=True)
-        context = browser.new_context(user_agent=AGENT)
-        page = context.new_page()
-        page.route('**/*', lambda route, request: abort_or_continue(route, request))
+        browser = await launch_browser(p)
+        context = await browser.new_context(user_agent=AGENT)
+        pool = PagePool(context, CONCURRENCY, setup=setup_page, bucket=get_bucket(), logger=get_logger())
+        await pool.start()
+
+        try:
+            last_page_num = await pool.run(get_last_page_num, f"{BASE_URL}/news/features/?page=0")
+
+            empty_page_count = 0
+            for page_n in range(1, last_page_num + 1):
+                get_logger().info(f"\npage: {page_n} of {last_page_num}\n")
+
+                # The first page of results is the ?page=0 one
+                page_url = f"https://magicseaweed.com/news/features/?page={page_n if page_n > 1 else 0}"
+                page_urls = await pool.run(get_listing, page_url) or []
+                urls = [url for url in page_urls if dedup_key(url, PUBLISHER) not in already_scraped]
+
+                # Stop after this page if it reaches the articles that were newest last run
+                reached = NEW_ONLY and watermarks.stop('features', page_urls)
+                if len(urls) > 1:
+                    url_list = "\n".join(urls)
+                    get_logger().info(f"{len(urls)} new URLs to scrape:\n{url_list}")
+                    empty_page_count = 0
+                else:
+                    empty_page_count += 1
 
-        page_url = f"{BASE_URL}/news/features/?page=0"
-        page.goto(page_url)
-        
-        last_page_num = int(page.query_selector("text=/.*Last.*/").get_attribute("href").split("/")[-2])
-        
-        empty_page_count = 0
-        for page_n in range(1, last_page_num + 1):
-            get_logger().info(f"\npage: {page_n} of {last_page_num}\n")
-
-            if page_n > 1:
-                page_url = f"https://magicseaweed.com/news/features/?page={page_n}"
-                page.goto(page_url)
-
-            loadmore_group = page.query_selector(".msw-js-loadmore-group")
-            loadmore_links = loadmore_group.query_selector_all("a.editorial-item, a.msw-js-live-content")
-            urls = [f'{BASE_URL}{a.get_attribute("href")}' for a in loadmore_links if "http://" not in a.get_attribute("href") and "www." not in a.get_attribute("href")]
-            urls = [url for url in urls if url not in already_scraped]
-            if len(urls) > 1:
-                url_list = "\n".join(urls)
-                get_logger().info(f"{len(urls)} new URLs to scrape:\n{url_list}")
-                empty_page_count = 0
-            else:
-                empty_page_count += 1
-
-                if empty_page_count == MAX_EMPTY_PAGES and NEW_ONLY:
-                    get_logger().info("Max number of empty pages reached, quitting...")
+                    if reached:
+                        break
+                    elif empty_page_count == MAX_EMPTY_PAGES and NEW_ONLY:
+                        get_logger().info("Max number of empty pages reached, quitting...")
+                        break
+                    else:
+                        continue
+
+                articles = [article for article in await pool.map(extract_url, urls) if article is not None]
+                create_articles(articles)
+
+                if reached:
                     break
-                else:
-                    continue
 
-            for url in urls:
-                article = extract_article(page, url)
-                if article is None:
-                    continue
-                create_article(article)
-                sleep(3)
+            watermarks.save()
+        finally:
+            get_logger().info(f"End Time: {strftime('%H:%M:%S')}\n")
+            await pool.close()
+            await context.close()
+            await browser.close()
 
-        get_logger().info(f"End Time: {strftime('%H:%M:%S')}\n")
-        browser.close()
+
+def reparse_archive(outfile):
+    """ Re-run the article parser over every archived article page, without fetching anything
+
+    :param outfile: The jsonl file to write the extracted articles to
+    """
+    if ARCHIVE is None:
+        get_logger().error("The page archive isn't enabled in config.yml")
+        return
+
+    count = 0
+    with open(outfile, 'w') as out:
+        for url, source in ARCHIVE.pages():
+            article = parse_article(url, source)
+            if article:
+                out.write(json.dumps(article, default=str) + "\n")
+                count += 1
+    get_logger().info(f"Re-extracted {count} articles from the archive into {outfile}")
 
 
 if __name__ == '__main__':
+    # Re-extract the archived pages instead of scraping: python scrape_magicseaweed.py --reparse [outfile]
+    if len(sys.argv) > 1 and sys.argv[1] == '--reparse':
+        reparse_archive(sys.argv[2] if len(sys.argv) > 2 else f"../data/{PUBLISHER}_reparsed.jsonl")
+        exit()
+
+    # All fetch and API calls share one retry policy (backoff, retry budget and per-host circuit breakers)
+    retrypolicy.configure(config, get_logger())
+
+    # Record the site's responses, or replay them offline (see dogbeach/replay.py)
+    replay.configure(config, PUBLISHER, get_logger())
+
     # Query all the urls already scraped for this publisher
     load_already_scraped_articles()
 
     # Extract and save any new articles
-    scrape()
+    asyncio.run(scrape())
 
     get_logger().info("\nDone.")
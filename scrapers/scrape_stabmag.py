@@ -6,14 +6,11 @@ import time
 import yaml
 import atexit
 import logging
-import requests
-import numpy as np
 import pandas as pd
 import pprint
 pp = pprint.PrettyPrinter(indent=2, width=160)
 
 from pathlib import Path
-from bs4 import BeautifulSoup
 from datetime import datetime
 from selenium.webdriver.common.by import By
 
@@ -30,11 +27,27 @@ with open("../config.yml", "r") as ymlfile:
 # Import Doglog
 sys.path.append('..')
 from dogbeach import doglog
-from dogbeach.dogdriver import DogDriver
+from dogbeach import replay
+from dogbeach import retrypolicy
+from dogbeach import browserd
+from dogbeach.dogdriver import DogDriverPool, open_driver
+from dogbeach.engine import TokenBucket, rate_limits
+from dogbeach.archive import open_archive
+from dogbeach.urlindex import open_url_index
+from dogbeach.urls import canonicalize, dedup_key
+from dogbeach.api import open_api
+from dogbeach.watermark import open_watermarks
+from dogbeach.checkpoint import open_checkpoint
+from dogbeach import parse as htmlparse
+from dogbeach.text import strip_tags
 
 
 _logger = None
+_api = None
 _drivers = {}
+_pool = None
+_bucket = None
+_checkpoint = None
 
 PUBLISHER = 'stabmag'
 
@@ -71,6 +84,28 @@ RETRIES = config[PUBLISHER]['retries'] if 'retries' in config[PUBLISHER] else No
 # How long to wait before giving up on a page load
 PAGELOAD_TIMEOUT = config[PUBLISHER]['page_load_timeout'] if 'page_load_timeout' in config[PUBLISHER] else None
 
+# Which resources should the browser skip loading (see dogdriver.BLOCKING_PROFILES), and when is a page "loaded"?
+BLOCK_RESOURCES = config[PUBLISHER]['block_resources'] if 'block_resources' in config[PUBLISHER] else None
+PAGE_LOAD_STRATEGY = config[PUBLISHER]['page_load_strategy'] if 'page_load_strategy' in config[PUBLISHER] else None
+
+# Attach to the shared browser service when it's running, rather than starting our own browser (see dogbeach/browserd.py)
+BROWSER_SERVICE = browserd.address(config)
+
+# Every fetched page is kept here (when enabled) so the parser can be re-run without re-crawling
+ARCHIVE = open_archive(config, PUBLISHER)
+
+# Parse pages with the parser backend set in config.yml (see dogbeach/parse.py)
+htmlparse.configure(config)
+
+# Only the article container is parsed out of an article page
+ARTICLE_ROOT = htmlparse.only("article.container", "div.article")
+
+# How many article pages should we load at once?
+CONCURRENCY = config[PUBLISHER]['concurrency'] if 'concurrency' in config[PUBLISHER] else 1
+
+# The host we're scraping, which is what the rate limit applies to
+HOST = config[PUBLISHER]['host'] if 'host' in config[PUBLISHER] else 'stabmag.com'
+
 # How many pages of articles that we've already scraped fully should we try before quitting?
 MAX_SCRAPED_PAGES_BEFORE_QUIT = config[PUBLISHER]['max_empty_pages']
 
@@ -78,12 +113,19 @@ SITE = "https://stabmag.com"
 
 NEWS_URL = "https://stabmag.com/news/"
 
+# What "loaded" means for the news page and for an article page, so we don't sleep any longer than we need to
+NEWS_READY = '#blog-list'
+ARTICLE_READY = 'article.container, div.article'
+
 # We want all times to be in westcoast time
 WESTCOAST = pytz.timezone('US/Pacific')
 
 # Track the list of article urls that have already been scraped
 already_scraped = set()
 
+# The newest articles in each listing last run, to stop paging once we reach them
+watermarks = None
+
 def get_logger():
     """ Initialize and/or return existing logger object
 
@@ -103,7 +145,8 @@ def get_driver(name='default'):
     """
     global _drivers
     if name not in _drivers:
-        _drivers[name] = DogDriver(get_logger())
+        _drivers[name] = open_driver(get_logger(), block=BLOCK_RESOURCES, page_load_strategy=PAGE_LOAD_STRATEGY,
+                                     debugger_address=BROWSER_SERVICE, archive=ARCHIVE)
         if SLEEP:
             _drivers[name].sleep = SLEEP
         if RETRIES:
@@ -114,16 +157,70 @@ def get_driver(name='default'):
     return _drivers[name]
 
 
-def load_already_scraped_articles():
-    """ Query the database for all articles that have already been scraped
+def get_pool():
+    """ Initialize and/or return existing pool of webdriver objects used to load articles
 
-    :return: a list of urls of articles that have already been scraped
+    :return: a DogDriverPool object
     """
-    global already_scraped
+    global _pool
+    if _pool is None:
+        driver_kwargs = {'block': BLOCK_RESOURCES, 'page_load_strategy': PAGE_LOAD_STRATEGY,
+                         'debugger_address': BROWSER_SERVICE, 'archive': ARCHIVE}
+        if SLEEP:
+            driver_kwargs['sleep'] = SLEEP
+        if RETRIES:
+            driver_kwargs['tries'] = RETRIES
+        if PAGELOAD_TIMEOUT:
+            driver_kwargs['pageload_timeout'] = PAGELOAD_TIMEOUT
+        _pool = DogDriverPool(CONCURRENCY, get_logger(), bucket=get_bucket(), **driver_kwargs)
+
+    return _pool
+
+
+def get_bucket():
+    """ Initialize and/or return existing token bucket that keeps article loads within the site's rate limit
+
+    :return: a TokenBucket object
+    """
+    global _bucket
+    if _bucket is None:
+        _bucket = TokenBucket(*rate_limits(config).get(HOST, (1, 1)))
+    return _bucket
 
-    r = requests.get(PUBLISHER_ARTICLES_ENDPOINT)
-    urls_json = r.json()
-    already_scraped = set([x['url'].rstrip('/').split("/")[-1] for x in urls_json])
+
+def get_checkpoint():
+    """ Initialize and/or return the checkpoint of this run, which is resumed if the last run didn't finish
+
+    :return: a Checkpoint object
+    """
+    global _checkpoint
+    if _checkpoint is None:
+        _checkpoint = open_checkpoint(config, PUBLISHER, get_logger())
+    return _checkpoint
+
+
+def get_api():
+    """ Initialize and/or return the REST API client, which keeps its connections open for the whole run
+
+    :return: an ApiClient object
+    """
+    global _api
+    if _api is None:
+        _api = open_api(config, get_logger())
+    return _api
+
+
+def load_already_scraped_articles():
+    """ Bring the local index of the articles that have already been scraped up to date with the database
+    """
+    global already_scraped, watermarks
+
+    already_scraped = open_url_index(config, PUBLISHER, logger=get_logger())
+    already_scraped.sync(PUBLISHER_ARTICLES_ENDPOINT)
+    watermarks = open_watermarks(config, already_scraped, get_logger())
+
+    # The articles a crashed run already scraped are waiting in the checkpoint, don't load them again
+    already_scraped.update(dedup_key(url, PUBLISHER) for url in get_checkpoint().urls())
     get_logger().debug("Found {} articles already scraped".format(len(already_scraped)))
 
     return
@@ -171,33 +268,15 @@ def get_author(article_soup, content_div):
     return author_json
 
 
-def remove_html_markup(s):
-    """ https://stackoverflow.com/questions/753052/strip-html-from-strings-in-python """
-    tag = False
-    quote = False
-    out = ""
-
-    for c in s:
-        if c == '<' and not quote:
-            tag = True
-        elif c == '>' and not quote:
-            tag = False
-        elif (c == '"' or c == "'") and tag:
-            quote = not quote
-        elif not tag:
-            out = out + c
-
-    return out
-
-
 def cleanup_text(s):
     """ Perform known cleanup for the text content of the article
     """
-    # There has been, at some point, some weird utf characters that need to be removed
-    s = s.replace(u'\xa0', u' ')
+    # There has been, at some point, some weird utf characters that need to be removed (the &nbsp; entities only
+    # turn into them once the page is parsed)
+    s = doglog.clean_unicode(s)
     
     # Remove any html tags encountered
-    s = remove_html_markup(s)
+    s = strip_tags(s)
 
     # Strip whitespace
     s = s.strip()
@@ -205,22 +284,37 @@ def cleanup_text(s):
     return s
 
 
-def scrape_article(article):
+def scrape_article(article, driver=None):
     """ Using a second driver instance, load the specific URL and scrape the remainder of the data
 
     :param article: A dictionary containing the url and thumbnail image, to be populated with the rest of the properties
+    :param driver: The DogDriver to load the page with (defaults to the shared 'article' driver)
     :return: the the populated dictionary, to be written to file as json - or None if we can't load the page
     """
+    driver = get_driver('article') if driver is None else driver
+
     # Load the article and wait for it to load
     url = article['url']
 
-    if not get_driver('article').get_url(url):
+    if not driver.get_url(url, ready=ARTICLE_READY):
         # We'll just have to skip this slug, can't load it even with retries
         get_logger().warning(f"failed to get url: {url}")
         return None
 
-    source = get_driver('article').clean_unicode(get_driver('article').driver.page_source)
-    soup = BeautifulSoup(source, "html.parser")
+    return parse_article(article, driver.driver.page_source)
+
+
+def parse_article(article, raw_source):
+    """ Extract the article's data from its page source. This doesn't need the browser, so it can be run over
+    archived pages as well
+
+    :param article: A dictionary containing the url and thumbnail image, to be populated with the rest of the properties
+    :param raw_source: The html of the article page
+    :return: the the populated dictionary, or None if the page isn't a usable article
+    """
+    url = article['url']
+    source = doglog.clean_unicode(raw_source)
+    soup = htmlparse.soup(source, only=ARTICLE_ROOT)
     article_soup = soup.find("article", class_="container")
     if article_soup is None:
         article_soup = soup.find("div", class_="article")
@@ -279,81 +373,108 @@ def extract_articles(posts):
     contains the url, image,
 
     :param posts:
-    :return: an array of tuples representing the articles on this page (links/images/shares/comments)
+    :return: an array of the new articles on this page, and the urls of every article on the page
     """
     global already_scraped
 
-    articles = []
+    cards = []
 
     posts_html = posts.get_attribute('innerHTML')
     # print("posts_html: {}".format(posts_html))
 
-    soup = BeautifulSoup(posts_html, "html.parser")
+    soup = htmlparse.soup(posts_html)
     # print("soup_text: {}".format(soup.prettify()))
 
     article_divs = soup.find_all("div", class_='grid-layout')
     first_url = article_divs[0].find('a', class_='feed-hero').get('href').rstrip('/')
     get_logger().info("Extracting {} articles starting with: {}".format(len(article_divs), first_url))
+    page_urls = []
     for article_div in article_divs:
         # print(article_div.prettify())
-        url = SITE + article_div.find('a', class_='feed-hero').get('href').rstrip('/')
-        if url.split('/')[-1] in already_scraped:
+        url = canonicalize(SITE + article_div.find('a', class_='feed-hero').get('href'), PUBLISHER)
+        page_urls.append(url)
+        if dedup_key(url, PUBLISHER) in already_scraped:
             get_logger().info("already scraped {}, skipping...".format(url))
             continue
         else:
             get_logger().info("new article found: {}".format(url))
             # Just in case there are duplicates
-            already_scraped.add(url.split('/')[-1])
+            already_scraped.add(dedup_key(url, PUBLISHER))
 
-        article_json = {
+        cards += [{
             'url': url,
             'thumb': article_div.find('img').get('src')
-        }
-        article_json = scrape_article(article_json)
+        }]
 
+    # Load all the new articles on this page through the driver pool
+    articles = []
+    scraped = get_pool().map(lambda driver, card: scrape_article(card, driver), [dict(c) for c in cards])
+    for card, article_json in zip(cards, scraped):
         if article_json is not None:
             articles += [article_json]
             # get_logger().debug("extracted article: {}".format(json.dumps(article_json)))
         else:
-            get_logger().warn("Couldn't scrape {}".format(url))
+            get_logger().warn("Couldn't scrape {}".format(card['url']))
 
-    return articles
+    # Keep them in the checkpoint until they're posted, so a crash doesn't lose them
+    get_checkpoint().add(articles)
+    return articles, page_urls
 
 
 def create_articles(articles):
-    """ Create articles using the REST API
+    """ Push the articles to the database through the REST API, in batches
 
-    :param articles:
-    :return:
+    :param articles: A list of article dictionaries
+    :return: the ApiResult for each article, in order
     """
     for article in articles:
-      get_logger().info(f"creating article: {article['url']}")
-
-      # Add some common fields
-      article['userId'] = SYSTEM_USER_ID
-      article['browserId'] = SCRAPER_BROWSER_ID
-      article['publisher'] = 'stabmag'
-      get_logger().debug("Writing article to RDS...\n{}".format(article))
-
-      header = { "Content-Type": "application/json" }
-      r = requests.post(CREATE_ENDPOINT, headers=header, data=json.dumps(article, default=str))
-      try:
-        r.raise_for_status()
-      except Exception as ex:
-        get_logger().error(f"There was a {type(ex)} error while creating article {article['url']}:...\n{r}")
+        article['url'] = canonicalize(article['url'], PUBLISHER)
+        get_logger().debug("Writing article to RDS...\n{}".format(article))
+
+    results = get_api().create(articles, PUBLISHER)
+    for result in results:
+        # Posted, or spooled in the outbox to be posted later, either way the page doesn't need loading again
+        if result.ok or result.spooled:
+            already_scraped.record(result.item['url'])
+        else:
+            get_logger().error(f"There was a {result.error} error while creating article {result.item['url']}")
 
+        get_checkpoint().done(result.item['url'])
+    return results
 
 def scrape_pages():
-    """ Stab's site doesn't allow direct requests to paging, so we have to simulate usage of the site to get
-    all the article URLs
+    """ Find the new articles, then post them oldest first. The articles are kept in the checkpoint as they're
+    scraped, so if the last run died after walking the pages, we go straight to posting what it found
 
     :return:
     """
     get_logger().info("Starting scrape of latest Stab Mag news...")
 
+    if not get_checkpoint().get('listed', False):
+        listed = walk_pages()
+        get_checkpoint().put('listed', listed)
+    else:
+        listed = True
+
+    # Now, write all the articles we found to RDS
+    ordered = list(reversed(get_checkpoint().pending()))
+    create_articles(ordered)
+
+    # If the walk stopped early, the checkpoint is left so the next run knows it has to walk the pages again
+    if listed:
+        watermarks.save()
+        get_checkpoint().finish()
+        get_logger().info("Successfully completed scrape of latest Stab Mag news.")
+
+
+def walk_pages():
+    """ Stab's site doesn't allow direct requests to paging, so we have to simulate usage of the site to get
+    all the article URLs
+
+    :return: True if we got through all the pages, False if the site stopped us partway
+    """
     # Load the news page and wait for the posts to load
-    get_driver('site').get_url(NEWS_URL)
-    time.sleep(SLEEP)
+    get_driver('site').get_url(NEWS_URL, ready=NEWS_READY)
 
     # Click the "load more" button so we have all of the first 20 results (only for first page)
     from selenium.common.exceptions import NoSuchElementException
@@ -364,45 +485,68 @@ def scrape_pages():
             more_button = get_driver('site').driver.find_element_by_id('load-more')
         except NoSuchElementException as nseex2:
             get_logger().error("Can't find the 'Load More' button, quitting.")
-            exit()
+            return False
     print("\nsleeping for a bit to see if this button click will work...")
     get_driver('site').driver.execute_script("arguments[0].click();", more_button)
-    time.sleep(SLEEP)
+    replay.pause(SLEEP)
     get_logger().debug("Got the news page")
 
     # Scrape the first MAX_SCRAPED_PAGES_BEFORE_QUIT pages, even if there isn't a single new article on a page
-    articles = []
     for _ in range(MAX_SCRAPED_PAGES_BEFORE_QUIT):
+        # Each page of posts replaces the last in place, so it's recorded (and replayed) as the next step of the news
+        # page. A replay ends where the recording did
+        if not get_driver('site').changed():
+            get_logger().info("No more recorded pages of the news")
+            break
         posts = get_driver('site').driver.find_element_by_id('blog-list')
 
-        post_articles = extract_articles(posts)
+        post_articles, page_urls = extract_articles(posts)
         if len(post_articles) == 0:
             get_logger().debug("We've already scraped all the articles found on this page")
-        else:
-            articles += post_articles
+
+        # Stop as soon as we reach the articles that were newest last run
+        if watermarks.stop('news', page_urls):
+            break
             
-        time.sleep(SLEEP)
+        replay.pause(SLEEP)
         try:
             next_button = get_driver('site').driver.find_element(By.XPATH, '//a[text()="Next Page"]')
         except:
             get_driver('site').driver.get_screenshot_as_file("log/error_images/stabmag/error_{}.png".format(time.time()))
             get_logger().error('Failed to find "Next Page" link', exc_info=True)
             get_logger().info('page source...\n{}'.format(get_driver('site').driver.page_source))
-            exit()
+            return False
 
         next_button.click()
-    
-    # Now, write all the articles we found to RDS
-    ordered = list(reversed(articles))
-    create_articles(ordered)
 
-    get_logger().info("Successfully completed scrape of latest Stab Mag news.")
+    return True
 
 
 @atexit.register
 def cleanup():
-    get_driver('site').driver.quit()
-    get_driver('article').driver.quit()
+    if _pool is not None:
+        _pool.quit()
+    for driver in _drivers.values():
+        driver.quit()
+
+
+def reparse_archive(outfile):
+    """ Re-run the article parser over every archived article page, without fetching anything
+
+    :param outfile: The jsonl file to write the extracted articles to
+    """
+    if ARCHIVE is None:
+        get_logger().error("The page archive isn't enabled in config.yml")
+        return
+
+    count = 0
+    with open(outfile, 'w') as out:
+        for url, source in ARCHIVE.pages(lambda u: u.rstrip('/') != NEWS_URL.rstrip('/')):
+            article = parse_article({'url': url}, source)
+            if article:
+                out.write(json.dumps(article, default=str) + "\n")
+                count += 1
+    get_logger().info(f"Re-extracted {count} articles from the archive into {outfile}")
 
 
 def test_urls(urls):
@@ -422,6 +566,17 @@ if __name__ == "__main__":
     # To get the script to see files in this directory (including chromedriver)
     os.chdir(os.path.dirname(sys.argv[0]))
 
+    # Re-extract the archived pages instead of scraping: python scrape_stabmag.py --reparse [outfile]
+    if len(sys.argv) > 1 and sys.argv[1] == '--reparse':
+        reparse_archive(sys.argv[2] if len(sys.argv) > 2 else f"../data/{PUBLISHER}_reparsed.jsonl")
+        exit()
+
+    # All fetch and API calls share one retry policy (backoff, retry budget and per-host circuit breakers)
+    retrypolicy.configure(config, get_logger())
+
+    # Record the site's responses, or replay them offline (see dogbeach/replay.py)
+    replay.configure(config, PUBLISHER, get_logger())
+
     load_already_scraped_articles()
 
     scrape_pages()
@@ -1,19 +1,12 @@
 import os
-import re
 import sys
 import json
 import yaml
 import atexit
 import logging
-import requests
-import pandas as pd
-import pprint as pp
 
-from time import sleep
 from pathlib import Path
 from datetime import datetime
-from scrapy.selector import Selector
-from selenium.webdriver.common.keys import Keys
 
 # Config
 os.chdir(os.path.dirname(sys.argv[0]))
@@ -23,10 +16,28 @@ with open("../config.yml", "r") as ymlfile:
 # Import Doglog
 sys.path.append('..')
 from dogbeach import doglog
-from dogbeach.dogdriver import DogDriver
+from dogbeach import replay
+from dogbeach import retrypolicy
+from dogbeach import dogdriver
+from dogbeach import browserd
+from dogbeach.dogdriver import DogDriverPool, open_driver
+from dogbeach.engine import TokenBucket, rate_limits
+from dogbeach.archive import open_archive
+from dogbeach.urlindex import open_url_index
+from dogbeach.urls import canonicalize, dedup_key
+from dogbeach.api import open_api
+from dogbeach.writebehind import open_writer
+from dogbeach.skips import SkipStore
+from dogbeach import parse as htmlparse
+from dogbeach import extract
+from dogbeach.text import strip_tags, collapse_whitespace
 
 _logger = None
+_api = None
+_writer = None
 _driver = None
+_pool = None
+_bucket = None
 
 PUBLISHER = 'surfd.com'
 
@@ -63,9 +74,32 @@ RETRIES = config[PUBLISHER]['retries']
 # How long to wait before giving up on a page load
 PAGE_LOAD_TIMEOUT = config[PUBLISHER]['page_load_timeout']
 
+# Which resources should the browser skip loading (see dogdriver.BLOCKING_PROFILES), and when is a page "loaded"?
+BLOCK_RESOURCES = config[PUBLISHER]['block_resources'] if 'block_resources' in config[PUBLISHER] else None
+PAGE_LOAD_STRATEGY = config[PUBLISHER]['page_load_strategy'] if 'page_load_strategy' in config[PUBLISHER] else None
+
+# Attach to the shared browser service when it's running, rather than starting our own browser (see dogbeach/browserd.py)
+BROWSER_SERVICE = browserd.address(config)
+
+# Every fetched page is kept here (when enabled) so the parser can be re-run without re-crawling
+ARCHIVE = open_archive(config, PUBLISHER)
+
+# Parse pages with the parser backend set in config.yml (see dogbeach/parse.py)
+htmlparse.configure(config)
+
+# How many article pages should we load at once?
+CONCURRENCY = config[PUBLISHER]['concurrency'] if 'concurrency' in config[PUBLISHER] else 1
+
+# The host we're scraping, which is what the rate limit applies to
+HOST = config[PUBLISHER]['host'] if 'host' in config[PUBLISHER] else 'surfd.com'
+
 # The category page url template
 CAT_URL_TEMPLATE = 'https://surfd.com/category/{}/'
 
+# What "loaded" means for a category page and for an article page, so we don't sleep any longer than we need to
+CATEGORY_READY = dogdriver.NETWORK_IDLE
+ARTICLE_READY = 'div.entry-content'
+
 # The list of all category slugs
 CATEGORIES = {
   'product-reviews',
@@ -105,31 +139,68 @@ def get_driver():
     """
     global _driver
     if _driver is None:
-        _driver = DogDriver(get_logger(), sleep=SLEEP, tries=RETRIES, pageload_timeout=PAGE_LOAD_TIMEOUT)
+        _driver = open_driver(get_logger(), sleep=SLEEP, tries=RETRIES, pageload_timeout=PAGE_LOAD_TIMEOUT,
+                              block=BLOCK_RESOURCES, page_load_strategy=PAGE_LOAD_STRATEGY,
+                              debugger_address=BROWSER_SERVICE, archive=ARCHIVE)
     return _driver
 
 
-def load_already_scraped_articles():
-    """ Query the database for all articles that have already been scraped
+def get_pool():
+    """ Initialize and/or return existing pool of webdriver objects used to load articles
+
+    :return: a DogDriverPool object
+    """
+    global _pool
+    if _pool is None:
+        _pool = DogDriverPool(CONCURRENCY, get_logger(), bucket=get_bucket(), sleep=SLEEP, tries=RETRIES,
+                              pageload_timeout=PAGE_LOAD_TIMEOUT, block=BLOCK_RESOURCES,
+                              page_load_strategy=PAGE_LOAD_STRATEGY, debugger_address=BROWSER_SERVICE,
+                              archive=ARCHIVE)
+    return _pool
+
+
+def get_bucket():
+    """ Initialize and/or return existing token bucket that keeps article loads within the site's rate limit
+
+    :return: a TokenBucket object
+    """
+    global _bucket
+    if _bucket is None:
+        _bucket = TokenBucket(*rate_limits(config).get(HOST, (1, 1)))
+    return _bucket
+
+
+def get_api():
+    """ Initialize and/or return the REST API client, which keeps its connections open for the whole run
 
-    :return: a list of urls of articles that have already been scraped
+    :return: an ApiClient object
+    """
+    global _api
+    if _api is None:
+        _api = open_api(config, get_logger())
+    return _api
+
+
+def get_writer():
+    """ Initialize and/or return the write-behind queue, which posts scraped articles while the next ones load
+
+    :return: a WriteBehind object
+    """
+    global _writer
+    if _writer is None:
+        _writer = open_writer(config, create_articles, get_logger())
+    return _writer
+
+
+def load_already_scraped_articles():
+    """ Bring the local index of the articles that have already been scraped up to date with the database
     """
     global already_scraped
 
-    r = requests.get(PUBLISHER_ARTICLES_ENDPOINT)
-    urls_json = r.json()
-    already_scraped = set([x['url'] for x in urls_json])
-
-    skip_filename = Path(f'../data/{PUBLISHER}/skips.txt')
-    directory = os.path.dirname(skip_filename)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    skip_filename.touch(exist_ok=True)  # will create file, if it exists will do nothing
-    with open(skip_filename, 'r') as skips_file:
-      SKIPS = list(map(str.strip, skips_file.readlines()))
-      # print(SKIPS)
-    
-    already_scraped.update(SKIPS)
+    already_scraped = open_url_index(config, PUBLISHER, logger=get_logger())
+    already_scraped.sync(PUBLISHER_ARTICLES_ENDPOINT)
+
+    SkipStore(already_scraped, legacy=f'../data/{PUBLISHER}/skips.txt', logger=get_logger()).load()
 
     get_logger().debug("Found {} articles already scraped".format(len(already_scraped)))
 
@@ -153,57 +224,17 @@ def cleanup_youtube_link(link):
         return link
 
 
-def extract_article_video(sel):
-    """ There can be a mix of youtube and vimeo videos on a page. Extract them all, and fix up the urls for the youtube vids
-    which are super long embed links rather than simple video pages
-
-    Return an empty list if there are no videos found
-    """
-    article_video_youtube = sel.xpath("*//iframe[@class='youtube-player']/@src").extract()
-    if article_video_youtube is None: 
-        article_video_youtube = ['']
-    else:
-        article_video_youtube = list(map(cleanup_youtube_link, article_video_youtube))
-
-    article_video_vimeo = sel.xpath("*//div[@class='embed-vimeo']//iframe/@src").extract()
-    if article_video_vimeo is None: 
-        article_video_vimeo = ['']
-
-    article_video = article_video_youtube + article_video_vimeo
-
-    return article_video
-
-
-def remove_html_markup(s):
-    """ https://stackoverflow.com/questions/753052/strip-html-from-strings-in-python """
-    tag = False
-    quote = False
-    out = ""
-
-    for c in s:
-        if c == '<' and not quote:
-            tag = True
-        elif c == '>' and not quote:
-            tag = False
-        elif (c == '"' or c == "'") and tag:
-            quote = not quote
-        elif not tag:
-            out = out + c
-
-    return out
-
-
 def cleanup_text(s):
     """ Perform know cleanup for the text content of the article
     """
     # There is a ton of whitespace that can be compressed to a single space
-    s = re.sub(r'\s+', ' ', s)
+    s = collapse_whitespace(s)
     
     # Remove any remaining html tags encountered
-    s = remove_html_markup(s)
+    s = strip_tags(s)
 
     # Remove this social footer text...
-    s = s.replace("Share Pin Tweet WhatsApp Email", '')
+    s = doglog.remove_phrases(s, ["Share Pin Tweet WhatsApp Email"])
 
     # Strip whitespace
     s = s.strip()
@@ -211,93 +242,97 @@ def cleanup_text(s):
     return s
 
 
-def extract_link_data(link):
+def extract_link_data(link, driver=None):
     """ For a given url, load the page and extract all available data
 
     Extract the following fields:
         url, publish date, post category, tItle, subtitle, tags, thumbnail image, text content, article video (if the content contains a video), author name, and author url
     
+    :param link: The url of the article
+    :param driver: The DogDriver to load the page with (defaults to the shared driver)
     :return: A dictionary of attributes extracted from the page
     """
-    
-    get_driver().get_url(link)
-    sleep(4)
+    driver = get_driver() if driver is None else driver
+
+    driver.get_url(link, ready=ARTICLE_READY)
 
     get_logger().debug("getting page source from driver")
-    source = doglog.clean_unicode(get_driver().driver.page_source)
-    sleep(1)
+    return parse_link_data(link, driver.driver.page_source)
 
-    sel = Selector(text=source)
-    sleep(0.4)
 
-    publish_date = sel.xpath("*//meta[@property='article:published_time']").xpath('@content').extract_first()
+def normalize_publish_date(publish_date):
+    """ Turn a timestamp like 2021-03-04T05:06:07+00:00 into just the date """
     if ":" == publish_date[-3]:
         publish_date = publish_date[:-3] + publish_date[-2:]
         publish_date = datetime.strptime(publish_date, '%Y-%m-%dT%H:%M:%S%z')
         publish_date  = publish_date.strftime('%Y-%m-%d')
+    return publish_date
+
+
+# The fields of an article page. More fallback selectors can be added under extract: article: in config.yml
+ARTICLE_SPEC = extract.from_config(config, PUBLISHER, 'article', extract.Spec(
+    publishedAt=extract.Field("//meta[@property='article:published_time']/@content", post=normalize_publish_date),
+    category=extract.Field("//div[@class='byline-part cats']//a/text()"),
+    title=extract.Field("//div[@class='title-wrap title-with-sub']/h1/text()", "//div[@class='title-wrap']/h1/text()"),
+    subtitle=extract.Field("//div[@class='title-wrap title-with-sub']/p/text()", default=''),
+    thumb=extract.Field("//div[@class='hero']/img/@src", default=''),
+    text_content=extract.Field("//div[contains(@class,'entry-content')]//text()", many=True, default='',
+                               post=lambda text: cleanup_text('\n'.join(text))),
+    # There can be a mix of youtube and vimeo videos on a page. The youtube ones are super long embed links, which
+    # get turned into simple video pages
+    youtube=extract.Field("//iframe[@class='youtube-player']/@src", many=True, default=[],
+                          post=lambda links: list(map(cleanup_youtube_link, links))),
+    vimeo=extract.Field("//div[@class='embed-vimeo']//iframe/@src", many=True, default=[]),
+    author_name=extract.Field("//span[@class='byline-part author']//a/text()"),
+    author_url=extract.Field("//span[@class='byline-part author']//a/@href"),
+))
+
+
+def parse_link_data(link, raw_source):
+    """ Extract all available data from the page source of a link. This doesn't need the browser, so it can be run
+    over archived pages as well
+
+    :param link: The url of the article
+    :param raw_source: The html of the article page
+    :return: A dictionary of attributes extracted from the page
+    """
+    source = doglog.clean_unicode(raw_source)
+    fields = ARTICLE_SPEC.extract(source)
 
-    post_category = sel.xpath("*//div[@class='byline-part cats']//a/text()").extract_first()
-
-    title = sel.xpath("*//div[@class='title-wrap title-with-sub']/h1/text()").extract_first()
-    if title is None:
-        title = sel.xpath("*//div[@class='title-wrap']/h1/text()").extract_first()
-    
-    subtitle = sel.xpath("*//div[@class='title-wrap title-with-sub']/p/text()").extract_first()
-    subtitle = subtitle if subtitle is not None else ''
-
-    thumbnail_image = sel.xpath("*//div[@class='hero']/img/@src").extract_first()
-    if thumbnail_image is None or len(thumbnail_image) == 0:
-        thumbnail_image = ''
-
-    text_content = sel.xpath("*//div[contains(@class,'entry-content')]//text()").extract()
-    text_content = '\n'.join(text_content)
-    text_content = cleanup_text(text_content)
-
-    article_video = extract_article_video(sel)
-    
-    author_name = sel.xpath("*//span[@class='byline-part author']//a/text()").extract_first()
-
-    author_url = sel.xpath("*//span[@class='byline-part author']//a/@href").extract_first()
-    
     article_dict = {
-        'publishedAt' : publish_date,
+        'publishedAt' : fields['publishedAt'],
         'url' : link, 
-        'category' : post_category, 
-        'thumb' : thumbnail_image, 
-        'title' : title,
-        'subtitle' : subtitle, 
-        'text_content' : text_content, 
-        'article_video': article_video,
-        'author_name' : author_name, 
-        'author_url' : author_url,           
+        'category' : fields['category'], 
+        'thumb' : fields['thumb'], 
+        'title' : fields['title'],
+        'subtitle' : fields['subtitle'], 
+        'text_content' : fields['text_content'], 
+        'article_video': fields['youtube'] + fields['vimeo'],
+        'author_name' : fields['author_name'], 
+        'author_url' : fields['author_url'],           
     }
 
     return article_dict
 
 
-def create_article(article):
-    """
-    Push this article to the database through the REST API
+def create_articles(articles):
+    """ Push the articles to the database through the REST API, in batches
 
-    :param article: A dictionary of attributes extracted for a single link
-    :return: None
+    :param articles: A list of article dictionaries
+    :return: the ApiResult for each article, in order
     """
-    # Add some common fields
-    article['userId'] = SYSTEM_USER_ID
-    article['browserId'] = SCRAPER_BROWSER_ID
-    article['publisher'] = PUBLISHER
-    get_logger().info(f"Writing article to RDS...\n{article}")
-
-    header = { "Content-Type": "application/json" }
-    json_data = json.dumps(article, default=str)
-    r = requests.post(CREATE_ENDPOINT, headers=header, data=json_data)
-    
-    try:
-      r.raise_for_status()
-    except Exception as ex:
-      exception_type = ex.__class__.__name__
-      get_logger().error(f"There was a {exception_type} error while creating article {article['url']}:...\n{r.json()}")
-
+    for article in articles:
+        article['url'] = canonicalize(article['url'], PUBLISHER)
+        get_logger().debug("Writing article to RDS...\n{}".format(article))
+
+    results = get_api().create(articles, PUBLISHER)
+    for result in results:
+        # Posted, or spooled in the outbox to be posted later, either way the page doesn't need loading again
+        if result.ok or result.spooled:
+            already_scraped.record(result.item['url'])
+        else:
+            get_logger().error(f"There was a {result.error} error while creating article {result.item['url']}")
+    return results
 
 def extract_new_links():
     """ Get all the unique, new links from all categories
@@ -311,7 +346,7 @@ def extract_new_links():
         get_logger().debug(f"\nExtracting category: {category}")
         get_logger().debug(f"-------------------")
 
-        get_driver().get_url(CAT_URL_TEMPLATE.format(category))
+        get_driver().get_url(CAT_URL_TEMPLATE.format(category), ready=CATEGORY_READY)
 
         # If other screen appear, close
         try:
@@ -323,10 +358,15 @@ def extract_new_links():
         while True:
             try:
                 button_load_more = get_driver().driver.find_element_by_xpath("*//a[@class='block-loader tipi-button inf-load-more custom-button__fill-1 custom-button__size-1 custom-button__rounded-1']")
-                sleep(0.4)
+                replay.pause(0.4)
                 
                 button_load_more.click()
-                sleep(3)
+                replay.pause(3)
+
+                # Each click adds to the page in place, so it's recorded (and replayed) as the next step of the
+                # category page. A replay ends where the recording did
+                if not get_driver().changed():
+                    break
 
                 #if other screen appear,close
                 try:
@@ -339,7 +379,7 @@ def extract_new_links():
 
         # Get all links
         source = doglog.clean_unicode(get_driver().driver.page_source)
-        sel = Selector(text=source)
+        sel = htmlparse.selector(source)
         cat_links = sel.xpath("*//div[@class='block block-72 tipi-flex']//div[@class='title-wrap']/h3/a/@href").extract()
         if len(cat_links) == 0:
             # Try a different format
@@ -347,7 +387,7 @@ def extract_new_links():
 
         # Filter out links we've already scraped, and/or duplicates (which we've seen before even in the same category)
         start_link_count = len(cat_links)
-        cat_links = list(set([x for x in cat_links if x not in already_scraped]))
+        cat_links = list(set([x for x in cat_links if dedup_key(x, PUBLISHER) not in already_scraped]))
         get_logger().info(f"{len(cat_links)} of {start_link_count} links in this category are new")
         get_logger().info("\n".join(sorted(cat_links)))
         if len(cat_links) > 0:
@@ -366,15 +406,44 @@ def scrape():
     """
     new_links = extract_new_links()
     get_logger().info(f"There are {len(new_links)} new links to scrape...")
-    for link in new_links:
-        get_logger().info(f"\nprocessing link: {link}")
-        article_dict = extract_link_data(link)
-        create_article(article_dict)
+
+    # Load the links on the driver pool, results come back in chronological order, and are queued to be posted while
+    # the next ones load
+    results = get_pool().map(lambda driver, link: extract_link_data(link, driver), new_links)
+    for article_dict in results:
+        if article_dict is not None:
+            get_logger().info(f"\nprocessed link: {article_dict['url']}")
+            get_writer().put(article_dict)
+    get_writer().flush()
 
 
 @atexit.register
 def cleanup():
-    get_driver().driver.quit()
+    if _writer is not None:
+        _writer.close()
+    if _pool is not None:
+        _pool.quit()
+    if _driver is not None:
+        _driver.quit()
+
+
+def reparse_archive(outfile):
+    """ Re-run the article parser over every archived article page, without fetching anything
+
+    :param outfile: The jsonl file to write the extracted articles to
+    """
+    if ARCHIVE is None:
+        get_logger().error("The page archive isn't enabled in config.yml")
+        return
+
+    count = 0
+    with open(outfile, 'w') as out:
+        for url, source in ARCHIVE.pages(lambda u: '/category/' not in u):
+            article = parse_link_data(url, source)
+            if article:
+                out.write(json.dumps(article, default=str) + "\n")
+                count += 1
+    get_logger().info(f"Re-extracted {count} articles from the archive into {outfile}")
 
 
 def test_urls(urls):
@@ -398,6 +467,17 @@ if __name__ == '__main__':
     # To get the script to see files in this directory (including chromedriver)
     os.chdir(os.path.dirname(sys.argv[0]))
 
+    # Re-extract the archived pages instead of scraping: python scrape_surfd.com.py --reparse [outfile]
+    if len(sys.argv) > 1 and sys.argv[1] == '--reparse':
+        reparse_archive(sys.argv[2] if len(sys.argv) > 2 else f"../data/{PUBLISHER}_reparsed.jsonl")
+        exit()
+
+    # All fetch and API calls share one retry policy (backoff, retry budget and per-host circuit breakers)
+    retrypolicy.configure(config, get_logger())
+
+    # Record the site's responses, or replay them offline (see dogbeach/replay.py)
+    replay.configure(config, PUBLISHER, get_logger())
+
     # Query all the urls already scraped for this publisher
     load_already_scraped_articles()
 
@@ -20,11 +20,10 @@ import pytz
 import yaml
 import atexit
 import logging
-import requests
-from bs4 import BeautifulSoup
+import lxml.html
 from pathlib import Path
 from datetime import datetime
-from xml.sax.saxutils import escape, unescape
+from xml.sax.saxutils import unescape
 
 import pprint
 pp = pprint.PrettyPrinter(indent=2, width=200)
@@ -38,10 +37,32 @@ with open("../config.yml", "r") as ymlfile:
 # Import Doglog
 sys.path.append('..')
 from dogbeach import doglog
-from dogbeach.dogdriver import DogDriver
+from dogbeach import replay
+from dogbeach import retrypolicy
+from dogbeach import dogdriver
+from dogbeach import browserd
+from dogbeach.dogdriver import DogDriverPool, open_driver
+from dogbeach.engine import TokenBucket, rate_limits
+from dogbeach.archive import open_archive
+from dogbeach.urlindex import open_url_index
+from dogbeach.urls import canonicalize, dedup_key
+from dogbeach.api import open_api
+from dogbeach.writebehind import open_writer
+from dogbeach.watermark import open_watermarks
+from dogbeach.contenthash import ContentHashes
+from dogbeach.skips import SkipStore, BROKEN, REDIRECTED, EXCLUDED
+from dogbeach import parse as htmlparse
+from dogbeach import extract
+from dogbeach.text import strip_tags, collapse_whitespace
+from dogbeach.fetcher import Fetcher, HttpFetcher, BrowserFetcher
 
 _logger = None
+_api = None
+_writer = None
 _driver = None
+_pool = None
+_bucket = None
+_fetcher = None
 
 # What is the identifier for this scraper?
 PUBLISHER = 'surfer.com'
@@ -64,6 +85,9 @@ REST_API_URL = f"{REST_API_PROTOCOL}://{REST_API_HOST}:{REST_API_PORT}"
 CREATE_ENDPOINT = f"{REST_API_URL}/article"
 PUBLISHER_ARTICLES_ENDPOINT = f"{REST_API_URL}/articleUrlsByPublisher?publisher={PUBLISHER}"
 
+# User Agent to use for plain HTTP requests
+AGENT = config['common']['agent']
+
 # UserID and BrowswerID are required fields for creating articles, this User is the ID tied to the system account
 SYSTEM_USER_ID = config['common']['system_user_id']
 
@@ -79,6 +103,32 @@ RETRIES = config[PUBLISHER]['retries'] if 'retries' in config[PUBLISHER] else No
 # How long to wait before giving up on a page load
 PAGELOAD_TIMEOUT = config[PUBLISHER]['page_load_timeout'] if 'page_load_timeout' in config[PUBLISHER] else None
 
+# Which resources should the browser skip loading (see dogdriver.BLOCKING_PROFILES), and when is a page "loaded"?
+BLOCK_RESOURCES = config[PUBLISHER]['block_resources'] if 'block_resources' in config[PUBLISHER] else None
+PAGE_LOAD_STRATEGY = config[PUBLISHER]['page_load_strategy'] if 'page_load_strategy' in config[PUBLISHER] else None
+
+# Attach to the shared browser service when it's running, rather than starting our own browser (see dogbeach/browserd.py)
+BROWSER_SERVICE = browserd.address(config)
+
+# Every fetched page is kept here (when enabled) so the parser can be re-run without re-crawling
+ARCHIVE = open_archive(config, PUBLISHER)
+
+# Parse pages with the parser backend set in config.yml (see dogbeach/parse.py)
+htmlparse.configure(config)
+
+# Only the article and the elements the publication date can be in (the byline, the meta tags) are parsed out of an
+# article page
+ARTICLE_ROOT = htmlparse.only("article.post-content", "span.post-byline__date", 'meta[property="article:published_time"]')
+
+# How many article pages should we load at once?
+CONCURRENCY = config[PUBLISHER]['concurrency'] if 'concurrency' in config[PUBLISHER] else 1
+
+# Does the listing endpoint need a browser to render? (Otherwise it's fetched over plain HTTP)
+NEEDS_JS = config[PUBLISHER]['needs_js'] if 'needs_js' in config[PUBLISHER] else False
+
+# The host we're scraping, which is what the rate limit applies to
+HOST = config[PUBLISHER]['host'] if 'host' in config[PUBLISHER] else 'www.surfer.com'
+
 # Mode: full or new-only
 MODE_FULL = config[PUBLISHER]['mode_full']
 
@@ -100,12 +150,25 @@ SURFCAT_URL = 'https://www.surfer.com/wp-json/ami/v1/lazy-load' \
   '&count={}'\
   '&sort={{"date": "{}"}}'
 
+# What "loaded" means for a listing page and for an article page, so we don't sleep any longer than we need to
+LISTING_READY = dogdriver.js("document.readyState === 'complete'")
+ARTICLE_READY = 'article.post-content'
+
 # We want all times to be in westcoast time
 WESTCOAST = pytz.timezone('US/Pacific')
 
 # Track the list of article urls that have already been scraped
 already_scraped = set()
 
+# The newest articles in each listing last run, to stop paging once we reach them
+watermarks = None
+
+# The content hash of each article posted, to leave out the ones we already have
+hashes = None
+
+# The urls we know not to scrape (dead, redirected or broken pages)
+skips = None
+
 def get_logger():
     """ Initialize and/or return existing logger object
 
@@ -125,7 +188,8 @@ def get_driver():
     """
     global _driver
     if _driver is None:
-        _driver = DogDriver(get_logger())
+        _driver = open_driver(get_logger(), block=BLOCK_RESOURCES, page_load_strategy=PAGE_LOAD_STRATEGY,
+                              debugger_address=BROWSER_SERVICE, archive=ARCHIVE)
         if SLEEP:
             _driver.sleep = SLEEP
         if RETRIES:
@@ -136,22 +200,84 @@ def get_driver():
     return _driver
 
 
-def load_already_scraped_articles():
-    """ Query the database for all articles that have already been scraped
+def get_pool():
+    """ Initialize and/or return existing pool of webdriver objects used to load articles
 
-    :return: a list of urls of articles that have already been scraped
+    :return: a DogDriverPool object
     """
-    global already_scraped
+    global _pool
+    if _pool is None:
+        driver_kwargs = {'block': BLOCK_RESOURCES, 'page_load_strategy': PAGE_LOAD_STRATEGY,
+                         'debugger_address': BROWSER_SERVICE, 'archive': ARCHIVE}
+        if SLEEP:
+            driver_kwargs['sleep'] = SLEEP
+        if RETRIES:
+            driver_kwargs['tries'] = RETRIES
+        if PAGELOAD_TIMEOUT:
+            driver_kwargs['pageload_timeout'] = PAGELOAD_TIMEOUT
+        _pool = DogDriverPool(CONCURRENCY, get_logger(), bucket=get_bucket(), **driver_kwargs)
 
-    r = requests.get(PUBLISHER_ARTICLES_ENDPOINT)
-    urls_json = r.json()
-    already_scraped = set([x['url'] for x in urls_json])
+    return _pool
+
+
+def get_bucket():
+    """ Initialize and/or return existing token bucket that keeps article loads within the site's rate limit
+
+    :return: a TokenBucket object
+    """
+    global _bucket
+    if _bucket is None:
+        _bucket = TokenBucket(*rate_limits(config).get(HOST, (1, 1)))
+    return _bucket
+
+
+def get_fetcher():
+    """ Initialize and/or return existing fetcher for the lazy-load listing endpoint
+
+    :return: a Fetcher object
+    """
+    global _fetcher
+    if _fetcher is None:
+        browser = BrowserFetcher(get_driver, ready=LISTING_READY)
+        _fetcher = Fetcher(HttpFetcher(get_logger(), AGENT, archive=ARCHIVE), browser, NEEDS_JS, get_logger())
+
+    return _fetcher
 
-    with open(f'../data/{PUBLISHER}/skips.txt', 'r') as skips_file:
-      SKIPS = list(map(str.strip, skips_file.readlines()))
-      # print(SKIPS)
-    
-    already_scraped.update(SKIPS)
+
+def get_api():
+    """ Initialize and/or return the REST API client, which keeps its connections open for the whole run
+
+    :return: an ApiClient object
+    """
+    global _api
+    if _api is None:
+        _api = open_api(config, get_logger())
+    return _api
+
+
+def get_writer():
+    """ Initialize and/or return the write-behind queue, which posts scraped articles while the next ones load
+
+    :return: a WriteBehind object
+    """
+    global _writer
+    if _writer is None:
+        _writer = open_writer(config, create_articles, get_logger())
+    return _writer
+
+
+def load_already_scraped_articles():
+    """ Bring the local index of the articles that have already been scraped up to date with the database
+    """
+    global already_scraped, hashes, skips, watermarks
+
+    already_scraped = open_url_index(config, PUBLISHER, logger=get_logger())
+    already_scraped.sync(PUBLISHER_ARTICLES_ENDPOINT)
+    watermarks = open_watermarks(config, already_scraped, get_logger())
+    hashes = ContentHashes(already_scraped, get_logger())
+
+    skips = SkipStore(already_scraped, legacy=f'../data/{PUBLISHER}/skips.txt', logger=get_logger())
+    skips.load()
 
     get_logger().debug("Found {} articles already scraped".format(len(already_scraped)))
     
@@ -161,8 +287,7 @@ def get_page_source(endpoint):
     """
     get_logger().debug("Retrieving page from endpoint: {}".format(endpoint))
     
-    get_driver().get_url(endpoint)
-    raw_source = get_driver().driver.page_source
+    raw_source = get_fetcher().fetch(endpoint) or ''
     
     # The html returned is html encoded for '<' and '>' which obviously causes problems
     html_escape_table = {'<': "&lt;", ">": "&gt;"}
@@ -175,227 +300,158 @@ def get_page_source(endpoint):
     return source
 
 
-def extract_article_image(element):
+def pick_thumbnail(img_element):
   """ Each image usually comes with multiple resolutions. Not sure if the available resolutions ever vary, but 
   this has been written to get whichever resolution is closest to 600px width (should be exactly 600px)
   """
-  images = element.select('img')
-  if len(images) == 0:
-    img = ''
+  # Most images have multiple resolution options, if so, find the one closest to 600px width
+  if img_element.get('srcset'):
+    img_resolutions_list = list(map(str.split, map(str.strip, img_element.get('srcset').split(','))))
+    img_resolutions_dict = {int(item[1][:-1]): item[0] for item in img_resolutions_list}
+    resolutions = img_resolutions_dict.keys()
+    resolution_diffs_dict = {abs(item-600): item for item in resolutions}
+    min_resolution_diff_key = min(resolution_diffs_dict.keys())
+    img = img_resolutions_dict[resolution_diffs_dict[min_resolution_diff_key]]
+  elif img_element.get('src'):
+    img = img_element.get('src')
   else:
-    img_element = images[0]
-    # Most images have multiple resolution options, if so, find the one closest to 600px width
-    if img_element.has_attr('srcset'):
-      img_resolutions_list = list(map(str.split, map(str.strip, img_element['srcset'].split(','))))
-      img_resolutions_dict = {int(item[1][:-1]): item[0] for item in img_resolutions_list}
-      resolutions = img_resolutions_dict.keys()
-      resolution_diffs_dict = {abs(item-600): item for item in resolutions}
-      min_resolution_diff_key = min(resolution_diffs_dict.keys())
-      img = img_resolutions_dict[resolution_diffs_dict[min_resolution_diff_key]]
-    elif img_element.has_attr('src'):
-      img = img_element['src']
-    else:
-      # There is an image without a src? seems unlikely but we'll capture it
-      get_logger().warning(f"Article found with src-less image element: {img_element}")
-      img = ''
-  # print(f"Thumbnail: {img}")
+    # There is an image without a src? seems unlikely but we'll capture it
+    get_logger().warning(f"Article found with src-less image element: {lxml.html.tostring(img_element)}")
+    img = ''
 
   return img
 
-def extract_article_category(element):
-  """
-  """
-  category_element = element.select('div.article__text a.post-flag')
-  if len(category_element) == 0:
-    category = ""
-  else:
-    category = category_element[0].string.strip()
-  # print(f"Category: {category}")
 
-  return category
-
-
-def extract_article_title(element):
-  """
-  """
-  title_element = element.select('h2.article__title a')
-  if len(title_element) == 0:
-    title = ""
-  else:
-    title = title_element[0].string.strip()
-  # print(f"Title: {title}")
-
-  return title
-
-
-def extract_article_subtitle(element):
-  """
-  """
-  subtitle_element = element.select('p.article__subtitle')
-  if len(subtitle_element) == 0:
-    subtitle = ""
-  else:
-    subtitle_string = subtitle_element[0].string
-    if subtitle_string is not None:
-      subtitle = " ".join(subtitle_element[0].string.split())
-    else:
-      subtitle = ""
-  # print(f"Subtitle: {title}")
-  
-  return subtitle
-
-def extract_author_url(element):
-  """
-  """
-  author_url_element = element.select('div.article__meta a')
-  if len(author_url_element) == 0:
-    url = ''
-  else:
-    url = author_url_element[0].get('href')
-  # print(f"Author URL: {url}")
-
-  return url
-
-def extract_author_name(element):
-  """
-  """
-  author_name_element = element.select('div.article__meta a')
-  if len(author_name_element) == 0:
-    name = ''
-  else:
-    name = author_name_element[0].string.strip()
-  # print(f"Author Name: {name}")
-
-  return name
+# The fields of each article card on a listing page. More fallback selectors can be added under extract: card: in
+# config.yml
+CARD_SPEC = extract.from_config(config, PUBLISHER, 'card', extract.Spec(
+  url=extract.Field("a", attr="href", post=lambda href: canonicalize(href, PUBLISHER)),
+  thumb=extract.Field("img", default='', post=pick_thumbnail),
+  category=extract.Field("div.article__text a.post-flag", text=True, default='', post=str.strip),
+  title=extract.Field("h2.article__title a", text=True, default='', post=str.strip),
+  subtitle=extract.Field("p.article__subtitle", text=True, default='', post=collapse_whitespace),
+  author_url=extract.Field("div.article__meta a", attr="href", default=''),
+  author_name=extract.Field("div.article__meta a", text=True, default='', post=str.strip),
+))
 
 
 def extract_article_list(post_source):
   """ This method will find all article links on the page that haven't already been scraped
 
-  :param category: The category we're currently scraping
   :param post_source: The html for an entire page of results
-  :return: A list of dictionaries of article data scraped from the page, in the order they were scraped
+  :return: A list of dictionaries of the new articles' data, and a list of the urls of every card on the page, both
+    in page order
   """
   global already_scraped
 
   articles = []
-  
-  soup = BeautifulSoup(post_source, "html.parser")
-  # print(soup.prettify())
 
-  article_elements = soup.find_all("article")
-  if len(article_elements) == 0:
+  cards = CARD_SPEC.extract_all(post_source, "article")
+  if len(cards) == 0:
     get_logger().warning("No articles found to extract")
   else:
-    get_logger().info("Extracting {} articles starting with: {}".format(len(article_elements), article_elements[0].find('a').get('href')))
+    get_logger().info("Extracting {} articles starting with: {}".format(len(cards), cards[0]['url']))
   
-  # From each article div, extract the partial content (url, thumbnail, category) from the card
-  for article_element in article_elements:
-    url = article_element.find('a').get('href')[:-1]
-    if url in already_scraped:
+  page_urls = [card['url'] for card in cards if card['url'] is not None]
+
+  # From each article card, take the partial content (url, thumbnail, category)
+  for card in cards:
+    url = card['url']
+    if url is None or dedup_key(url, PUBLISHER) in already_scraped:
       continue
 
     if '30-days-giveaways' in url:
       print(f"All of these are broken for some reason: {url}")
-      with open('../data/surfer.com/skips.txt', "a") as skips:
-        skips.write(f"{url}\n")
+      skips.add(url, EXCLUDED)
       continue
 
     surfer_dot_com_regex = r"^https?:\/\/(www\.)?surfer.com"
     if not re.search(surfer_dot_com_regex, url, re.M|re.I):
       get_logger().warning("This link is to a different domain, skip it")
       continue
-    
-    img = extract_article_image(article_element)
-    category = extract_article_category(article_element)
-    title = extract_article_title(article_element)
-    subtitle = extract_article_subtitle(article_element)
-    author_url = extract_author_url(article_element)
-    author_name = extract_author_name(article_element)
 
     article_json = {
       "url": url, 
-      "category": category, 
-      "thumb": img, 
-      "title": title, 
-      "subtitle": subtitle, 
-      "author_url": author_url, 
-      "author_name": author_name
+      "category": card['category'], 
+      "thumb": card['thumb'], 
+      "title": card['title'], 
+      "subtitle": card['subtitle'], 
+      "author_url": card['author_url'], 
+      "author_name": card['author_name']
     }
     get_logger().debug(f"\nArticle card found: \n{pp.pformat(article_json)}")
     
     articles += [article_json]
   
-  return articles
-
-
-def remove_html_markup(s):
-    """ https://stackoverflow.com/questions/753052/strip-html-from-strings-in-python """
-    tag = False
-    quote = False
-    out = ""
-
-    for c in s:
-        if c == '<' and not quote:
-            tag = True
-        elif c == '>' and not quote:
-            tag = False
-        elif (c == '"' or c == "'") and tag:
-            quote = not quote
-        elif not tag:
-            out = out + c
-
-    return out
+  return articles, page_urls
 
 
 def cleanup_text(s):
     """ """
-    cleaned = s.replace("- Enlarge image", "").strip()
+    cleaned = doglog.remove_phrases(s, ["- Enlarge image"]).strip()
 
     return cleaned
 
 
-def scrape_article(article):
+def scrape_article(article, driver=None):
     """ For the provided article url, load the article and find whatever data is available
 
     :param article: The initial fields of the article in a dictionary
+    :param driver: The DogDriver to load the page with (defaults to the shared driver)
     :return:
     """
+    driver = get_driver() if driver is None else driver
+
     # Load the article and wait for it to load
     print("\n\n=================================================================================\n")
     get_logger().debug(f"Processing URL: {article['url']}")
 
-    if not get_driver().get_url(article['url'], tries=5):
+    if not driver.get_url(article['url'], tries=5, ready=ARTICLE_READY):
         # We'll just have to skip this url, can't load it even with retries
         get_logger().error("Failed to load URL: {}".format(article['url']))
         return
     
     # There are some URLs that get redirected to non-article pages, avoid them...
-    current_url = get_driver().driver.current_url.rstrip('/')
+    current_url = driver.driver.current_url.rstrip('/')
     current_slug = current_url.split('/')[-1]
     article_slug = article['url'].rstrip('/').split('/')[-1]
     if current_slug != article_slug :
       get_logger().error(f"This url redirected to something other than the expected URL ({current_url}), so it's probably a dead page\n")
 
       # Save this bad url so we don't try to scrape it again
-      with open('../data/surfer.com/skips.txt', "a") as skips:
-        skips.write(f"{article['url']}\n")
+      skips.add(article['url'], REDIRECTED)
       
       return
-    
+
+    # Keep the page's hash along with the article's, for backfills to compare against
+    source = driver.driver.page_source
+    if hashes is not None:
+        hashes.check_page(article['url'], source)
+
+    return parse_article(article, source)
+
+
+def parse_article(article, raw_source):
+    """ Extract the article's data from its page source. This doesn't need the browser, so it can be run over
+    archived pages as well
+
+    :param article: The initial fields of the article in a dictionary
+    :param raw_source: The html of the article page
+    :return: the populated dictionary, or None if the page isn't a usable article
+    """
     # Cleanup the article source
-    source = doglog.clean_unicode(get_driver().driver.page_source)
+    source = doglog.clean_unicode(raw_source)
     
     # There are different formats/html structure so figure out which we're dealing with
-    article_soup = BeautifulSoup(source, "html.parser")
+    article_soup = htmlparse.soup(source, only=ARTICLE_ROOT)
     try:
       content = article_soup.select('article.post-content')[0]
     except:
       get_logger().error(f"Broken content found at {article['url']}, adding to the skip list...")
       get_logger().info(f"Broken content:\n{article_soup}")
       
-      with open('../data/surfer.com/skips.txt', "a") as skips:
-        skips.write(f"{article['url']}\n")
+      if skips is not None:
+        skips.add(article['url'], BROKEN)
       
       return
 
@@ -420,9 +476,9 @@ def scrape_article(article):
 
     # Article Content
     content = article_soup.select('article.post-content div.post-body')[0].text.strip()
-    content = remove_html_markup(content) # This shouldn't be necessary, but there are some broken articles with html tags
+    content = strip_tags(content) # This shouldn't be necessary, but there are some broken articles with html tags
     content = cleanup_text(content)
-    content = " ".join(content.split())
+    content = collapse_whitespace(content)
     article['text_content'] = content
     
     # Tags
@@ -439,31 +495,39 @@ def scrape_article(article):
     return article
 
 
-def create_article(article):
-    """
-    Push this article to the database through the REST API
+def create_articles(articles):
+    """ Push the articles to the database through the REST API, in batches
 
-    :param articles:
-    :return:
+    :param articles: A list of article dictionaries
+    :return: the ApiResult for each article posted, in order
     """
-    global already_scraped
-    
-    # Add some common fields
-    article['userId'] = SYSTEM_USER_ID
-    article['browserId'] = SCRAPER_BROWSER_ID
-    article['publisher'] = PUBLISHER
-    get_logger().debug("Writing article to RDS...\n{}".format(article))
-
-    header = { "Content-Type": "application/json" }
-    json_data = json.dumps(article, default=str)
-    r = requests.post(CREATE_ENDPOINT, headers=header, data=json_data)
-    
-    try:
-      r.raise_for_status()
-    except Exception as ex:
-      exception_type = ex.__class__.__name__
-      get_logger().error(f"There was a {exception_type} error while creating article {article['url']}:...\n{r.json()}")
-
+    changed = []
+    for article in articles:
+        article['url'] = canonicalize(article['url'], PUBLISHER)
+
+        # We already have this article word for word, so there's nothing to post
+        if hashes is not None and hashes.unchanged(article):
+            get_logger().debug(f"Skipping unchanged article {article['url']}")
+            already_scraped.record(article['url'])
+            continue
+        moved_from = hashes.moved(article) if hashes is not None else None
+        if moved_from is not None:
+            get_logger().info(f"Skipping article {article['url']}, it's the same as {moved_from}")
+            already_scraped.record(article['url'])
+            continue
+        get_logger().debug("Writing article to RDS...\n{}".format(article))
+        changed.append(article)
+
+    results = get_api().create(changed, PUBLISHER)
+    for result in results:
+        # Posted, or spooled in the outbox to be posted later, either way the page doesn't need loading again
+        if result.ok or result.spooled:
+            already_scraped.record(result.item['url'])
+        else:
+            get_logger().error(f"There was a {result.error} error while creating article {result.item['url']}")
+    if hashes is not None:
+        hashes.remember([result.item for result in results if result.ok or result.spooled])
+    return results
 
 def extract_articles(articles, create=True):
   """
@@ -474,13 +538,12 @@ def extract_articles(articles, create=True):
   :param post_source: The html for an entire page of results
   :return: True if we encountered *any* urls that we've already scraped, False if not
   """
-  # Load each article and extract the rest of the data
-  for article in articles:
-    article = scrape_article(article)
-    
-    # If there was no scraping error, then send the article data to the REST API...
-    if article and create:
-      create_article(article)
+  # Load the articles on the driver pool and extract the rest of the data, results come back in the original order.
+  # If there was no scraping error, the article is queued for the REST API, and posted while the next ones load
+  results = get_pool().map(lambda driver, a: scrape_article(a, driver), articles)
+  for article in results:
+    if create and article:
+      get_writer().put(article)
 
 
 def scrape():
@@ -498,7 +561,7 @@ def scrape():
         source = get_page_source(page_endpoint)
         
         # build a list of all articles on this page that haven't been scraped yet
-        page_articles = extract_article_list(source)
+        page_articles, page_urls = extract_article_list(source)
 
         # If there are any new articles on this page, extract all their contents and push to the database
         article_urls_string = "\n".join([x['url'] for x in page_articles])
@@ -518,15 +581,56 @@ def scrape():
                 get_logger().info("All articles on page {} have already been scraped, exiting...".format(int(pagenum)))
                 break
         
+        # Stop as soon as we reach the articles that were newest last run (a full scrape runs oldest first, so it
+        # never does)
+        if not MODE_FULL and watermarks.stop('latest', page_urls):
+            break
+
         # Increment the page counter
         pagenum += 1
 
+    # The watermark only keeps articles that made it into the index, so wait for the queue to be posted
+    get_writer().flush()
+    watermarks.save()
     get_logger().info("Successfully completed scrape of latest Surfer.com news.")
 
 
 @atexit.register
 def cleanup():
-    get_driver().driver.quit()
+    if _writer is not None:
+        _writer.close()
+    if skips is not None:
+        skips.flush()
+    if _pool is not None:
+        _pool.quit()
+    if _driver is not None:
+        _driver.quit()
+
+
+def reparse_archive(outfile, changed_only=False):
+    """ Re-run the article parser over every archived article page, without fetching anything
+
+    :param outfile: The jsonl file to write the extracted articles to
+    :param changed_only: Only parse the pages that have changed since they were last parsed
+    """
+    if ARCHIVE is None:
+        get_logger().error("The page archive isn't enabled in config.yml")
+        return
+
+    page_hashes = ContentHashes(open_url_index(config, PUBLISHER, logger=get_logger()), get_logger())
+    count, unchanged = 0, 0
+    with open(outfile, 'w') as out:
+        for url, source in ARCHIVE.pages(lambda u: 'wp-json' not in u):
+            # Every page is hashed, so the next --changed run has something to compare with
+            if page_hashes.check_page(url, source) and changed_only:
+                unchanged += 1
+                continue
+            article = parse_article({'url': canonicalize(url, PUBLISHER)}, source)
+            if article:
+                out.write(json.dumps(article, default=str) + "\n")
+                count += 1
+            page_hashes.remember_pages([url])
+    get_logger().info(f"Re-extracted {count} articles from the archive into {outfile} ({unchanged} pages unchanged)")
 
 
 def test_urls(urls):
@@ -554,6 +658,20 @@ if __name__ == "__main__":
     # To get the script to see files in this directory (including chromedriver)
     os.chdir(os.path.dirname(sys.argv[0]))
 
+    # Re-extract the archived pages instead of scraping: python scrape_surfer.com.py --reparse [outfile] [--changed]
+    # (--changed only parses the pages that are different from when they were last parsed)
+    if len(sys.argv) > 1 and sys.argv[1] == '--reparse':
+        args = [arg for arg in sys.argv[2:] if arg != '--changed']
+        reparse_archive(args[0] if len(args) > 0 else f"../data/{PUBLISHER}_reparsed.jsonl",
+                        changed_only='--changed' in sys.argv)
+        exit()
+
+    # All fetch and API calls share one retry policy (backoff, retry budget and per-host circuit breakers)
+    retrypolicy.configure(config, get_logger())
+
+    # Record the site's responses, or replay them offline (see dogbeach/replay.py)
+    replay.configure(config, PUBLISHER, get_logger())
+
     # Query all the urls already scraped for this publisher
     load_already_scraped_articles()
 
@@ -1,21 +1,14 @@
 import os
-import re
 import sys
 import json
 import yaml
 import pprint
+import asyncio
 import logging
-import requests
 import pandas as pd
 
-from retry import retry
 from pathlib import Path
-from requests import Timeout
-from bs4 import BeautifulSoup
-from time import sleep, strftime
-from dateutil.parser import parse
-from scrapy.selector import Selector
-from playwright.sync_api import sync_playwright
+from playwright.async_api import async_playwright, Error
 
 
 # Config
@@ -26,7 +19,22 @@ with open("../config.yml", "r") as ymlfile:
 # Import Doglog
 sys.path.append('..')
 from dogbeach import doglog
+from dogbeach import replay
+from dogbeach import retrypolicy
+from dogbeach import browserd
+from dogbeach.fetcher import HttpFetcher
+from dogbeach.archive import open_archive
+from dogbeach.urlindex import open_url_index
+from dogbeach.urls import canonicalize, dedup_key
+from dogbeach.api import open_api
+from dogbeach.watermark import open_watermarks
+from dogbeach import parse as htmlparse
+from dogbeach.engine import TokenBucket, rate_limits
+from dogbeach.pagepool import PagePool
 _logger = None
+_api = None
+_http = None
+_bucket = None
 
 
 PUBLISHER = 'surfline.com'
@@ -50,6 +58,21 @@ SYSTEM_USER_ID = config['common']['system_user_id']
 # This is the "blank" UUID
 SCRAPER_BROWSER_ID = config['common']['browser_id']
 
+# Attach to the shared browser service when it's running, rather than starting our own browser
+BROWSER_SERVICE = browserd.address(config)
+
+# Keep the raw pages, so they can be re-parsed without re-crawling (None when archiving is turned off)
+ARCHIVE = open_archive(config, PUBLISHER)
+
+# Parse pages with the parser backend set in config.yml (see dogbeach/parse.py)
+htmlparse.configure(config)
+
+# How many article pages should we load at once?
+CONCURRENCY = config[PUBLISHER]['concurrency'] if 'concurrency' in config[PUBLISHER] else 1
+
+# The host we're scraping, which is what the rate limit applies to
+HOST = config[PUBLISHER]['host'] if 'host' in config[PUBLISHER] else 'www.surfline.com'
+
 # Maximum number of empty pages to load before quitting
 MAX_EMPTY_PAGES = config[PUBLISHER]['max_empty_pages']
 
@@ -58,6 +81,9 @@ MAX_EMPTY_PAGES = config[PUBLISHER]['max_empty_pages']
 # A list of all the articles that have been scraped already, so we don't duplicate our efforts
 already_scraped = set()
 
+# The newest articles in each listing last run, to stop paging once we reach them
+watermarks = None
+
 ##################################### Logging
 def get_logger():
     """ Initialize and/or return existing logger object
@@ -70,6 +96,26 @@ def get_logger():
         _logger = doglog.setup_logger(f'{PUBLISHER}_site', logfile, clevel=logging.DEBUG)
     return _logger
 
+def get_http():
+    """ Initialize and/or return existing HTTP fetcher for the json listing endpoint
+
+    :return: an HttpFetcher object
+    """
+    global _http
+    if _http is None:
+        _http = HttpFetcher(get_logger(), AGENT, archive=ARCHIVE)
+    return _http
+
+def get_bucket():
+    """ Initialize and/or return existing token bucket that keeps page loads within the site's rate limit
+
+    :return: a TokenBucket object
+    """
+    global _bucket
+    if _bucket is None:
+        _bucket = TokenBucket(*rate_limits(config).get(HOST, (1, 1)))
+    return _bucket
+
 ##################################### Helper Functions
 
 def parse_tags(tags_list: list) -> str:
@@ -90,229 +136,348 @@ def parse_tags(tags_list: list) -> str:
     return tags
 
 
-def load_already_scraped_articles():
-    """ Query the database for all articles that have already been scraped
+def get_api():
+    """ Initialize and/or return the REST API client, which keeps its connections open for the whole run
 
-    :return: a list of urls of articles that have already been scraped
+    :return: an ApiClient object
     """
-    global already_scraped
+    global _api
+    if _api is None:
+        _api = open_api(config, get_logger())
+    return _api
+
 
-    r = requests.get(PUBLISHER_ARTICLES_ENDPOINT)
-    urls_json = r.json()
+def load_already_scraped_articles():
+    """ Bring the local index of the articles that have already been scraped up to date with the database
+    """
+    global already_scraped, watermarks
 
-    already_scraped = set([x['url'] for x in urls_json])
+    already_scraped = open_url_index(config, PUBLISHER, logger=get_logger())
+    already_scraped.sync(PUBLISHER_ARTICLES_ENDPOINT)
+    watermarks = open_watermarks(config, already_scraped, get_logger())
 
     get_logger().debug("Found {} articles already scraped".format(len(already_scraped)))
 
 
 ################################################################################ Scraping
 
-def create_article(article):
-    """
-    Push this article to the database through the REST API
+def create_articles(articles):
+    """ Push the articles to the database through the REST API, in batches
 
-    :param articles:
-    :return:
+    :param articles: A list of article dictionaries
+    :return: the ApiResult for each article, in order
     """
-    # Add some common fields
-    article['userId'] = SYSTEM_USER_ID
-    article['browserId'] = SCRAPER_BROWSER_ID
-    article['publisher'] = PUBLISHER
-
-    header = { "Content-Type": "application/json" }
-    json_data = json.dumps(article, default=str)
-    r = requests.post(CREATE_ENDPOINT, headers=header, data=json_data)
-    try:
-        r.raise_for_status()
-    except Exception as ex:
-        get_logger().error(f"There was a {type(ex)} error while creating article {article['url']}:...\n{r.json()}")
-
-    get_logger().debug("\n\n=================================================================================\n\n")
+    for article in articles:
+        article['url'] = canonicalize(article['url'], PUBLISHER)
+        get_logger().debug("Writing article to RDS...\n{}".format(article))
+
+    results = get_api().create(articles, PUBLISHER)
+    for result in results:
+        # Posted, or spooled in the outbox to be posted later, either way the page doesn't need loading again
+        if result.ok or result.spooled:
+            already_scraped.record(result.item['url'])
+        else:
+            get_logger().error(f"There was a {result.error} error while creating article {result.item['url']}")
+    return results
 
 ################################################################################
 
-@retry(Timeout, tries=6, delay=3, backoff=1.4, max_delay=30)
-def extract_article(page, post):
+async def extract_article(page, post):
     """
     :param page: the playwright page object used to load the url
     :param post: a dict containing the content already extracted from the category page
     :return: a dict containing all the data extracted from the page
     """
-    permalink = post["permalink"].replace('#038;', '')
+    permalink = canonicalize(post["permalink"], PUBLISHER)
     get_logger().info(f"extracting: {permalink}")
 
-    r = page.goto(permalink)
-    sleep(2)
+    r = await page.goto(permalink)
 
     if r.status == 200:
-        soup = BeautifulSoup(doglog.clean_unicode(r.text()), "lxml")
-
-        if post["media"]["type"] == "image":
-            thumbnail = post["media"]["feed1x"].replace('https://', '')
-        else:
-            thumbnail = ""
-
-        if soup.select("div.sl-editorial-author__details__name"):
-            author_name = soup.select("div.sl-editorial-author__details__name")[0].get_text() # Surfline
-        else:
-            author_name = ""
-
-        article_video = [v.find("iframe")["src"] for v in soup.select(".video-wrap") if v.find("iframe") is not None] # ["https://www.youtube.com/embed/nF2y6MjpOQ4?feature=oembed"]
-
-        if len(soup.select("div#sl-editorial-article-body")) > 0:
-            # We have a standard page, pull out the text in the normal div
-            content = ". ".join([p.get_text(separator="\n", strip=True) for p in soup.select("div#sl-editorial-article-body")[0].select("p.p1") if len(p.get_text(strip=True)) > 0]).replace('..', '.') # or "\n".join(...)
-            if not len(content):
-                content = ". ".join([p.get_text(separator="\n", strip=True) for p in soup.select("div#sl-editorial-article-body")[0].select("p") if len(p.get_text(strip=True)) > 0]).replace('..', '.')
-        elif len(soup.findAll("header", {"data-testid": "travel-zone-navbar"})) > 0:
-            # We have a special "travel guide" page, extracting the content on this one will take some extra work
-            sections = [
-                soup.find("section", {"data-testid": "travel-hero"}),
-                soup.find("section", {"data-testid": "surf-zone"}),
-                soup.find("section", {"data-testid": "travel-interview"}),
-                soup.find("section", {"data-testid": "travel-zone-when-to-score"}),
-                soup.find("section", {"data-testid": "travel-local-knowledge"}),
-                soup.find("section", {"data-testid": "travel-essentials"}),
-                soup.find("section", {"data-testid": "spaghetti-time"})
-            ]
-            content = "\n\n".join([s.get_text(separator="\n", strip=True) for s in sections if s])
-
-        # Build full tags list from the categories, series, and existing tags
-        categories = [c["name"] for c in post["categories"]]
-        series = [s["name"] for s in post["series"]]
-        atags = [a["href"].split("/")[-1] for a in soup.select("ul.sl-article-tags")[0].select("a")] if soup.select("ul.sl-article-tags") else []
-        tags = parse_tags(categories + series + atags)
-        
-        article_json = {
-            'url': permalink,
-            'publishedAt': post["createdAt"].replace(' ', 'T'),
-            'category': post['category'],
-            'tags': tags,
-            'title': post["title"],
-            'subtitle' : post["subtitle"],
-            'thumb': thumbnail,
-            'article_video': article_video,
-            'author_name': author_name,
-            'text_content': content,
-        }
-        get_logger().debug(pprint.pformat(article_json, sort_dicts=False, width=200))
-        return article_json
+        raw_source = await r.text()
+        if ARCHIVE is not None:
+            ARCHIVE.put(permalink, raw_source)
+        return parse_article(post, raw_source)
     else:
         get_logger().error(f"Error: {r.status} status retrieving page: {permalink}")
         return None
 
-def scrub_url(url):
-    """ Remove any useless querystrings
+def parse_article(post, raw_source):
+    """ Extract the article's data from its page source. This doesn't need the browser, so it can be run over
+    archived pages as well
+
+    :param post: a dict containing the content already extracted from the category page
+    :param raw_source: the page source
+    :return: a dict containing all the data extracted from the page
     """
-    print(url)
-    url = url.replace('#038;', '')
-    
-    utm_regex_str = r'(\\?)utm[^&]*(?:&utm[^&]*)*&(?=(?!utm[^\s&=]*=)[^\s&=]+=)|\\?utm[^&]*(?:&utm[^&]*)*$|&utm[^&]*/g'
-    utm_regex = re.compile(utm_regex_str, re.IGNORECASE)
+    permalink = canonicalize(post["permalink"], PUBLISHER)
+    soup = htmlparse.soup(doglog.clean_unicode(raw_source))
+
+    if post["media"]["type"] == "image":
+        thumbnail = post["media"]["feed1x"].replace('https://', '')
+    else:
+        thumbnail = ""
 
-    scrubbed = re.sub(utm_regex, r'\1', url).rstrip('?')
+    if soup.select("div.sl-editorial-author__details__name"):
+        author_name = soup.select("div.sl-editorial-author__details__name")[0].get_text() # Surfline
+    else:
+        author_name = ""
+
+    article_video = [v.find("iframe")["src"] for v in soup.select(".video-wrap") if v.find("iframe") is not None] # ["https://www.youtube.com/embed/nF2y6MjpOQ4?feature=oembed"]
+
+    if len(soup.select("div#sl-editorial-article-body")) > 0:
+        # We have a standard page, pull out the text in the normal div
+        content = ". ".join([p.get_text(separator="\n", strip=True) for p in soup.select("div#sl-editorial-article-body")[0].select("p.p1") if len(p.get_text(strip=True)) > 0]).replace('..', '.') # or "\n".join(...)
+        if not len(content):
+            content = ". ".join([p.get_text(separator="\n", strip=True) for p in soup.select("div#sl-editorial-article-body")[0].select("p") if len(p.get_text(strip=True)) > 0]).replace('..', '.')
+    elif len(soup.findAll("header", {"data-testid": "travel-zone-navbar"})) > 0:
+        # We have a special "travel guide" page, extracting the content on this one will take some extra work
+        sections = [
+            soup.find("section", {"data-testid": "travel-hero"}),
+            soup.find("section", {"data-testid": "surf-zone"}),
+            soup.find("section", {"data-testid": "travel-interview"}),
+            soup.find("section", {"data-testid": "travel-zone-when-to-score"}),
+            soup.find("section", {"data-testid": "travel-local-knowledge"}),
+            soup.find("section", {"data-testid": "travel-essentials"}),
+            soup.find("section", {"data-testid": "spaghetti-time"})
+        ]
+        content = "\n\n".join([s.get_text(separator="\n", strip=True) for s in sections if s])
+
+    # Build full tags list from the categories, series, and existing tags
+    categories = [c["name"] for c in post["categories"]]
+    series = [s["name"] for s in post["series"]]
+    atags = [a["href"].split("/")[-1] for a in soup.select("ul.sl-article-tags")[0].select("a")] if soup.select("ul.sl-article-tags") else []
+    tags = parse_tags(categories + series + atags)
     
-    print(scrubbed)
-    return scrubbed
+    article_json = {
+        'url': permalink,
+        'publishedAt': post["createdAt"].replace(' ', 'T'),
+        'category': post['category'],
+        'tags': tags,
+        'title': post["title"],
+        'subtitle' : post["subtitle"],
+        'thumb': thumbnail,
+        'article_video': article_video,
+        'author_name': author_name,
+        'text_content': content,
+    }
+    get_logger().debug(pprint.pformat(article_json, sort_dicts=False, width=200))
+    return article_json
+
+async def get_listing(page, url):
+    """ Retrieve a page of posts from the json listing endpoint. This is a plain API so it's requested over HTTP,
+    only falling back to rendering it in the browser if that fails
+
+    :param page: the playwright page object to fall back on
+    :param url: the listing endpoint url
+    :return: the decoded json
+    """
+    data = await asyncio.get_running_loop().run_in_executor(None, get_http().fetch_json, url)
+    if data is not None:
+        return data
+
+    get_logger().info(f"Falling back to the browser for: {url}")
+    await page.goto(url)
+
+    source = doglog.clean_unicode(await page.content())
+    sel = htmlparse.selector(source)
+    json_str = sel.xpath("*//pre//text()").extract_first()
+    return json.loads(json_str)
+
+async def launch_browser(p):
+    """ Attach to the shared browser service when it's running (see dogbeach/browserd.py), otherwise start our own
 
-def abort_or_continue(route, request):
+    :param p: the playwright object
+    :return: a playwright browser
+    """
+    if BROWSER_SERVICE:
+        get_logger().info(f"Attaching to the shared browser at {BROWSER_SERVICE}")
+        return await p.chromium.connect_over_cdp(browserd.endpoint(BROWSER_SERVICE))
+    return await p.chromium.launch(headless=True)
+
+async def abort_or_continue(route, request):
     if request.resource_type in ['document']:
-        route.continue_()
+        await route.continue_()
     else:
-        route.abort()
+        await route.abort()
 
-def scrape():
-    """ Main function driving the scraping process
+async def setup_page(page):
+    """ Only let the documents through on each of the pool's pages """
+    await page.route('**/*', abort_or_continue)
+    await replay.attach(page)
+
+async def extract_post(page, post):
+    """ Extract the article for the post, retrying according to the retry policy
+
+    :return: the article dict, or None if it couldn't be extracted
     """
-    offset = config[PUBLISHER]['offset']
+    try:
+        return await retrypolicy.get_policy().acall(post['permalink'], extract_article, page, post, retry_on=(Error,))
+    except (Error, retrypolicy.CircuitOpenError, retrypolicy.RetryBudgetExhausted):
+        get_logger().error(f"Failed to extract: {post['permalink']}", exc_info=True)
+        return None
+
+def categorize(post, ranked_categories):
+    """ Set the post's category to the highest ranked of its categories and series
+
+    :param post: a dict containing the content extracted from the category page
+    :param ranked_categories: the category names, in order of preference
+    :return: the set of the post's categories and series
+    """
+    categories = [c["name"] for c in post["categories"]]
+    series = [s["name"] for s in post["series"]]
+    tags = set(categories)
+    tags.update(set(series))
+
+    # Find the highest ranked tag that is present for this article
+    category = None
+    for cat in ranked_categories:
+        if cat in tags:
+            category = cat
+            break
+
+    # If we didn't find any tag in the rankings, choose the first category
+    if category == None:
+        category = list(tags)[0]
+
+    # Set the category for the post
+    post['category'] = category
+    return tags
 
+def load_ranked_categories():
+    """ :return: the category names, in order of preference """
     df = pd.read_csv(f"../data/{PUBLISHER}/alltags_ordered.csv", header=None)
-    ranked_categories = [row[0] for index,row in df.iterrows()]
+    return [row[0] for index,row in df.iterrows()]
 
+async def scrape():
+    """ Main function driving the scraping process
+    """
+    offset = config[PUBLISHER]['offset']
+    ranked_categories = load_ranked_categories()
+
+    async with async_playwright() as p:
+        browser = await launch_browser(p)
+        context = await browser.new_context(user_agent=AGENT)
+        pool = PagePool(context, CONCURRENCY, setup=setup_page, bucket=get_bucket(), logger=get_logger())
+        await pool.start()
+
+        try:
+            await scrape_posts(pool, offset, ranked_categories)
+            watermarks.save()
+        finally:
+            # Our context has to be closed explicitly when it lives in the shared browser
+            await pool.close()
+            await context.close()
+            await browser.close()
+
+async def scrape_posts(pool, offset, ranked_categories):
+    """ Page through the listing endpoint, extracting and saving every new post, until we hit MAX_EMPTY_PAGES pages
+    in a row without anything new. The articles from each listing page are extracted on the pool's pages at once
+
+    :param pool: the PagePool to load the articles on
+    :param offset: the listing offset to start at
+    :param ranked_categories: the category names, in order of preference
+    """
     empty_pages = 0
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        context = browser.new_context(user_agent=AGENT)
-        page = context.new_page()
-        page.route('**/*', lambda route, request: abort_or_continue(route, request))
-
-        while(1):
-            get_logger().debug(f"Grabbing next {LIMIT} articles starting at offset {offset}")
-            url = f'https://www.surfline.com/wp-json/sl/v1/taxonomy/posts/category?limit={LIMIT}&offset={offset}'
-            page.goto(url)
-            sleep(2)
-
-            source = doglog.clean_unicode(page.content())
-            sel = Selector(text=source)
-            json_str = sel.xpath("*//pre//text()").extract_first()
-            data = json.loads(json_str)
-
-            if data != None:
-                posts = data["posts"]
-
-                new_articles_found = 0
-                for i in range(len(posts)): # = limit for all the iterations, except last one
-                    post = posts[i]
-
-                    # There appear to be promos from other sites (worldsurfleague.com is one I found) and we don't want to include that
-                    if 'surfline.com' not in post['permalink']:
-                        continue
-
-                    if 'utm' in post['permalink']:
-                        post['permalink'] = scrub_url(post['permalink'])
-                    if post['permalink'] in already_scraped:
-                        continue
-
-                    premium = post["premium"]
-                    categories = [c["name"] for c in post["categories"]]
-                    series = [s["name"] for s in post["series"]]
-                    tags = set(categories)
-                    tags.update(set(series))
-
-                    # Find the highest ranked tag that is present for this article
-                    category = None
-                    for cat in ranked_categories:
-                        if cat in tags:
-                            category = cat
-                            break
-                    
-                    # If we didn't find any tag in the rankings, choose the first category
-                    if category == None:
-                        category = list(tags)[0]
-
-                    # Set the category for the post
-                    post['category'] = category
-
-                    # If the article is premium or not in English then skip it
-                    if premium == False and len(tags.intersection({"Español", "Português", "Premium"})) == 0:
-                        article = extract_article(page, post)
-                        if article is None:
-                            continue
-
-                        create_article(article)
-                        new_articles_found += 1
-            else:
+    from_top = offset == 0
+    while(1):
+        get_logger().debug(f"Grabbing next {LIMIT} articles starting at offset {offset}")
+        url = f'https://www.surfline.com/wp-json/sl/v1/taxonomy/posts/category?limit={LIMIT}&offset={offset}'
+        data = await pool.run(get_listing, url)
+
+        if data != None:
+            posts = data["posts"]
+            stop = from_top and watermarks.stop('posts', [canonicalize(post['permalink'], PUBLISHER) for post in posts])
+
+            new_posts = []
+            for i in range(len(posts)): # = limit for all the iterations, except last one
+                post = posts[i]
+
+                # There appear to be promos from other sites (worldsurfleague.com is one I found) and we don't want to include that
+                if 'surfline.com' not in post['permalink']:
+                    continue
+
+                post['permalink'] = canonicalize(post['permalink'], PUBLISHER)
+                if dedup_key(post['permalink'], PUBLISHER) in already_scraped:
+                    continue
+
+                premium = post["premium"]
+                tags = categorize(post, ranked_categories)
+
+                # If the article is premium or not in English then skip it
+                if premium == False and len(tags.intersection({"Español", "Português", "Premium"})) == 0:
+                    new_posts.append(post)
+
+            articles = [article for article in await pool.map(extract_post, new_posts) if article is not None]
+            create_articles(articles)
+            new_articles_found = len(articles)
+        else:
+            return
+
+        # Stop as soon as we reach the articles that were newest last run
+        if stop:
+            return
+        
+        # Keep track of if we should stop due to no new articles found...
+        if new_articles_found > 1:
+            empty_pages = 0
+        else:
+            empty_pages += 1
+            if empty_pages >= MAX_EMPTY_PAGES:
+                get_logger().info("Max number of empty pages reached, quitting.")
                 return
-            
-            # Keep track of if we should stop due to no new articles found...
-            if new_articles_found > 1:
-                empty_pages = 0
-            else:
-                empty_pages += 1
-                if empty_pages >= MAX_EMPTY_PAGES:
-                    get_logger().info("Max number of empty pages reached, quitting.")
-                    return
-            
-            # Update to get the next page worth of articles
-            offset += LIMIT
+        
+        # Update to get the next page worth of articles
+        offset += LIMIT
+
+def reparse_archive(outfile):
+    """ Re-run the article parser over every archived article page, without fetching anything. The posts from the
+    archived listing pages supply the fields that don't come from the article page itself
+
+    :param outfile: The jsonl file to write the extracted articles to
+    """
+    if ARCHIVE is None:
+        get_logger().error("The page archive isn't enabled in config.yml")
+        return
+
+    posts = {}
+    for url, source in ARCHIVE.pages(lambda u: 'wp-json' in u):
+        for post in json.loads(source)["posts"]:
+            posts[canonicalize(post['permalink'], PUBLISHER)] = post
+
+    ranked_categories = load_ranked_categories()
+    count = 0
+    with open(outfile, 'w') as out:
+        for url, source in ARCHIVE.pages(lambda u: 'wp-json' not in u):
+            if url not in posts:
+                get_logger().warn(f"No archived listing for: {url}")
+                continue
+            post = posts[url]
+            categorize(post, ranked_categories)
+            article = parse_article(post, source)
+            if article:
+                out.write(json.dumps(article, default=str) + "\n")
+                count += 1
+    get_logger().info(f"Re-extracted {count} articles from the archive into {outfile}")
 
 if __name__ == '__main__':
+    # Re-extract the archived pages instead of scraping: python scrape_surfline.py --reparse [outfile]
+    if len(sys.argv) > 1 and sys.argv[1] == '--reparse':
+        reparse_archive(sys.argv[2] if len(sys.argv) > 2 else f"../data/{PUBLISHER}_reparsed.jsonl")
+        exit()
+
+    # All fetch and API calls share one retry policy (backoff, retry budget and per-host circuit breakers)
+    retrypolicy.configure(config, get_logger())
+
+    # Record the site's responses, or replay them offline (see dogbeach/replay.py)
+    replay.configure(config, PUBLISHER, get_logger())
+
     # Query all the urls already scraped for this publisher
     load_already_scraped_articles()
 
     # Extract and save any new articles
     try:
-        scrape()
+        asyncio.run(scrape())
     finally:
         # DbToCsv(db)
         get_logger().info("\nDone.")
\ No newline at end of file
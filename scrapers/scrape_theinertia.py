@@ -7,12 +7,11 @@ import yaml
 import atexit
 import urllib
 import logging
-import requests
+import threading
 import numpy as np
 import pandas as pd
 
 from pathlib import Path
-from bs4 import BeautifulSoup
 from datetime import datetime
 
 
@@ -28,10 +27,32 @@ with open("../config.yml", "r") as ymlfile:
 # Import Doglog
 sys.path.append('..')
 from dogbeach import doglog
-from dogbeach.dogdriver import DogDriver
+from dogbeach import replay
+from dogbeach import retrypolicy
+from dogbeach import browserd
+from dogbeach.dogdriver import DogDriverPool, open_driver
+from dogbeach.fetcher import Fetcher, HttpFetcher, BrowserFetcher
+from dogbeach.engine import CrawlEngine, rate_limits
+from dogbeach.archive import open_archive
+from dogbeach.urlindex import open_url_index
+from dogbeach.urls import canonicalize, dedup_key
+from dogbeach.api import open_api
+from dogbeach.writebehind import open_writer
+from dogbeach.watermark import open_watermarks
+from dogbeach.contenthash import ContentHashes
+from dogbeach.checkpoint import open_checkpoint
+from dogbeach import parse as htmlparse
+from dogbeach.text import strip_tags
 
 _logger = None
+_api = None
+_writer = None
 _driver = None
+_driver_lock = threading.Lock()
+_pool = None
+_fetcher = None
+_engine = None
+_checkpoint = None
 
 PUBLISHER = 'theinertia'
 
@@ -53,6 +74,9 @@ REST_API_URL = f"{REST_API_PROTOCOL}://{REST_API_HOST}:{REST_API_PORT}"
 CREATE_ENDPOINT = f"{REST_API_URL}/article"
 PUBLISHER_ARTICLES_ENDPOINT = f"{REST_API_URL}/articleUrlsByPublisher?publisher={PUBLISHER}"
 
+# User Agent to use for plain HTTP requests
+AGENT = config['common']['agent']
+
 # UserID and BrowswerID are required fields for creating articles, this User is the ID tied to the system account
 SYSTEM_USER_ID = config['common']['system_user_id']
 
@@ -68,6 +92,31 @@ RETRIES = config[PUBLISHER]['retries'] if 'retries' in config[PUBLISHER] else No
 # How long to wait before giving up on a page load
 PAGELOAD_TIMEOUT = config[PUBLISHER]['page_load_timeout'] if 'page_load_timeout' in config[PUBLISHER] else None
 
+# Which resources should the browser skip loading (see dogdriver.BLOCKING_PROFILES), and when is a page "loaded"?
+BLOCK_RESOURCES = config[PUBLISHER]['block_resources'] if 'block_resources' in config[PUBLISHER] else None
+PAGE_LOAD_STRATEGY = config[PUBLISHER]['page_load_strategy'] if 'page_load_strategy' in config[PUBLISHER] else None
+
+# Attach to the shared browser service when it's running, rather than starting our own browser (see dogbeach/browserd.py)
+BROWSER_SERVICE = browserd.address(config)
+
+# Every fetched page is kept here (when enabled) so the parser can be re-run without re-crawling
+ARCHIVE = open_archive(config, PUBLISHER)
+
+# Parse pages with the parser backend set in config.yml (see dogbeach/parse.py)
+htmlparse.configure(config)
+
+# Only the article container is parsed out of an article page
+ARTICLE_ROOT = htmlparse.only("div.inertia-article", "main.inertia-article")
+
+# How many article pages should we load at once?
+CONCURRENCY = config[PUBLISHER]['concurrency'] if 'concurrency' in config[PUBLISHER] else 1
+
+# The host we're scraping, which is what the rate limit applies to
+HOST = config[PUBLISHER]['host'] if 'host' in config[PUBLISHER] else 'www.theinertia.com'
+
+# Do the category pages need a browser to render? (Otherwise they're fetched over plain HTTP)
+NEEDS_JS = config[PUBLISHER]['needs_js'] if 'needs_js' in config[PUBLISHER] else False
+
 # How many articles should we load for each "page" from The Inertia's API?
 ARTICLES_PER_PAGE = config[PUBLISHER]['articles_per_page']
 
@@ -78,6 +127,10 @@ WESTCOAST = pytz.timezone('US/Pacific')
 SURFCAT_URL = 'https://www.theinertia.com/wp-content/themes/theinertia-2014/quick-ajax.php' \
               + '?action=recent_posts&category={}&curated_list=false&paged=1&num={}'
 
+# What "loaded" means for a category page and for an article page, so we don't sleep any longer than we need to
+LISTING_READY = 'div.inertia-item, div.item'
+ARTICLE_READY = 'div.inertia-article, main.inertia-article'
+
 # The list of categories and codes we're interested in scraping
 CATEGORIES = {
     'art': 10,
@@ -95,6 +148,12 @@ MAX_EMPTY_PAGES = config[PUBLISHER]['max_empty_pages']
 # Track the list of article urls that have already been scraped
 already_scraped = set()
 
+# The newest articles in each listing last run, to stop paging once we reach them
+watermarks = None
+
+# The content hash of each article posted, to leave out the ones we already have
+hashes = None
+
 # A regex used to clean up some of the extracted text
 video_regex = re.compile('Volume \d+%.+')
 more_videos_regex = re.compile('More Videos\d+:.+')
@@ -117,28 +176,113 @@ def get_driver():
     :return: a DogDriver object
     """
     global _driver
-    if _driver is None:
-        _driver = DogDriver(get_logger())
+    # The categories are walked on the engine's threads, any of which can fall back to the browser
+    with _driver_lock:
+        if _driver is None:
+            _driver = open_driver(get_logger(), block=BLOCK_RESOURCES, page_load_strategy=PAGE_LOAD_STRATEGY,
+                                  debugger_address=BROWSER_SERVICE, archive=ARCHIVE)
+            if SLEEP:
+                _driver.sleep = SLEEP
+            if RETRIES:
+                _driver.tries = RETRIES
+            if PAGELOAD_TIMEOUT:
+                _driver.set_pageload_timeout(PAGELOAD_TIMEOUT)
+
+    return _driver
+
+
+def get_pool():
+    """ Initialize and/or return existing pool of webdriver objects used to load articles
+
+    :return: a DogDriverPool object
+    """
+    global _pool
+    if _pool is None:
+        driver_kwargs = {'block': BLOCK_RESOURCES, 'page_load_strategy': PAGE_LOAD_STRATEGY,
+                         'debugger_address': BROWSER_SERVICE, 'archive': ARCHIVE}
         if SLEEP:
-            _driver.sleep = SLEEP
+            driver_kwargs['sleep'] = SLEEP
         if RETRIES:
-            _driver.tries = RETRIES
+            driver_kwargs['tries'] = RETRIES
         if PAGELOAD_TIMEOUT:
-            _driver.set_pageload_timeout(PAGELOAD_TIMEOUT)
-    
-    return _driver
+            driver_kwargs['pageload_timeout'] = PAGELOAD_TIMEOUT
+        _pool = DogDriverPool(CONCURRENCY, get_logger(), bucket=get_engine().bucket(HOST), **driver_kwargs)
 
+    return _pool
 
-def load_already_scraped_articles():
-    """ Query the database for all articles that have already been scraped
 
-    :return: a list of urls of articles that have already been scraped
+def get_fetcher():
+    """ Initialize and/or return existing fetcher for the category pages, which are plain ajax html
+
+    :return: a Fetcher object
+    """
+    global _fetcher
+    if _fetcher is None:
+        browser = BrowserFetcher(get_driver, ready=LISTING_READY)
+        _fetcher = Fetcher(HttpFetcher(get_logger(), AGENT, archive=ARCHIVE), browser, NEEDS_JS, get_logger())
+
+    return _fetcher
+
+
+def get_engine():
+    """ Initialize and/or return existing crawl engine, which holds the per-host rate limits
+
+    :return: a CrawlEngine object
+    """
+    global _engine
+    if _engine is None:
+        # The browser fetcher loads one page at a time whenever it's used, but if every category page goes through
+        # the browser there's no point having more of them waiting on it
+        host_concurrency = {HOST: 1} if NEEDS_JS else {}
+        _engine = CrawlEngine(rate_limits(config), host_concurrency=host_concurrency, fetcher=get_fetcher(),
+                              logger=get_logger())
+
+    return _engine
+
+
+def get_checkpoint():
+    """ Initialize and/or return the checkpoint of this run, which is resumed if the last run didn't finish
+
+    :return: a Checkpoint object
+    """
+    global _checkpoint
+    if _checkpoint is None:
+        _checkpoint = open_checkpoint(config, PUBLISHER, get_logger())
+
+    return _checkpoint
+
+
+def get_api():
+    """ Initialize and/or return the REST API client, which keeps its connections open for the whole run
+
+    :return: an ApiClient object
+    """
+    global _api
+    if _api is None:
+        _api = open_api(config, get_logger())
+    return _api
+
+
+def get_writer():
+    """ Initialize and/or return the write-behind queue, which posts scraped articles while the next ones load
+
+    :return: a WriteBehind object
+    """
+    global _writer
+    if _writer is None:
+        _writer = open_writer(config, post_scraped, get_logger())
+    return _writer
+
+
+def load_already_scraped_articles():
+    """ Bring the local index of the articles that have already been scraped up to date with the database
     """
-    global already_scraped
+    global already_scraped, hashes, watermarks
 
-    r = requests.get(PUBLISHER_ARTICLES_ENDPOINT)
-    urls_json = r.json()
-    already_scraped = set([x['url'].rstrip('/').split("/")[-1] for x in urls_json])
+    already_scraped = open_url_index(config, PUBLISHER, logger=get_logger())
+    already_scraped.sync(PUBLISHER_ARTICLES_ENDPOINT)
+    watermarks = open_watermarks(config, already_scraped, get_logger())
+    hashes = ContentHashes(already_scraped, get_logger())
     get_logger().debug("Found {} articles already scraped".format(len(already_scraped)))
 
 
@@ -149,40 +293,12 @@ def find_unscraped_articles():
     Categories: Films (broken), Surf, Mountain (skip), Enviro, Health, Photo, Arts, Travel, Women
   """
   get_logger().debug("Starting scrape...")
+
+  # Walk all the categories at once, the engine keeps us within the rate limit for the site
+  categories = get_engine().run([find_unscraped_category_articles(cat, catnum) for cat, catnum in CATEGORIES.items()])
+
   all_articles_list = []
-  for cat, catnum in CATEGORIES.items():
-      get_logger().debug("Processing category: {}".format(cat))
-      pagenum = -1
-      empty_pages = 0
-      category_articles = []
-      while 1 == 1:
-          # increment the page counter
-          pagenum += 1
-          
-          # Extract and clean the html source for the current page
-          cat_page_url = SURFCAT_URL.format(catnum, pagenum * ARTICLES_PER_PAGE)
-          get_logger().debug("Scraping category page: {}".format(cat_page_url))
-          get_driver().get_url(cat_page_url)
-          raw_source = get_driver().driver.page_source
-          source = doglog.clean_unicode(raw_source)
-
-          # build a list of all articles on this page that haven't been scraped yet
-          page_articles = extract_article_list(cat, source)
-          category_articles += page_articles
-          
-          # if we have any new articles on the page, add them. If this is the MAX_EMPTY_PAGES page
-          # in a row without a single unscraped article, then quit and start extracting the data from the generated
-          # list
-          if len(page_articles) == 0:
-              empty_pages += 1
-              if empty_pages < MAX_EMPTY_PAGES:
-                  continue
-              else:
-                  get_logger().info("All articles on page {} have already been scraped, exiting...".format(int(pagenum)))
-                  break
-          else:
-              empty_pages = 0
-      
+  for category_articles in categories:
       if len(category_articles) > 0:
         # Reverse the articles in each category so they are added to the database oldest first. If the scraper crashes, there will be
         # no chance that older pages will be skipped after newer pages are fully scraped
@@ -190,18 +306,75 @@ def find_unscraped_articles():
     
   return all_articles_list
 
+async def find_unscraped_category_articles(cat, catnum):
+  """ Page through a single category until we run into MAX_EMPTY_PAGES pages in a row that have all been scraped
+
+  :param cat: The category name
+  :param catnum: The category code used by the endpoint
+  :return: A list of article cards, newest first
+  """
+  get_logger().debug("Processing category: {}".format(cat))
+
+  # Carry on from the last page the checkpoint has for this category, if the last run stopped partway through
+  progress = get_checkpoint().get(cat, {'page': -1, 'empty': 0, 'articles': [], 'done': False})
+  if progress['done']:
+      return progress['articles']
+  pagenum = progress['page']
+  empty_pages = progress['empty']
+  category_articles = progress['articles']
+  while 1 == 1:
+      # increment the page counter
+      pagenum += 1
+      
+      # Extract and clean the html source for the current page
+      cat_page_url = SURFCAT_URL.format(catnum, pagenum * ARTICLES_PER_PAGE)
+      get_logger().debug("Scraping category page: {}".format(cat_page_url))
+      raw_source = await get_engine().fetch(cat_page_url)
+      source = doglog.clean_unicode(raw_source or '')
+
+      # build a list of all articles on this page that haven't been scraped yet
+      page_articles, page_urls = extract_article_list(cat, source)
+      category_articles += page_articles
+      get_checkpoint().put(cat, {'page': pagenum, 'empty': empty_pages + (len(page_articles) == 0),
+                                 'articles': category_articles, 'done': False})
+      
+      # Stop as soon as we reach the articles that were newest last run
+      if watermarks.stop(cat, page_urls):
+          break
+
+      # if we have any new articles on the page, add them. If this is the MAX_EMPTY_PAGES page
+      # in a row without a single unscraped article, then quit and start extracting the data from the generated
+      # list
+      if len(page_articles) == 0:
+          empty_pages += 1
+          if empty_pages < MAX_EMPTY_PAGES:
+              continue
+          else:
+              get_logger().info("All articles on page {} have already been scraped, exiting...".format(int(pagenum)))
+              break
+      else:
+          empty_pages = 0
+
+  get_checkpoint().put(cat, {'page': pagenum, 'empty': empty_pages, 'articles': category_articles, 'done': True})
+  return category_articles
+
 def scrape():
     """ 
 
     :return:
     """
-    # Get the list of unscraped articles
-    unscraped_articles = find_unscraped_articles()
+    # Get the list of unscraped articles (the checkpoint's frontier, if the last run found them but didn't finish)
+    if not get_checkpoint().get('listed', False):
+      get_checkpoint().add(find_unscraped_articles())
+      get_checkpoint().put('listed', True)
+    unscraped_articles = get_checkpoint().pending()
     
     # If there's anything to scrape, then scrape the individual article content and push to the database
     if len(unscraped_articles) > 0:
       extract_articles(unscraped_articles)
 
+    watermarks.save()
+    get_checkpoint().finish()
     get_logger().info("Successfully completed scrape of latest The Inertia news.")
 
 def extract_article_list(category, post_source):
@@ -214,27 +387,29 @@ def extract_article_list(category, post_source):
 
   :param category: The category we're currently scraping
   :param post_source: The html for an entire page of results
-  :return: A list of article URLs scraped from the page, in the order they were scraped
+  :return: A list of the new article cards, and a list of the urls of every card on the page, both in page order
   """
   global already_scraped
 
   # Extract all the divs containing article cards. There are two possible html layouts
-  soup = BeautifulSoup(post_source, "html.parser")
+  soup = htmlparse.soup(post_source)
   article_divs = soup.find_all("div", class_="inertia-item")
   if len(article_divs) == 0:
     # Perhaps we're dealing with old html, the class switched in Nov 2018
     article_divs = soup.find_all("div", class_="item")
     if len(article_divs) == 0:
       get_logger().warn("No articles found to extract")
-      return []
+      return [], []
 
   # From each article div, extract the partial content (url, thumbnail, category) from the card
   articles = []
+  page_urls = []
   get_logger().info("Extracting {} articles starting with: {}".format(len(article_divs), article_divs[0].find('a').get('href')))
   for article_div in article_divs:
     # print(article.prettify())
-    url = article_div.find('a').get('href')[:-1]
-    if url.split("/")[-1] in already_scraped:
+    url = canonicalize(article_div.find('a').get('href'), PUBLISHER)
+    page_urls.append(url)
+    if dedup_key(url, PUBLISHER) in already_scraped:
       continue
     img = article_div.find('img').get('src')
     if img is None:
@@ -249,7 +424,7 @@ def extract_article_list(category, post_source):
     get_logger().debug("Article card found: {}".format(article_json))
     articles += [article_json]
 
-  return articles
+  return articles, page_urls
 
 def extract_articles(articles):
   """
@@ -260,41 +435,72 @@ def extract_articles(articles):
   :param post_source: The html for an entire page of results
   :return: True if we encountered *any* urls that we've already scraped, False if not
   """
-  # Load each article and extract the rest of the data
-  for article in articles:
-    article = scrape_article(article)
-    
-    # Send the article data to the REST API...
-    if article:
-        create_article(article)
-    else:
-        get_logger().error("Failed to scrape article\n")
+  # Load the articles on the driver pool and extract the rest of the data, results come back in the original order.
+  # Each one is queued for the REST API as it comes in, and posted while the pool carries on with the next ones
+  results = zip(articles, get_pool().map(lambda driver, a: scrape_article(a, driver), [dict(a) for a in articles]))
+  for card, article in results:
+    get_writer().put((card, article))
+  get_writer().flush()
+
+
+def post_scraped(batch):
+  """ Send a batch of scraped articles to the REST API, and take them off the checkpoint's frontier (this runs on the
+  write-behind queue's thread)
+
+  :param batch: A list of (card, article) pairs, the article being None if it failed to scrape
+  """
+  create_articles([article for _, article in batch if article])
+  for card, article in batch:
+    if not article:
+      get_logger().error("Failed to scrape article\n")
 
+    # Either way it's off the frontier, a failed article is picked up again by the next run's listing walk
+    get_checkpoint().done(card['url'])
 
-def scrape_article(article):
+
+def scrape_article(article, driver=None):
     """ For the provided article url, load the article and find whatever data is available
 
     :param article: The initial fields of the article in a dictionary
+    :param driver: The DogDriver to load the page with (defaults to the shared driver)
     :return:
     """
+    driver = get_driver() if driver is None else driver
+
     # Load the article and wait for it to load
     get_logger().debug("Processing URL: {}".format(article['url']))
 
     # Try to load the page
-    fully_loaded = get_driver().get_url(article['url'])
+    fully_loaded = driver.get_url(article['url'], ready=ARTICLE_READY)
 
     # Sometime The Inertia pages take 10 minutes to finish loading because of an autoplay video
-    if not fully_loaded and not get_driver().driver.page_source:
+    if not fully_loaded and not driver.driver.page_source:
         # We'll just have to skip this url, can't load it even with retries
         return
-    
-    source = doglog.clean_unicode(get_driver().driver.page_source)
+
+    # Keep the page's hash along with the article's, for backfills to compare against
+    source = driver.driver.page_source
+    if hashes is not None:
+        hashes.check_page(article['url'], source)
+
+    return parse_article(article, source)
+
+
+def parse_article(article, raw_source):
+    """ Extract the article's data from its page source. This doesn't need the browser, so it can be run over
+    archived pages as well
+
+    :param article: The initial fields of the article in a dictionary
+    :param raw_source: The html of the article page
+    :return: the populated dictionary, or None if the page isn't a usable article
+    """
+    source = doglog.clean_unicode(raw_source)
     if 'ERROR 404' in source:
         get_logger().debug("Skipping (url is a 404) - {}".format(article['url']))
         return
     
     # There are different formats/html structure so figure out which we're dealing with
-    soup = BeautifulSoup(source, "html.parser")
+    soup = htmlparse.soup(source, only=ARTICLE_ROOT)
     article_soup = soup.find("div", class_="inertia-article")
     if article_soup is None:
         article_soup = soup.find("main", class_="inertia-article")
@@ -341,37 +547,18 @@ def scrape_article(article):
     return article
 
 
-def remove_html_markup(s):
-    """ https://stackoverflow.com/questions/753052/strip-html-from-strings-in-python """
-    tag = False
-    quote = False
-    out = ""
-
-    for c in s:
-        if c == '<' and not quote:
-            tag = True
-        elif c == '>' and not quote:
-            tag = False
-        elif (c == '"' or c == "'") and tag:
-            quote = not quote
-        elif not tag:
-            out = out + c
-
-    return out
-
-
 def cleanup_text(s):
     """ Perform know cleanup for the text content of the article
     """
     # The term "Advertisement" shows up wherever an ad was displayed
-    s = s.replace('Advertisement', '')
+    s = doglog.remove_phrases(s, ['Advertisement'])
     
     # Use a regular expression to clear out boilerplate content from video iframe
     s = video_regex.sub('', s).strip()
     s = more_videos_regex.sub('', s).strip()
     
     # Remove any remaining html tags encountered
-    s = remove_html_markup(s)
+    s = strip_tags(s)
 
     # Strip whitespace
     s = s.strip()
@@ -477,34 +664,74 @@ def get_article_content(soup, article):
 
     return article
 
-def create_article(article):
-    """
-    Push this article to the database through the REST API
+def create_articles(articles):
+    """ Push the articles to the database through the REST API, in batches
 
-    :param articles:
-    :return:
+    :param articles: A list of article dictionaries
+    :return: the ApiResult for each article posted, in order
     """
-    global already_scraped
-
-    # Add some common fields
-    article['userId'] = SYSTEM_USER_ID
-    article['browserId'] = SCRAPER_BROWSER_ID
-    article['publisher'] = PUBLISHER
-    get_logger().debug("Writing article to RDS...\n{}".format(article))
-
-    header = { "Content-Type": "application/json" }
-    json_data = json.dumps(article, default=str)
-    r = requests.post(CREATE_ENDPOINT, headers=header, data=json_data)
-    get_logger().info("\n\n=================================================================================\n\n")
-    
-    try:
-      r.raise_for_status()
-    except Exception as ex:
-      get_logger().error(f"There was a {type(ex)} error while creating article {article['url']}:...\n{r.json()}")
+    changed = []
+    for article in articles:
+        article['url'] = canonicalize(article['url'], PUBLISHER)
+
+        # We already have this article word for word, so there's nothing to post
+        if hashes is not None and hashes.unchanged(article):
+            get_logger().debug(f"Skipping unchanged article {article['url']}")
+            already_scraped.record(article['url'])
+            continue
+        moved_from = hashes.moved(article) if hashes is not None else None
+        if moved_from is not None:
+            get_logger().info(f"Skipping article {article['url']}, it's the same as {moved_from}")
+            already_scraped.record(article['url'])
+            continue
+        get_logger().debug("Writing article to RDS...\n{}".format(article))
+        changed.append(article)
+
+    results = get_api().create(changed, PUBLISHER)
+    for result in results:
+        # Posted, or spooled in the outbox to be posted later, either way the page doesn't need loading again
+        if result.ok or result.spooled:
+            already_scraped.record(result.item['url'])
+        else:
+            get_logger().error(f"There was a {result.error} error while creating article {result.item['url']}")
+    if hashes is not None:
+        hashes.remember([result.item for result in results if result.ok or result.spooled])
+    return results
 
 @atexit.register
 def cleanup():
-    get_driver().driver.quit()
+    if _writer is not None:
+        _writer.close()
+    if _pool is not None:
+        _pool.quit()
+    if _driver is not None:
+        _driver.quit()
+
+
+def reparse_archive(outfile, changed_only=False):
+    """ Re-run the article parser over every archived article page, without fetching anything
+
+    :param outfile: The jsonl file to write the extracted articles to
+    :param changed_only: Only parse the pages that have changed since they were last parsed
+    """
+    if ARCHIVE is None:
+        get_logger().error("The page archive isn't enabled in config.yml")
+        return
+
+    page_hashes = ContentHashes(open_url_index(config, PUBLISHER, logger=get_logger()), get_logger())
+    count, unchanged = 0, 0
+    with open(outfile, 'w') as out:
+        for url, source in ARCHIVE.pages(lambda u: 'quick-ajax.php' not in u):
+            # Every page is hashed, so the next --changed run has something to compare with
+            if page_hashes.check_page(url, source) and changed_only:
+                unchanged += 1
+                continue
+            article = parse_article({'url': url}, source)
+            if article:
+                out.write(json.dumps(article, default=str) + "\n")
+                count += 1
+            page_hashes.remember_pages([url])
+    get_logger().info(f"Re-extracted {count} articles from the archive into {outfile} ({unchanged} pages unchanged)")
 
 
 def test_urls(urls):
@@ -532,6 +759,20 @@ if __name__ == "__main__":
     # To get the script to see files in this directory (including chromedriver)
     os.chdir(os.path.dirname(sys.argv[0]))
 
+    # Re-extract the archived pages instead of scraping: python scrape_theinertia.py --reparse [outfile] [--changed]
+    # (--changed only parses the pages that are different from when they were last parsed)
+    if len(sys.argv) > 1 and sys.argv[1] == '--reparse':
+        args = [arg for arg in sys.argv[2:] if arg != '--changed']
+        reparse_archive(args[0] if len(args) > 0 else f"../data/{PUBLISHER}_reparsed.jsonl",
+                        changed_only='--changed' in sys.argv)
+        exit()
+
+    # All fetch and API calls share one retry policy (backoff, retry budget and per-host circuit breakers)
+    retrypolicy.configure(config, get_logger())
+
+    # Record the site's responses, or replay them offline (see dogbeach/replay.py)
+    replay.configure(config, PUBLISHER, get_logger())
+
     load_already_scraped_articles()
 
     scrape()
@@ -1,12 +1,9 @@
 import os
 import re
 import sys
-import json
-import time
 import yaml
 import atexit
 import logging
-import requests
 import urllib.parse
 from pathlib import Path
 
@@ -24,7 +21,14 @@ with open("../config.yml", "r") as ymlfile:
 # Import Doglog
 sys.path.append('..')
 from dogbeach import doglog
+from dogbeach import retrypolicy
+from dogbeach import replay
+from dogbeach.urlindex import open_url_index
+from dogbeach.urls import canonicalize, dedup_key
+from dogbeach.api import open_api
+from dogbeach.watermark import open_watermarks
 _logger = None
+_api = None
 
 # What is the API endpoint
 REST_API_PROTOCOL = config['common']['rest_api']['protocol']
@@ -43,6 +47,9 @@ SCRAPER_BROWSER_ID = config['common']['browser_id']
 # The URLs of the articles that have already been scraped
 ALREADY_SCRAPED = set()
 
+# The newest videos in each playlist last run, to stop paging once we reach them
+WATERMARKS = None
+
 # The number of videos to request in each page from youtube's API
 RESULTS_PER_PAGE = config['youtube']['videos_per_page']  # youtube does not permit values higher than 50
 
@@ -52,6 +59,9 @@ MAX_EMPTY_PAGES = config['youtube']['max_empty_pages']
 # Google API Key
 GOOGLE_API_KEY = config['youtube']['api_key']
 
+# The host of the Youtube API, for the retry policy's circuit breaker
+YOUTUBE_API_URL = 'https://www.googleapis.com/youtube/v3'
+
 # The minimum length of a video to scrape
 MIN_VIDEO_DURATION = 3 * 60
 
@@ -87,18 +97,28 @@ def close_youtube():
     get_youtube().close()
 
 
+def get_api():
+    """ Initialize and/or return the REST API client, which keeps its connections open for the whole run
+
+    :return: an ApiClient object
+    """
+    global _api
+    if _api is None:
+        _api = open_api(config, get_logger())
+    return _api
+
+
 def get_already_scraped(channel_names):
-    """ For each of the channels that we're scraping, lookup all URLs we've already scraped to avoid duplicates
+    """ For each of the channels that we're scraping, bring the local index of the URLs we've already scraped up to
+    date, to avoid duplicates. Each channel keeps its own sync cursor, so only its new videos are fetched
     """
-    global ALREADY_SCRAPED
+    global ALREADY_SCRAPED, WATERMARKS
 
+    ALREADY_SCRAPED = open_url_index(config, 'youtube', logger=get_logger())
+    WATERMARKS = open_watermarks(config, ALREADY_SCRAPED, get_logger())
     for channel_name in channel_names:
-        r = requests.get(PUBLISHER_ARTICLES_ENDPOINT + urllib.parse.quote_plus(channel_name))
-        urls_json = r.json()
-        channel_urls = set([x['url'] for x in urls_json])
-        get_logger().debug(f"{channel_name}: {len(channel_urls)} videos found")
-
-        ALREADY_SCRAPED.update(channel_urls)
+        added = ALREADY_SCRAPED.sync(PUBLISHER_ARTICLES_ENDPOINT + urllib.parse.quote_plus(channel_name))
+        get_logger().debug(f"{channel_name}: {added} new videos found")
 
     # get_logger().debug(ALREADY_SCRAPED)
     get_logger().debug("Found {} articles already scraped".format(len(ALREADY_SCRAPED)))
@@ -217,8 +237,13 @@ def scrape_playlist(playlist_id):
         request = get_youtube().playlistItems().list(**params)
         
         # Execute request and set parameters for next iteration
-        response = request.execute()
-        time.sleep(1)
+        response = replay.call(replay.scrub(request.uri),
+                               lambda: retrypolicy.get_policy().call(YOUTUBE_API_URL, request.execute,
+                                                                     retry_on=(OSError,)))
+        replay.pause(1)
+        if response is None:
+            # Replaying, and the recording stopped before this page
+            break
         # get_logger().debug(response)
         # get_logger().debug(json.dumps(response, sort_keys=True, indent=4))
 
@@ -234,9 +259,13 @@ def scrape_playlist(playlist_id):
 
         # Extract the necessary data from the response
         page_videos = [extract_video_data(x) for x in response['items']]
+
+        # The uploads playlist is newest first, so there's nothing new past the videos that were newest last run
+        if WATERMARKS.stop(playlist_id, [x['url'] for x in page_videos], [x['publishedAt'] for x in page_videos]):
+            more = False
         
         # Filter out the videos we've already scraped
-        page_videos = [x for x in page_videos if x['url'] not in ALREADY_SCRAPED]
+        page_videos = [x for x in page_videos if dedup_key(x['url'], 'youtube') not in ALREADY_SCRAPED]
         
         # Get the IDs of the videos from this page of the current playlist
         video_ids = [x['id'] for x in page_videos]
@@ -246,8 +275,12 @@ def scrape_playlist(playlist_id):
             part = "contentDetails",
             id = ",".join(video_ids)
         )
-        video_response = video_request.execute()
-        time.sleep(1)
+        video_response = replay.call(replay.scrub(video_request.uri),
+                                     lambda: retrypolicy.get_policy().call(YOUTUBE_API_URL, video_request.execute,
+                                                                           retry_on=(OSError,)))
+        replay.pause(1)
+        if video_response is None:
+            break
         # get_logger().debug(json.dumps(video_response, sort_keys=True, indent=4))
 
         # Process the video duration response
@@ -284,24 +317,22 @@ def scrape_playlist(playlist_id):
 def create_videos(videos):
     """ Push the videos to the database through the REST API
     """
+    articles = []
     for video in videos:
-        # Add some common fields
-        video['userId'] = SYSTEM_USER_ID
-        video['browserId'] = SCRAPER_BROWSER_ID
+        video['url'] = canonicalize(video['url'], 'youtube')
         video = {key:val for key, val in video.items() if key not in ['id', 'duration']}
         # get_logger().debug("Writing article to RDS...\n{}".format(video))
         video_str = f"WRITING: {video['publisher']} : {video['publishedAt']} : {video['title']}"
         get_logger().debug(video_str)
+        articles.append(video)
 
-        header = { "Content-Type": "application/json" }
-        json_data = json.dumps(video, default=str)
-        r = requests.post(CREATE_ENDPOINT, headers=header, data=json_data)
-        
-        try:
-            r.raise_for_status()
-        except Exception as ex:
-            message = f"There was a {type(ex)} error while creating article {video['url']}:...\n{r.json()}"
-            get_logger().error(message)
+    # Each video keeps its channel as its publisher
+    for result in get_api().create(articles):
+        # Posted, or spooled in the outbox to be posted later, either way the page doesn't need loading again
+        if result.ok or result.spooled:
+            ALREADY_SCRAPED.record(result.item['url'])
+        else:
+            get_logger().error(f"There was a {result.error} error while creating article {result.item['url']}")
 
 
 
@@ -319,6 +350,12 @@ def scrape_playlists(playlist_ids):
 
 
 def main():
+    # All fetch and API calls share one retry policy (backoff, retry budget and per-host circuit breakers)
+    retrypolicy.configure(config, get_logger())
+
+    # Record the API's responses, or replay them offline (see dogbeach/replay.py)
+    replay.configure(config, 'youtube', get_logger())
+
     # Get the list of channels and ids to scrape from a config file
     channels = get_channels()
     get_logger().debug(f"Channels : {channels}")
@@ -332,6 +369,8 @@ def main():
     videos = scrape_playlists(playlists)
     get_logger().debug(f"Scraped {len(videos)} total videos")    
 
+    WATERMARKS.save()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file